@@ -1,9 +1,10 @@
 import base64
 from functools import wraps
-from threading import Thread
 from typing import (
+    Any,
     Dict,
     Tuple,
+    cast,
 )
 
 import requests
@@ -14,9 +15,11 @@ from flask import (
 )
 
 from harvey.config import Config
-from harvey.deployments import Deployment
 from harvey.errors import HarveyError
+from harvey.metrics import WEBHOOKS
+from harvey.prefetcher import PREFETCHER
 from harvey.repos.webhooks import update_webhook
+from harvey.scheduler import SCHEDULER
 from harvey.webhooks import Webhook
 
 
@@ -74,6 +77,8 @@ class Api:
         payload_data = request.data  # We need this to properly decode the webhook secret
         signature = request.headers.get('X-Hub-Signature-256')
 
+        reason = 'error'
+
         if payload_json:
             repo_full_name = Webhook.repo_full_name(payload_json)
             logger.info(f'Webhook received for: {repo_full_name}')
@@ -86,18 +91,20 @@ class Api:
             if Config.webhook_secret and not Webhook.validate_webhook_secret(payload_data, signature):
                 message = 'The X-Hub-Signature did not match the WEBHOOK_SECRET.'
                 status_code = 403
+                reason = 'signature_mismatch'
             elif (branch_name in Config.allowed_branches) or (
                 Config.deploy_on_tag and tag_commit in payload_json['ref']
             ):
-                Thread(
-                    name=repo_full_name,
-                    target=Deployment.run_deployment,
-                    args=(payload_json,),
-                ).start()
+                # The payload has been validated as a push webhook by now
+                webhook = cast(Dict[str, Any], payload_json)
+                SCHEDULER.submit(webhook)
+                # Start fetching the commit while the deployment waits in the queue
+                PREFETCHER.submit(webhook)
 
                 message = f'Started deployment for {repo_full_name}'
                 status_code = 200
                 success = True
+                reason = 'accepted'
 
                 logger.info(message)
 
@@ -111,14 +118,18 @@ class Api:
                     f' ALLOWED_BRANCHES for {repo_full_name}.'
                 )
                 status_code = 422
+                reason = 'branch_not_allowed'
 
                 logger.error(message)
         else:
             message = 'Malformed or missing JSON data in webhook.'
             status_code = 422
+            reason = 'malformed_payload'
 
             logger.error(message)
 
+        WEBHOOKS.inc(status_code=str(status_code), reason=reason)
+
         response = {
             'success': success,
             'message': message,
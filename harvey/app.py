@@ -13,26 +13,40 @@ import woodchips
 from dotenv import load_dotenv
 from flask import (
     Flask,
+    Response,
     abort,
     request,
+    stream_with_context,
 )
 
 from harvey.api import Api
 from harvey.config import Config
-from harvey.deployments import Deployment
-from harvey.errors import HarveyError
+from harvey.containers import DOCKER_CLIENT_POOL
+from harvey.errors import (
+    HarveyError,
+    InvalidRequestError,
+)
 from harvey.locks import (
     lock_project,
     retrieve_lock,
     unlock_project,
 )
+from harvey.metrics import METRICS
 from harvey.repos.deployments import (
     retrieve_deployment,
+    retrieve_deployment_logs,
     retrieve_deployments,
+    stream_deployment_log,
 )
+from harvey.repos.jobs import retrieve_active_deployments
 from harvey.repos.locks import retrieve_locks
-from harvey.repos.projects import retrieve_projects
+from harvey.repos.projects import (
+    retrieve_project_containers,
+    retrieve_projects,
+)
 from harvey.repos.webhooks import retrieve_webhook
+from harvey.scheduler import SCHEDULER
+from harvey.tracing import retrieve_trace
 from harvey.utils.utils import (
     run_subprocess_command,
     setup_logger,
@@ -80,9 +94,23 @@ def bootstrap() -> bool:
     # Allows us to use requests_unixsocket via requests
     requests_unixsocket.monkeypatch()
 
+    # Run the deployments left in the queue by a previous run rather than waiting for the next webhook to arrive
+    if not Config.external_runner:
+        SCHEDULER.start()
+
     return debug
 
 
+@APP.errorhandler(400)
+def bad_request(error) -> Dict[str, Any]:
+    """Return a 400 if the request is invalid (eg: a malformed URL param)."""
+    return _create_response_dict(
+        message=error.description,
+        success=False,
+        status_code=400,
+    )
+
+
 @APP.errorhandler(401)
 def not_authorized(error):
     """Return a 401 if the request is not authorized."""
@@ -131,9 +159,25 @@ def retrieve_deployments_endpoint():
     - The keys will be `username-repo_name-commit_id`.
     - The user can optionally pass a URL param of `page_size` to limit how many results are returned
     - The user can optionally pass a URL param of `project` to filter what deployments get returned
+    - The user can optionally pass a URL param of `cursor` (the `next_cursor` of the previous page) to paginate
     """
     try:
         return retrieve_deployments(request)
+    except InvalidRequestError as error:
+        return abort(400, str(error))
+    except Exception as error:
+        _log_error(error)
+        return abort(500)
+
+
+@APP.route('/deployments/active', methods=['GET'])
+@Api.check_api_key
+def retrieve_active_deployments_endpoint():
+    """Retrieves the deployments in flight across every Harvey process along with their current stage, start time,
+    PIDs, and last heartbeat.
+    """
+    try:
+        return retrieve_active_deployments()
     except Exception as error:
         _log_error(error)
         return abort(500)
@@ -153,6 +197,66 @@ def retrieve_deployment_endpoint(deployment_id: str):
         return abort(500)
 
 
+@APP.route('/deployments/<deployment_id>/trace', methods=['GET'])
+@Api.check_api_key
+def retrieve_deployment_trace_endpoint(deployment_id):
+    """Retrieves the spans recorded while a deployment ran along with a timeline of them (tracing must be
+    enabled via `TRACE_EXPORTER`).
+
+    A `deployment_id` will be `username-repo_name-commit_id`, the most recent attempt is retrieved unless the user
+    passes a URL param of `attempt`.
+    """
+    try:
+        return retrieve_trace(deployment_id, request)
+    except InvalidRequestError as error:
+        return abort(400, str(error))
+    except Exception as error:
+        _log_error(error)
+        return abort(500)
+
+
+@APP.route('/deployments/<deployment_id>/logs', methods=['GET'])
+@Api.check_api_key
+def retrieve_deployment_logs_endpoint(deployment_id: str):
+    """Retrieve the logs of a deployment's attempts by deployment ID.
+
+    - The user can optionally pass a URL param of `attempt` to only retrieve the log of a single attempt
+    """
+    try:
+        return retrieve_deployment_logs(deployment_id, request)
+    except InvalidRequestError as error:
+        return abort(400, str(error))
+    except Exception as error:
+        _log_error(error)
+        return abort(500)
+
+
+@APP.route('/deployments/<deployment_id>/logs/stream', methods=['GET'])
+@Api.check_api_key
+def stream_deployment_logs_endpoint(deployment_id: str):
+    """Stream the log of a deployment's most recent attempt via Server-Sent Events while it runs.
+
+    - Clients reconnecting can pass a `Last-Event-ID` header to resume the stream where they left off
+    """
+    last_event_id = request.headers.get('Last-Event-ID', '0')
+    if not last_event_id.isdigit():
+        return abort(400, f'Invalid Last-Event-ID: {last_event_id}')
+
+    try:
+        events = stream_deployment_log(deployment_id, int(last_event_id))
+        return Response(
+            stream_with_context(events),
+            mimetype='text/event-stream',
+            headers={
+                'Cache-Control': 'no-cache',
+                'X-Accel-Buffering': 'no',  # Stops nginx from buffering the stream
+            },
+        )
+    except Exception as error:
+        _log_error(error)
+        return abort(500)
+
+
 # Notably, we do not check the API key here because we'll check its presence later when we parse the webhook
 @APP.route('/deploy', methods=['POST'])
 def deploy_project_endpoint():
@@ -187,11 +291,7 @@ def redeploy_project_endpoint(project_name):
         if not webhook:
             raise HarveyError(f'Webhook does not exist for {project_name}')
         else:
-            threading.Thread(
-                name=project_name,
-                target=Deployment.run_deployment,
-                args=(webhook,),
-            ).start()
+            SCHEDULER.submit(webhook, redeploy=True)
             return _create_response_dict(
                 f'Redeploying {project_name}...',
                 success=True,
@@ -223,6 +323,23 @@ def retrieve_project_webhook_endpoint(project_name):
         return abort(500)
 
 
+@APP.route('/projects/<project_name>/containers', methods=['GET'])
+@Api.check_api_key
+def retrieve_project_containers_endpoint(project_name):
+    """Retrieves the status of the containers of a project."""
+    try:
+        webhook = retrieve_webhook(project_name)
+        if not webhook:
+            return abort(404)  # This will throw an exception in the except block below
+        else:
+            return retrieve_project_containers(webhook)
+    except werkzeug.exceptions.NotFound:
+        raise
+    except Exception as error:
+        _log_error(error)
+        return abort(500)
+
+
 @APP.route('/projects/<project_name>/lock', methods=['PUT'])
 @Api.check_api_key
 def lock_project_endpoint(project_name: str):
@@ -270,7 +387,9 @@ def retrieve_lock_endpoint(project_name: str):
 @APP.route('/threads', methods=['GET'])
 @Api.check_api_key
 def retrieve_threads_endpoint():
-    """Retrieves a list of running threads for Harvey. Threads indicate ongoing deployments."""
+    """Retrieves a list of running threads of the Harvey process handling the request. Threads indicate ongoing
+    deployments, see `/deployments/active` for the deployments of every process.
+    """
     threads = []
     for thread in threading.enumerate():
         threads.append(thread.name)
@@ -278,6 +397,41 @@ def retrieve_threads_endpoint():
     return {'threads': threads}
 
 
+@APP.route('/metrics', methods=['GET'])
+@Api.check_api_key
+def retrieve_metrics_endpoint():
+    """Retrieves the metrics of the Harvey process handling the request in the Prometheus text format."""
+    try:
+        return Response(METRICS.render(), mimetype='text/plain; version=0.0.4')
+    except Exception as error:
+        _log_error(error)
+        return abort(500)
+
+
+@APP.route('/docker', methods=['GET'])
+@Api.check_api_key
+def retrieve_docker_client_endpoint():
+    """Retrieves the metrics of the Docker client of the Harvey process handling the request: clients created,
+    reconnects, requests made to the Docker daemon, and their round-trip times.
+    """
+    try:
+        return DOCKER_CLIENT_POOL.metrics()
+    except Exception as error:
+        _log_error(error)
+        return abort(500)
+
+
+@APP.route('/queue', methods=['GET'])
+@Api.check_api_key
+def retrieve_queue_endpoint():
+    """Retrieves the running and queued deployments along with each one's queue position and wait time."""
+    try:
+        return SCHEDULER.status()
+    except Exception as error:
+        _log_error(error)
+        return abort(500)
+
+
 def _create_response_dict(message: str, success: Optional[bool] = False, status_code: Optional[int] = 500):
     """Response object that all Harvey responses return."""
     return {
@@ -0,0 +1,282 @@
+import hashlib
+import json
+import os
+import re
+import subprocess  # nosec
+import time
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Pattern,
+    Tuple,
+)
+
+import woodchips
+
+from harvey.config import Config
+from harvey.repos.builds import (
+    lookup_cached_image,
+    store_cached_image,
+    store_deployment_build,
+)
+from harvey.tracing import TRACER
+from harvey.utils.utils import (
+    run_subprocess_command,
+    stream_subprocess_command,
+)
+from harvey.webhooks import Webhook
+
+
+class BuildCache:
+    """Skips building the images of services whose build context didn't change since an image was last built
+    from it.
+
+    The content of a service's build context (honoring its `.dockerignore`), its Dockerfile, and its build config
+    are hashed and recorded against the image built from them. If an image recorded for the same hash is still
+    present locally, it's tagged as the service's image instead of building it again which saves sending the
+    entire build context to the builder. Whether each service hit the cache is stored on the deployment.
+    """
+
+    @staticmethod
+    @TRACER.traced('build_cache.build_services')
+    def build_services(
+        compose_command: List[str],
+        services: Optional[List[str]],
+        webhook: Dict[str, Any],
+        output_callback: Callable[[str], None],
+        pid_callback: Optional[Callable[[int], None]] = None,
+    ) -> Optional[str]:
+        """Build the images of services (or all of them if `None`) that aren't in the build cache.
+
+        `compose_command` is the `docker compose` command with the project's compose files, the build's output is
+        passed to `output_callback`. Returns a summary of the cache hits and misses or `None` if the cache can't be
+        used (eg: the compose config can't be resolved), in which case the images should be built as usual. Raises
+        the same exceptions as `stream_subprocess_command` if the build fails.
+        """
+        logger = woodchips.get(Config.logger_name)
+        project_name = Webhook.repo_full_name(webhook)
+
+        try:
+            compose_config = json.loads(run_subprocess_command([*compose_command, 'config', '--format', 'json']))
+        except (subprocess.CalledProcessError, subprocess.TimeoutExpired, OSError, ValueError) as error:
+            logger.warning(f'Could not resolve the compose config of {project_name}, skipping the build cache: {error}')
+            return None
+
+        builds = []
+        services_to_build = []
+        for service_name in services or sorted(compose_config.get('services', {})):
+            service = compose_config['services'][service_name]
+            if not service.get('build'):
+                continue
+
+            image_name = service.get('image') or f'{compose_config["name"]}-{service_name}'
+            context_hash = BuildCache.hash_build_context(service['build'])
+            cached_image = lookup_cached_image(project_name, service_name, context_hash)
+
+            if cached_image and BuildCache._tag_image(cached_image['image_id'], image_name):
+                builds.append(
+                    {
+                        'service': service_name,
+                        'hash': context_hash,
+                        'cache_hit': True,
+                        'image_id': cached_image['image_id'],
+                        'build_seconds': None,
+                        'seconds_saved': cached_image['build_seconds'],
+                    }
+                )
+            else:
+                services_to_build.append((service_name, image_name, context_hash))
+
+        if services_to_build:
+            start_time = time.monotonic()
+            stream_subprocess_command(
+                [*compose_command, 'build', *[service_name for service_name, _, _ in services_to_build]],
+                output_callback,
+                pid_callback=pid_callback,
+            )
+            # Services are built together, each is attributed the time of the whole build
+            build_seconds = round(time.monotonic() - start_time, 3)
+
+            for service_name, image_name, context_hash in services_to_build:
+                image_id = BuildCache._image_id(image_name)
+                if image_id:
+                    store_cached_image(project_name, service_name, context_hash, image_id, build_seconds)
+                builds.append(
+                    {
+                        'service': service_name,
+                        'hash': context_hash,
+                        'cache_hit': False,
+                        'image_id': image_id,
+                        'build_seconds': build_seconds,
+                        'seconds_saved': None,
+                    }
+                )
+
+        summary = []
+        for build in sorted(builds, key=lambda build: build['service']):
+            store_deployment_build(webhook, build)
+            if build['cache_hit']:
+                summary.append(f'{build["service"]}: hit (saved {build["seconds_saved"]}s)')
+            else:
+                summary.append(f'{build["service"]}: miss (built in {build["build_seconds"]}s)')
+
+        return 'Build cache:\n' + '\n'.join(summary) if summary else 'Build cache: no services to build'
+
+    @staticmethod
+    def hash_build_context(build_config: Dict[str, Any]) -> str:
+        """Hash everything an image is built from: the resolved build config of a service, its Dockerfile, and the
+        files of its build context that aren't excluded by the context's `.dockerignore`.
+        """
+        digest = hashlib.sha256()
+        digest.update(json.dumps(build_config, sort_keys=True).encode())
+
+        context_path = build_config['context']
+        # Remote contexts (eg: Git URLs) can only be identified by their URL which is part of the build config
+        if not os.path.isdir(context_path):
+            return digest.hexdigest()
+
+        dockerfile_path = os.path.join(context_path, build_config.get('dockerfile', 'Dockerfile'))
+        if not build_config.get('dockerfile_inline') and os.path.isfile(dockerfile_path):
+            BuildCache._hash_file(digest, dockerfile_path)
+
+        ignore_patterns = BuildCache._load_dockerignore(context_path, dockerfile_path)
+        for relative_path in BuildCache._context_files(context_path, ignore_patterns):
+            digest.update(relative_path.encode() + b'\0')
+            BuildCache._hash_file(digest, os.path.join(context_path, relative_path))
+
+        return digest.hexdigest()
+
+    @staticmethod
+    def _context_files(context_path: str, ignore_patterns: List[Tuple[bool, Pattern]]) -> List[str]:
+        """Return the paths (relative to the context) of the files sent to the builder, sorted."""
+        # Excluded folders can only be skipped if no exception could include some of their files again
+        can_skip_folders = all(not exception for exception, _ in ignore_patterns)
+        files = []
+
+        for folder, subfolders, filenames in os.walk(context_path):
+            relative_folder = os.path.relpath(folder, context_path)
+            if can_skip_folders:
+                subfolders[:] = [
+                    subfolder
+                    for subfolder in subfolders
+                    if not BuildCache._is_ignored(
+                        os.path.normpath(os.path.join(relative_folder, subfolder)), ignore_patterns
+                    )
+                ]
+            # Symlinks to folders aren't followed by the builder either, they are hashed like files
+            filenames += [subfolder for subfolder in subfolders if os.path.islink(os.path.join(folder, subfolder))]
+
+            for filename in filenames:
+                relative_path = os.path.normpath(os.path.join(relative_folder, filename))
+                if not BuildCache._is_ignored(relative_path, ignore_patterns):
+                    files.append(relative_path)
+
+        return sorted(files)
+
+    @staticmethod
+    def _hash_file(digest, path: str):
+        """Add a file's content (or target if it's a symlink) and whether it's executable to a digest."""
+        if os.path.islink(path):
+            digest.update(b'link:' + os.readlink(path).encode())
+            return
+
+        digest.update(b'x' if os.access(path, os.X_OK) else b'-')
+        with open(path, 'rb') as file:
+            for chunk in iter(lambda: file.read(1024 * 1024), b''):
+                digest.update(chunk)
+
+    @staticmethod
+    def _load_dockerignore(context_path: str, dockerfile_path: str) -> List[Tuple[bool, Pattern]]:
+        """Load the ignore patterns of a build context as `(is_exception, regex)` pairs.
+
+        Like BuildKit, a `<Dockerfile>.dockerignore` file next to the Dockerfile takes precedence over the
+        `.dockerignore` file of the context.
+        """
+        ignore_filepath = f'{dockerfile_path}.dockerignore'
+        if not os.path.isfile(ignore_filepath):
+            ignore_filepath = os.path.join(context_path, '.dockerignore')
+        if not os.path.isfile(ignore_filepath):
+            return []
+
+        patterns = []
+        with open(ignore_filepath, 'r') as ignore_file:
+            for line in ignore_file.read().splitlines():
+                pattern = line.strip()
+                if not pattern or pattern.startswith('#'):
+                    continue
+
+                is_exception = pattern.startswith('!')
+                pattern = os.path.normpath(pattern.lstrip('!').strip()).lstrip('/')
+                patterns.append((is_exception, BuildCache._compile_pattern(pattern)))
+
+        return patterns
+
+    @staticmethod
+    def _compile_pattern(pattern: str) -> Pattern:
+        """Compile a `.dockerignore` pattern, `*` and `?` don't match `/` while `**` matches any number of folders."""
+        regex = ''
+        index = 0
+
+        while index < len(pattern):
+            if pattern.startswith('**/', index):
+                regex += '(.*/)?'
+                index += 3
+            elif pattern.startswith('**', index):
+                regex += '.*'
+                index += 2
+            elif pattern[index] == '*':
+                regex += '[^/]*'
+                index += 1
+            elif pattern[index] == '?':
+                regex += '[^/]'
+                index += 1
+            elif pattern[index] == '[' and ']' in pattern[index + 1 :]:
+                end = pattern.index(']', index + 1)
+                character_class = pattern[index + 1 : end].replace('\\', '\\\\')
+                if character_class.startswith('!'):
+                    character_class = f'^{character_class[1:]}'
+                regex += f'[{character_class}]'
+                index = end + 1
+            else:
+                regex += re.escape(pattern[index])
+                index += 1
+
+        return re.compile(regex)
+
+    @staticmethod
+    def _is_ignored(relative_path: str, ignore_patterns: List[Tuple[bool, Pattern]]) -> bool:
+        """Return whether a path (or one of its parent folders) is excluded, the last matching pattern wins."""
+        parts = relative_path.split('/')
+        candidates = ['/'.join(parts[: index + 1]) for index in range(len(parts))]
+
+        ignored = False
+        for is_exception, regex in ignore_patterns:
+            if any(regex.fullmatch(candidate) for candidate in candidates):
+                ignored = not is_exception
+
+        return ignored
+
+    @staticmethod
+    def _image_id(image: str) -> Optional[str]:
+        """Return the ID of a local image, `None` if it isn't present."""
+        try:
+            return run_subprocess_command(['docker', 'image', 'inspect', '--format', '{{.Id}}', image]).strip()
+        except (subprocess.CalledProcessError, subprocess.TimeoutExpired):
+            return None
+
+    @staticmethod
+    def _tag_image(image_id: str, image_name: str) -> bool:
+        """Tag a cached image as a service's image, returns `False` if the image is no longer present."""
+        current_image_id = BuildCache._image_id(image_name)
+        if current_image_id == image_id:
+            return True
+
+        try:
+            run_subprocess_command(['docker', 'tag', image_id, image_name])
+        except (subprocess.CalledProcessError, subprocess.TimeoutExpired):
+            return False
+
+        return True
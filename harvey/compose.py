@@ -0,0 +1,133 @@
+import os
+import re
+from typing import (
+    Any,
+    Dict,
+    List,
+    Optional,
+)
+
+import woodchips
+import yaml
+
+from harvey.config import Config
+
+
+# The compose files of a project, later files override earlier ones
+COMPOSE_FILENAMES = [
+    'docker-compose.yml',
+    'docker-compose.yaml',
+    'docker-compose-prod.yml',
+    'docker-compose-prod.yaml',
+]
+
+
+class Compose:
+    """Maps the files changed by a commit to the compose services they affect.
+
+    A service is affected by changes to its build context, Dockerfile, env files, and the files it bind mounts.
+    Changes to the compose files themselves or to the `.env` file compose interpolates them with affect every
+    service. Services that aren't built (eg: `image: postgres`) are only affected by the latter.
+    """
+
+    @staticmethod
+    def affected_services(compose_filepaths: List[str], changed_paths: Optional[List[str]]) -> Optional[List[str]]:
+        """Return the names of the services affected by the changed paths (relative to the project folder), or
+        `None` if every service has to be deployed (eg: the changes are unknown or the compose files changed).
+        """
+        logger = woodchips.get(Config.logger_name)
+
+        if changed_paths is None:
+            return None
+
+        # Like compose, paths are relative to the folder of the first compose file
+        project_path = os.path.dirname(compose_filepaths[0])
+        global_paths = [os.path.relpath(filepath, project_path) for filepath in compose_filepaths] + ['.env']
+        if any(Compose._path_affected(path, global_paths) for path in changed_paths):
+            return None
+
+        try:
+            services = Compose.load_services(compose_filepaths)
+        except (OSError, yaml.YAMLError) as error:
+            logger.warning(f'Could not read the services of {project_path}, deploying all of them: {error}')
+            return None
+
+        affected_services = []
+        for service_name, service in services.items():
+            service_paths = [
+                os.path.normpath(os.path.relpath(os.path.join(project_path, path), project_path))
+                for path in Compose._service_paths(service)
+            ]
+            if any(Compose._path_affected(path, service_paths) for path in changed_paths):
+                affected_services.append(service_name)
+
+        return affected_services
+
+    @staticmethod
+    def project_name(project_path: str) -> str:
+        """Return the compose project name of a project: the `name` of its compose files or, like compose, the
+        normalized name of its folder.
+        """
+        name = None
+        for filename in COMPOSE_FILENAMES:
+            compose_filepath = os.path.join(project_path, filename)
+            if not os.path.isfile(compose_filepath):
+                continue
+
+            try:
+                with open(compose_filepath, 'r') as compose_file:
+                    compose_config = yaml.safe_load(compose_file) or {}
+            except (OSError, yaml.YAMLError):
+                continue
+            name = compose_config.get('name') or name
+
+        return name or re.sub(r'[^a-z0-9_-]', '', os.path.basename(project_path.rstrip('/')).lower()).lstrip('_-')
+
+    @staticmethod
+    def load_services(compose_filepaths: List[str]) -> Dict[str, Dict[str, Any]]:
+        """Load the services of a project, later compose files override the keys of the services they redefine."""
+        services: Dict[str, Dict[str, Any]] = {}
+
+        for compose_filepath in compose_filepaths:
+            with open(compose_filepath, 'r') as compose_file:
+                compose_config = yaml.safe_load(compose_file) or {}
+
+            for service_name, service in (compose_config.get('services') or {}).items():
+                services[service_name] = {**services.get(service_name, {}), **(service or {})}
+
+        return services
+
+    @staticmethod
+    def _service_paths(service: Dict[str, Any]) -> List[str]:
+        """Return the local paths a service is built from or mounts."""
+        paths = []
+
+        build = service.get('build')
+        if isinstance(build, str):
+            build = {'context': build}
+        if isinstance(build, dict):
+            context = build.get('context', '.')
+            # Remote contexts (eg: Git URLs) aren't part of the project
+            if '://' not in context and not context.startswith('git@'):
+                paths.append(context)
+                paths.append(os.path.join(context, build.get('dockerfile', 'Dockerfile')))
+
+        env_files = service.get('env_file') or []
+        for env_file in [env_files] if isinstance(env_files, (str, dict)) else env_files:
+            paths.append(env_file['path'] if isinstance(env_file, dict) else env_file)
+
+        for volume in service.get('volumes') or []:
+            source = volume.get('source', '') if isinstance(volume, dict) else volume.split(':', 1)[0]
+            # Only bind mounts of relative paths point into the project, other sources are named volumes
+            if source.startswith('.'):
+                paths.append(source)
+
+        return paths
+
+    @staticmethod
+    def _path_affected(changed_path: str, paths: List[str]) -> bool:
+        """Return whether a changed file is one of the paths or is inside one of them."""
+        return any(
+            path in {'', '.'} or changed_path == path or changed_path.startswith(f'{path.rstrip("/")}/')
+            for path in paths
+        )
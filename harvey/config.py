@@ -12,6 +12,12 @@ class Config:
     # User configurable settings
     allowed_branches = [branch.strip().lower() for branch in os.getenv('ALLOWED_BRANCHES', 'main,master').split(',')]
     operation_timeout = int(os.getenv('OPERATION_TIMEOUT', 300))  # Default is 5 minutes
+    max_concurrent_deployments = int(os.getenv('MAX_CONCURRENT_DEPLOYMENTS', 4))
+    # The max number of commits fetched ahead of their deployment at once, set to 0 to disable prefetching
+    max_concurrent_prefetches = int(os.getenv('MAX_CONCURRENT_PREFETCHES', 4))
+    deployment_debounce_seconds = float(os.getenv('DEPLOYMENT_DEBOUNCE_SECONDS', 0))
+    # Run deployments in a separate `harvey-runner` process instead of the process serving the API
+    external_runner = bool(os.getenv('EXTERNAL_RUNNER'))
     pagination_limit = int(os.getenv('PAGINATION_LIMIT', 20))
     deploy_on_tag = os.getenv('DEPLOY_ON_TAG', True)  # Whether a tag pushed will trigger a deploy or not
     use_slack = bool(os.getenv('USE_SLACK'))
@@ -20,6 +26,17 @@ class Config:
     slack_channel = os.getenv('SLACK_CHANNEL', 'general')
     harvey_path = os.path.expanduser(os.getenv('HARVEY_PATH', os.path.join('~', 'harvey')))
     use_https_auth = os.getenv('USE_HTTPS_AUTH')  # Use HTTPS URLs instead of SSH URLs for Git operations
+    # Set to `jsonl` to record spans around the stages of deployments under `traces_path`, disabled by default
+    trace_exporter = os.getenv('TRACE_EXPORTER')
+    # Traces last written to more than this many days ago are removed when a new trace starts
+    trace_retention_days = float(os.getenv('TRACE_RETENTION_DAYS', 7))
+    # How commands and Docker requests are executed: `subprocess` (default), `recording` to also record their timings
+    # to `executor_recording_path`, or `replay` to simulate them from such a recording instead, see `harvey.executors`
+    executor = os.getenv('EXECUTOR') or 'subprocess'
+    executor_recording_path = os.getenv('EXECUTOR_RECORDING') or os.path.join(
+        harvey_path, 'recordings', 'executor.jsonl'
+    )
+    executor_replay_speed = float(os.getenv('EXECUTOR_REPLAY_SPEED') or 1)
 
     # Harvey settings
     host = os.getenv('HOST', '127.0.0.1')
@@ -31,8 +48,12 @@ class Config:
     }
     default_deployment = 'deploy'
     projects_path = os.path.join(harvey_path, 'projects')
+    mirrors_path = os.path.join(harvey_path, 'mirrors')
     database_path = os.path.join(harvey_path, 'databases')
     database_file = os.path.join(database_path, 'database.sqlite')
+    traces_path = os.path.join(harvey_path, 'traces')
+    docker_pool_size = 10  # The max number of keep-alive connections each Harvey process keeps open to Docker
+    database_pool_size = 8  # The max number of concurrent connections each Harvey process opens to the database
     logger_name = 'harvey'
     log_level = os.getenv('LOG_LEVEL', 'INFO').upper()
     sentry_url = os.getenv('SENTRY_URL')
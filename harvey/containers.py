@@ -1,10 +1,16 @@
 import datetime
+import os
+import queue
+import re
+import threading
 import time
 from typing import (
     Any,
     Dict,
     List,
     Optional,
+    Set,
+    Tuple,
 )
 
 import docker  # type: ignore
@@ -12,117 +18,413 @@ import woodchips
 
 from harvey.config import Config
 from harvey.errors import HarveyError
-from harvey.utils.deployments import kill_deployment
+from harvey.executors import EXECUTOR
+from harvey.tracing import TRACER
 from harvey.utils.utils import get_utc_timestamp
 
 
-class Container:
-    @staticmethod
-    def create_client():
-        """Creates a Docker client to use for connections."""
+class DockerClientPool:
+    """A Docker client shared by every deployment thread of the process instead of a client per deployment.
+
+    The client keeps up to `Config.docker_pool_size` keep-alive connections to the Docker daemon open which
+    concurrent deployments reuse. A client that sat idle is pinged before being handed out and replaced if the
+    daemon can't be reached (eg: it restarted). Round-trips to the daemon are measured, see `metrics()`.
+    """
+
+    # How long the client can sit idle before it's pinged before being handed out again
+    ping_interval_seconds = 30.0
+
+    def __init__(self):
+        # Guards the client, the metrics have their own lock since requests record them via the response hook
+        self._lock = threading.Lock()
+        self._metrics_lock = threading.Lock()
+        self._client = None
+        self._pid: Optional[int] = None
+        self._last_used = 0.0
+        self._metrics = {
+            'clients_created': 0,
+            'reconnects': 0,
+            'requests': 0,
+            'round_trip_seconds_total': 0.0,
+            'round_trip_seconds_max': 0.0,
+        }
+
+    def client(self):
+        """Return the shared client, (re)connecting to the Docker daemon if needed."""
+        with self._lock:
+            # Connections can't be shared with a parent process (eg: after uWSGI forks)
+            if self._client is None or self._pid != os.getpid():
+                self._connect()
+                idle = False
+            else:
+                idle = time.monotonic() - self._last_used > self.ping_interval_seconds
+            client = self._client
+            self._last_used = time.monotonic()
+
+        if not idle:
+            return client
+
+        # The daemon is pinged without holding the lock so other threads never wait on its round-trip
+        try:
+            client.ping()
+        except Exception:
+            woodchips.get(Config.logger_name).warning('Lost the connection to Docker, reconnecting...')
+            with self._lock:
+                # Another thread may have replaced the client while it was being pinged
+                if self._client is client:
+                    with self._metrics_lock:
+                        self._metrics['reconnects'] += 1
+                    self._close()
+                    self._connect()
+                client = self._client
+
+        return client
+
+    def metrics(self) -> Dict[str, Any]:
+        """Return the number of clients created, reconnects, requests made, and their round-trip times."""
+        with self._metrics_lock:
+            metrics = dict(self._metrics)
+
+        requests = metrics['requests']
+        metrics['round_trip_seconds_average'] = metrics['round_trip_seconds_total'] / requests if requests else 0.0
+
+        return metrics
+
+    def close(self):
+        """Close the shared client's connections, a new client is created the next time one is needed."""
+        with self._lock:
+            self._close()
+
+    def _connect(self):
         logger = woodchips.get(Config.logger_name)
 
         logger.debug('Setting up Docker client...')
-        client = docker.from_env(timeout=10)
+        try:
+            self._client = EXECUTOR.docker_client(timeout=10, max_pool_size=Config.docker_pool_size)
+        except docker.errors.DockerException as error:
+            error_message = f'Could not communicate with Docker: {error}'
+            logger.critical(error_message)
+            raise HarveyError(error_message)
+
+        self._client.api.hooks['response'].append(self._record_response)
+        self._pid = os.getpid()
+        with self._metrics_lock:
+            self._metrics['clients_created'] += 1
+
+    def _close(self):
+        if self._client is not None:
+            try:
+                self._client.close()
+            except Exception:
+                pass  # The client is discarded either way
+        self._client = None
+
+    def _record_response(self, response, *args, **kwargs):
+        """Record the round-trip time of a request to the Docker daemon (until its response headers arrived)."""
+        round_trip_seconds = response.elapsed.total_seconds()
+
+        with self._metrics_lock:
+            self._metrics['requests'] += 1
+            self._metrics['round_trip_seconds_total'] += round_trip_seconds
+            self._metrics['round_trip_seconds_max'] = max(self._metrics['round_trip_seconds_max'], round_trip_seconds)
+        self._last_used = time.monotonic()
+
+
+DOCKER_CLIENT_POOL = DockerClientPool()
 
-        return client
+
+class Container:
+    # How long to wait before checking containers again if no Docker event arrives, the last delay is repeated
+    healthcheck_backoff_seconds = [0.5, 1.0, 2.0, 4.0]
+    # How many times a container may be found not running before its healthcheck fails
+    healthcheck_max_attempts = 5
+    healthcheck_timeout_seconds = 120.0
+
+    @staticmethod
+    def create_client():
+        """Return the Docker client shared by the process, see `DockerClientPool`."""
+        return DOCKER_CLIENT_POOL.client()
 
     @staticmethod
-    def get_container(client, container_id: str) -> Optional[Any]:
-        """Get the details of a Docker container."""
+    def inspect_containers(
+        client,
+        compose_project: Optional[str] = None,
+        container_names: Optional[List[str]] = None,
+    ) -> Dict[str, Dict[str, Any]]:
+        """Return the status of the containers (running or not) of a compose project or with the given names, keyed
+        by container name.
+
+        All of them are fetched with a single filtered list request to the Docker daemon instead of inspecting each
+        container. The list doesn't include when a container last started or its restart policy, `started_at` and
+        `restart_policy` are `None` until filled in via `inspect_container_details`.
+        """
         logger = woodchips.get(Config.logger_name)
 
-        logger.debug(f'Getting details from {container_id}...')
+        filters: Dict[str, Any] = {}
+        if compose_project:
+            filters['label'] = f'com.docker.compose.project={compose_project}'
+        if container_names:
+            # Docker matches names as regular expressions, anchor them so `api` doesn't match `api-worker`
+            filters['name'] = [f'^/?{re.escape(container_name)}$' for container_name in container_names]
+
+        logger.debug(f'Inspecting containers matching {filters}...')
 
         try:
-            container = client.containers.get(container_id)
-        except docker.errors.NotFound:
-            # If the Docker API errors or the image doesn't exist, fail gracefully by returning `None`
-            container = None
+            containers = client.api.containers(all=True, filters=filters)
         except (docker.errors.APIError, Exception):
             error_message = 'Could not communicate with Docker!'
             logger.critical(error_message)
             raise HarveyError(error_message)
 
-        return container
+        records = {}
+        for container in containers:
+            record = Container._container_record(container)
+            if not container_names or record['name'] in container_names:
+                records[record['name']] = record
+
+        return records
 
     @staticmethod
-    def list_containers(client) -> List[Any]:
-        """Return a list of all Docker containers.
+    def _container_record(container: Dict[str, Any]) -> Dict[str, Any]:
+        """Build the status record of a container from its entry in Docker's container list."""
+        status = container.get('Status') or ''
+        if '(health: starting)' in status:
+            health = 'starting'
+        elif '(unhealthy)' in status:
+            health = 'unhealthy'
+        elif '(healthy)' in status:
+            health = 'healthy'
+        else:
+            health = None
+
+        labels = container.get('Labels') or {}
 
-        To grab details of a single record, use something like `container.attrs['Name']`.
+        return {
+            'id': container.get('Id'),
+            'name': (container.get('Names') or ['/'])[0].lstrip('/'),
+            'image': container.get('Image'),
+            'service': labels.get('com.docker.compose.service'),
+            'state': container.get('State'),
+            'status': status,
+            'health': health,
+            'created_at': datetime.datetime.fromtimestamp(
+                container.get('Created', 0), tz=datetime.timezone.utc
+            ).isoformat(),
+            'started_at': None,
+            'restart_policy': None,
+        }
+
+    @staticmethod
+    def inspect_container_details(client, container: Dict[str, Any]) -> Dict[str, Any]:
+        """Return when a container (status record) last started (`State.StartedAt`) and its restart policy, the
+        fields of its record Docker's container list leaves out, by inspecting the container on its own.
         """
         logger = woodchips.get(Config.logger_name)
 
-        logger.debug('Listing containers...')
+        logger.debug(f'Inspecting {container["name"]}...')
 
         try:
-            containers = client.containers.list(limit=100)
+            attrs = client.api.inspect_container(container['id'])
+        except docker.errors.NotFound:
+            # The container was removed since it was listed, its record is left as-is
+            return {}
         except (docker.errors.APIError, Exception):
             error_message = 'Could not communicate with Docker!'
             logger.critical(error_message)
             raise HarveyError(error_message)
 
-        return containers
+        started_at = Container._parse_docker_timestamp((attrs.get('State') or {}).get('StartedAt'))
+
+        return {
+            'started_at': started_at.isoformat() if started_at else None,
+            'restart_policy': ((attrs.get('HostConfig') or {}).get('RestartPolicy') or {}).get('Name') or 'no',
+        }
+
+    @staticmethod
+    def _parse_docker_timestamp(timestamp: Optional[str]) -> Optional[datetime.datetime]:
+        """Parse a date stored by Docker in RFC 3339 Nano and UTC time, Python only handles microseconds so the
+        ending digits are chopped off. Returns `None` for dates Docker leaves unset (eg: never started).
+        """
+        match = re.match(r'(\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2})(\.\d{1,6})?', timestamp or '')
+        if not match or match.group(1).startswith('0001-'):
+            return None
+
+        return datetime.datetime.strptime(f'{match.group(1)}{match.group(2) or ".0"}', '%Y-%m-%dT%H:%M:%S.%f').replace(
+            tzinfo=datetime.timezone.utc
+        )
 
     @staticmethod
-    def run_container_healthcheck(docker_client, container_name: str, webhook: Dict[str, Any]) -> bool:
-        """Run a healthcheck to ensure the container is running and not in a transitory state.
-        Not to be confused with the "Docker Healthcheck" functionality which is different.
+    def run_container_healthcheck(docker_client, container_name: str) -> bool:
+        """Run the healthcheck of a single container, see `run_container_healthchecks`."""
+        return Container.run_container_healthchecks(docker_client, [container_name])[container_name][0]
+
+    @staticmethod
+    @TRACER.traced('containers.run_container_healthchecks')
+    def run_container_healthchecks(
+        docker_client,
+        container_names: List[str],
+        services: Optional[List[str]] = None,
+    ) -> Dict[str, Tuple[bool, str]]:
+        """Run healthchecks to ensure containers are running and not in a transitory state, returns whether each
+        container is healthy along with the reason. Not to be confused with the "Docker Healthcheck" functionality
+        which is different, though containers that define one must also report being healthy.
+
+        Every container is checked at once: containers are inspected again (with a single request to Docker) as soon
+        as Docker reports one of them started, died, or changed health status, and after increasing delays in case
+        events are missed. The healthchecks take about as long as the slowest container takes to settle. Containers
+        that start or stop running are inspected on their own once to learn when they started and their restart
+        policy, containers that exited and won't be restarted fail right away.
 
-        If we cannot inspect a container, it may not be up and running yet, we'll retry
-        a few times before abandoning the healthcheck.
+        Containers must have restarted with the deployment unless they belong to a compose service that wasn't
+        part of it (only `services` were deployed, `None` means all of them). This is decided the first time a
+        container is seen running, it then has until the timeout to become healthy.
         """
         logger = woodchips.get(Config.logger_name)
 
-        container_healthy = False
-        max_retries = 5
-        retry_delay_seconds = 3
-
-        for attempt in range(1, max_retries + 1):
-            logger.info(f'Running healthcheck attempt #{attempt} for {container_name}...')
-
-            container = Container.get_container(docker_client, container_name)
-
-            if container is None:
-                message = f'Harvey did not get container details from Docker for {container_name} during Healthcheck.'
-                logger.error(message)
-                kill_deployment(message, webhook)
-            elif container.status.lower() == 'running' and Container.container_recently_restarted(container.__dict__):
-                container_healthy = True
-                logger.info(f'{container_name} healthcheck passed!')
-                break
-            elif container.status.lower() != 'running':
-                logger.warning(f'{container_name} healthcheck failed due to current container status, retrying...')
-                time.sleep(retry_delay_seconds)
-            elif container.status.lower() == 'running' and not Container.container_recently_restarted(
-                container.__dict__
-            ):
-                message = f'{container_name} healthcheck failed due to container not restarting on deploy.'
-                logger.error(message)
-                kill_deployment(
-                    message=message,
-                    webhook=webhook,
+        pending = set(container_names)
+        results: Dict[str, Tuple[bool, str]] = {}
+        not_running_attempts = {container_name: 0 for container_name in container_names}
+        restart_verified: Set[str] = set()
+        # Containers are only inspected on their own once per state to learn when they started and their restart policy
+        details: Dict[str, Dict[str, Any]] = {}
+        deadline = time.monotonic() + Container.healthcheck_timeout_seconds
+        backoff = iter(Container.healthcheck_backoff_seconds)
+        events: 'queue.Queue[str]' = queue.Queue()
+        event_stream = Container._watch_container_events(docker_client, container_names, events)
+        containers_to_check = set(pending)
+
+        try:
+            while pending:
+                # Every container that may have changed is fetched at once
+                containers = Container.inspect_containers(
+                    docker_client, container_names=sorted(containers_to_check & pending)
                 )
+                for container_name in sorted(containers_to_check & pending):
+                    container = containers.get(container_name)
+                    if container is not None and (
+                        container['state'] in {'exited', 'dead'}
+                        or (container['state'] == 'running' and container_name not in restart_verified)
+                    ):
+                        details_key = f'{container["id"]}:{container["state"]}'
+                        if details_key not in details:
+                            details[details_key] = Container.inspect_container_details(docker_client, container)
+                        container = {**container, **details[details_key]}
+                    healthy, reason = Container._container_health(
+                        container, services, restart_verified=container_name in restart_verified
+                    )
+                    if container is not None and container['state'] == 'running':
+                        restart_verified.add(container_name)
+                    if healthy is None and reason == 'not running':
+                        not_running_attempts[container_name] += 1
+                        if not_running_attempts[container_name] >= Container.healthcheck_max_attempts:
+                            healthy = False
+
+                    if healthy is None:
+                        logger.info(f'{container_name} is {reason}, waiting for it to settle...')
+                        continue
+                    elif healthy:
+                        logger.info(f'{container_name} healthcheck passed!')
+                    else:
+                        logger.error(f'{container_name} healthcheck failed: {reason}')
+                    results[container_name] = (healthy, reason)
+                    pending.discard(container_name)
+
+                remaining_seconds = deadline - time.monotonic()
+                if not pending or remaining_seconds <= 0:
+                    break
 
-        return container_healthy
+                # Wait for the next relevant event, falling back to checking every pending container after a delay
+                try:
+                    containers_to_check = {
+                        events.get(
+                            timeout=min(next(backoff, Container.healthcheck_backoff_seconds[-1]), remaining_seconds)
+                        )
+                    }
+                    while not events.empty():
+                        containers_to_check.add(events.get_nowait())
+                except queue.Empty:
+                    containers_to_check = set(pending)
+        finally:
+            if event_stream is not None:
+                event_stream.close()
+
+        for container_name in pending:
+            logger.error(f'{container_name} healthcheck timed out')
+            results[container_name] = (False, 'timed out waiting for the container to settle')
+
+        return results
 
     @staticmethod
-    def container_recently_restarted(container_dictionary: Dict[str, Any]):
-        """Determines if the container was recently restarted or not within the last minute by getting the
-        difference of datetimes between now and the container's start time. If it's greater than 60 seconds,
-        we know the container didn't restart with this deploy.
+    def _watch_container_events(docker_client, container_names: List[str], events: 'queue.Queue[str]'):
+        """Stream the events that change the health of containers to a queue in the background, returns the stream
+        so it can be closed or `None` if events can't be streamed (healthchecks then rely on their delays).
+        """
+        logger = woodchips.get(Config.logger_name)
+
+        try:
+            event_stream = docker_client.events(
+                decode=True,
+                filters={
+                    'type': 'container',
+                    'event': ['start', 'die', 'health_status'],
+                    'container': container_names,
+                },
+            )
+        except Exception as error:
+            logger.warning(f'Could not stream Docker events, healthchecks will poll instead: {error}')
+            return None
+
+        def forward_events():
+            try:
+                for event in event_stream:
+                    container_name = event.get('Actor', {}).get('Attributes', {}).get('name')
+                    if container_name in container_names:
+                        events.put(container_name)
+            except Exception as error:
+                # Closing the stream to stop watching also ends up here
+                logger.debug(f'Stopped streaming Docker events: {error}')
+
+        threading.Thread(name='harvey-docker-events', target=forward_events, daemon=True).start()
+
+        return event_stream
 
-        Docker appears to store dates in RFC 3339 Nano and UTC time so we chop off the ending digits and
-        convert to a Python datetime here for comparison.
+    @staticmethod
+    def _container_health(
+        container: Optional[Dict[str, Any]],
+        services: Optional[List[str]],
+        restart_verified: bool = False,
+    ) -> Tuple[Optional[bool], str]:
+        """Determine the health of a container from its status record, `None` if it hasn't settled yet, along with
+        the reason. Whether the container restarted on deploy isn't checked again once `restart_verified`.
+        """
+        if container is None:
+            return False, 'Harvey did not get container details from Docker'
+
+        if container['state'] != 'running':
+            if container['state'] in {'exited', 'dead'} and container.get('restart_policy') == 'no':
+                return False, f'container {container["state"]} and will not be restarted'
+            return None, 'not running'
+
+        restart_required = services is None or container['service'] is None or container['service'] in services
+        if restart_required and not restart_verified and not Container.container_recently_restarted(container):
+            return False, 'container did not restart on deploy'
+
+        if container['health'] == 'starting':
+            return None, 'starting'
+        elif container['health'] == 'unhealthy':
+            return False, 'container is unhealthy'
+
+        return True, 'passed'
+
+    @staticmethod
+    def container_recently_restarted(container: Dict[str, Any]) -> bool:
+        """Determines if a container (status record) was restarted within the last minute by getting the difference
+        between now and the container's start time. If it's greater than 60 seconds, we know the container didn't
+        restart with this deploy. The creation time is used if the start time wasn't inspected.
         """
-        now = get_utc_timestamp()
-        container_start_datetime = datetime.datetime.strptime(
-            container_dictionary['attrs']['State'].get('StartedAt', '')[:-4], '%Y-%m-%dT%H:%M:%S.%f'
-        ).replace(tzinfo=datetime.timezone.utc)
-        container_age_difference = now - container_start_datetime
+        restarted_at = datetime.datetime.fromisoformat(container.get('started_at') or container['created_at'])
+        container_age_difference = get_utc_timestamp() - restarted_at
 
         grace_period_seconds = 60.0
-        container_restarted_recently = container_age_difference.total_seconds() <= grace_period_seconds
 
-        return container_restarted_recently
+        return container_age_difference.total_seconds() <= grace_period_seconds
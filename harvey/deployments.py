@@ -5,61 +5,65 @@ import subprocess  # nosec
 from typing import (
     Any,
     Dict,
+    List,
+    Optional,
     Tuple,
 )
 
 import woodchips
 import yaml
 
+from harvey.build_cache import BuildCache
+from harvey.compose import Compose
 from harvey.config import Config
 from harvey.containers import Container
 from harvey.git import Git
 from harvey.messages import Message
+from harvey.metrics import DEPLOYMENTS
 from harvey.repos.deployments import store_deployment_details
-from harvey.repos.locks import (
-    lookup_project_lock,
-    update_project_lock,
+from harvey.repos.jobs import (
+    update_job_child_pid,
+    update_job_stage,
 )
+from harvey.tracing import TRACER
 from harvey.utils.deployments import (
+    DeploymentTimer,
+    LiveLog,
     kill_deployment,
     succeed_deployment,
 )
 from harvey.utils.utils import (
     get_utc_timestamp,
-    run_subprocess_command,
+    stream_subprocess_command,
 )
 from harvey.webhooks import Webhook
 
 
 class Deployment:
     @staticmethod
-    def initialize_deployment(webhook: Dict[str, Any]) -> Tuple[Dict[str, Any], str, datetime.datetime]:
+    def initialize_deployment(
+        webhook: Dict[str, Any],
+        timer: Optional[DeploymentTimer] = None,
+    ) -> Tuple[Dict[str, Any], str, datetime.datetime]:
         """Initialize the setup for a deployment by cloning or pulling the project
-        and setting up standard logging info.
+        and setting up standard logging info. The git step is timed by `timer` if provided.
         """
         logger = woodchips.get(Config.logger_name)
-
-        try:
-            # Kill the deployment if the project is locked
-            if lookup_project_lock(Webhook.repo_full_name(webhook))['locked'] is True:
-                kill_deployment(
-                    f'{Webhook.repo_full_name(webhook)} deployments are locked.'
-                    ' Please try again later or unlock deployments.',
-                    webhook,
-                )
-        except Exception:
-            logger.error('Could not determine project lock status!')
+        timer = timer or DeploymentTimer()
 
         start_time = get_utc_timestamp()
 
-        _ = update_project_lock(
-            project_name=Webhook.repo_full_name(webhook),
-            locked=True,
-            system_lock=True,
-        )
         store_deployment_details(webhook)
-        # Run git operation first to ensure the config is present and up-to-date
-        git = Git.update_git_repo(webhook)
+        # Run git operation first to ensure the config is present and up-to-date, how the project is fetched is
+        # configured by the currently checked out config since the new commit hasn't been fetched yet
+        update_job_stage(Webhook.repo_full_name(webhook), 'git')
+        git_config = webhook.get('data') or Deployment.load_project_config(webhook) or {}
+        live_log = LiveLog(webhook)
+        with timer.stage('git'):
+            try:
+                Git.update_git_repo(webhook, git_config, output_callback=live_log.write)
+            finally:
+                live_log.flush()
 
         webhook_data_key = webhook.get('data')
         if webhook_data_key:
@@ -95,45 +99,61 @@ class Deployment:
         commit_details = f'Commit author: {Webhook.repo_commit_author(webhook)}'
         if Config.log_level == 'DEBUG':
             commit_details += f'\nCommit Details: {Webhook.repo_commit_message(webhook)}'
-        git_output = f'\n\n{git}' if Config.log_level == 'DEBUG' else ''
         execution_time = f'Startup execution time: {get_utc_timestamp() - start_time}'
 
-        output = f'{preamble}{configuration}\n\n{commit_details}{git_output}\n\n{execution_time}'
+        output = f'{preamble}{configuration}\n\n{commit_details}\n\n{execution_time}'
         logger.debug(f'{Webhook.repo_full_name(webhook)} {execution_time}')
 
         return config, output, start_time
 
     @staticmethod
-    def run_deployment(webhook: Dict[str, Any]):
+    def run_deployment(webhook: Dict[str, Any], queue_wait_seconds: Optional[float] = None):
         """After receiving a webhook, spin up a deployment based on the config.
         If a Deployment fails, it fails early in the individual functions being called.
+
+        The caller must hold the project's system lock (see `Scheduler`), it is released once the deployment
+        succeeds or is killed. How long each stage took (along with how long the deployment waited in the queue,
+        if provided) is stored on the deployment whether it succeeds or not.
         """
+        timer = DeploymentTimer()
+        if queue_wait_seconds is not None:
+            timer.record('queue_wait', queue_wait_seconds)
+        succeeded = False
+
         try:
             logger = woodchips.get(Config.logger_name)
 
-            webhook_config, webhook_output, start_time = Deployment.initialize_deployment(webhook)
+            with timer.stage('startup'):
+                webhook_config, webhook_output, start_time = Deployment.initialize_deployment(webhook, timer=timer)
             deployment_type = webhook_config.get('deployment_type', Config.default_deployment).lower()
 
             if deployment_type == 'deploy':
-                deploy_output = Deployment.deploy(webhook_config, webhook, webhook_output)
+                update_job_stage(Webhook.repo_full_name(webhook), 'deploy')
+                with timer.stage('deploy'):
+                    deploy_output, deployed_services = Deployment.deploy(webhook_config, webhook, webhook_output)
 
+                update_job_stage(Webhook.repo_full_name(webhook), 'healthcheck')
                 healthcheck = webhook_config.get('healthcheck')
                 healthcheck_messages = ''
-                docker_client = Container.create_client()
 
                 if healthcheck:
-                    container_healthcheck_statuses = {}
+                    # Only projects with healthchecks need to talk to the Docker daemon
+                    docker_client = Container.create_client()
+                    with timer.stage('healthcheck'):
+                        container_healthchecks = Container.run_container_healthchecks(
+                            docker_client,
+                            healthcheck,
+                            services=deployed_services,
+                        )
                     for container in healthcheck:
-                        container_healthcheck = Container.run_container_healthcheck(docker_client, container, webhook)
-                        container_healthcheck_statuses[container] = container_healthcheck
-                        if container_healthcheck is True:
+                        container_healthy, reason = container_healthchecks[container]
+                        if container_healthy is True:
                             healthcheck_message = f'\n{container} Healthcheck: {Message.success_emoji}'
                         else:
-                            healthcheck_message = f'\n{container} Healthcheck: {Message.failure_emoji}'
+                            healthcheck_message = f'\n{container} Healthcheck: {Message.failure_emoji} ({reason})'
                         healthcheck_messages += healthcheck_message
 
-                    healthcheck_values = container_healthcheck_statuses.values()
-                    all_healthchecks_passed = any(healthcheck_values) and list(healthcheck_values)[0] is True
+                    all_healthchecks_passed = all(healthy for healthy, _ in container_healthchecks.values())
                 else:
                     all_healthchecks_passed = True  # Set to true here since we cannot determine, won't kill the deploy
 
@@ -143,7 +163,9 @@ class Deployment:
                 final_output = f'{webhook_output}\n{deploy_output}\n{execution_time}\n{healthcheck_messages}\n'
 
                 if all_healthchecks_passed or not healthcheck:
+                    Git.record_deployed_commit(webhook)
                     succeed_deployment(final_output, webhook)
+                    succeeded = True
                 else:
                     kill_deployment(
                         message=final_output,
@@ -159,6 +181,7 @@ class Deployment:
                 logger.info(pull_success_message)
                 final_output = f'{webhook_output}\n{execution_time}\n{pull_success_message}'
                 succeed_deployment(final_output, webhook)
+                succeeded = True
             else:
                 kill_deployment(f'deployment_type invalid, must be one of {Config.supported_deployments}', webhook)
         except Exception as error:
@@ -166,8 +189,12 @@ class Deployment:
             # top before hitting sentry as this function is the top-level function called when a thread has
             # been spawned.
             kill_deployment(str(error), webhook)
+        finally:
+            timer.store(webhook)
+            DEPLOYMENTS.inc(status='success' if succeeded else 'failure')
 
     @staticmethod
+    @TRACER.traced('open_project_config')
     def open_project_config(webhook: Dict[str, Any]):
         """Open the project's config file to assign deployment variables.
 
@@ -181,6 +208,20 @@ class Deployment:
             ]
         }
         """
+        config = Deployment.load_project_config(webhook)
+
+        if config is None:
+            kill_deployment(
+                message='Harvey could not find a ".harvey.yaml" file!',
+                webhook=webhook,
+            )
+
+        return config
+
+    @staticmethod
+    @TRACER.traced('load_project_config')
+    def load_project_config(webhook: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """Load the project's config file as currently checked out, returns `None` if there isn't one."""
         logger = woodchips.get(Config.logger_name)
 
         try:
@@ -199,16 +240,20 @@ class Deployment:
                 logger.debug(json.dumps(config, indent=4))
             return config
         except FileNotFoundError:
-            kill_deployment(
-                message='Harvey could not find a ".harvey.yaml" file!',
-                webhook=webhook,
-            )
+            return None
 
     @staticmethod
-    def deploy(config: Dict[str, Any], webhook: Dict[str, Any], output: str) -> str:
+    def deploy(config: Dict[str, Any], webhook: Dict[str, Any], output: str) -> Tuple[str, Optional[List[str]]]:
         """Build Stage, used for `deploy` deployments.
 
-        This flow doesn't use the Docker API but instead runs `docker compose` commands.
+        This flow doesn't use the Docker API but instead runs `docker compose` commands. Their output is streamed
+        to the deployment's live log as it's produced rather than returned.
+
+        Only the services affected by the changes since the last deployment are built and recreated unless the
+        project sets `rebuild_all_services` or the deployment is a redeploy (see `Scheduler.submit`). Images are only
+        built if they aren't in the build cache unless the project sets `build_cache: false`.
+
+        Returns the output of the stage along with the services that were deployed (`None` if all of them were).
         """
         logger = woodchips.get(Config.logger_name)
 
@@ -256,6 +301,7 @@ class Deployment:
                 '--force-recreate',
             ]
             # fmt: on
+            compose_filepaths = [default_compose_filepath, prod_compose_filepath]
         else:
             # fmt: off
             compose_command = [
@@ -267,23 +313,65 @@ class Deployment:
                 '--force-recreate',
             ]
             # fmt: on
+            compose_filepaths = [default_compose_filepath]
+
+        live_log = LiveLog(webhook)
+
+        services = None
+        if not (config.get('rebuild_all_services') or webhook.get('redeploy')):
+            services = Compose.affected_services(compose_filepaths, Git.changed_paths(webhook))
+
+        if services == []:
+            final_output = 'Harvey skipped `docker compose` since no services were affected by the changes.'
+            live_log.write(f'{final_output}\n')
+            live_log.flush()
+            logger.info(final_output)
+
+            return final_output, services
+        elif services:
+            live_log.write(f'Harvey is only deploying the services affected by the changes: {", ".join(services)}\n')
+            # Leave the services they depend on as-is, they weren't affected
+            compose_command += ['--no-deps', *services]
+
+        def record_child_pid(pid: int):
+            update_job_child_pid(Webhook.repo_full_name(webhook), pid)
 
         try:
-            compose_output = run_subprocess_command(compose_command)
-            execution_time = f'Deploy stage execution time: {get_utc_timestamp() - start_time}'
-            final_output = f'{compose_output}\n{execution_time}'
+            build_cache_output = None
+            if config.get('build_cache', True):
+                build_cache_output = BuildCache.build_services(
+                    compose_command[: compose_command.index('up')],
+                    services,
+                    webhook,
+                    live_log.write,
+                    pid_callback=record_child_pid,
+                )
+            if build_cache_output is not None:
+                # The images were either built or taken from the build cache already
+                compose_command.remove('--build')
+
+            with TRACER.span('compose.up', services=services):
+                stream_subprocess_command(compose_command, live_log.write, pid_callback=record_child_pid)
+            live_log.flush()
+            final_output = f'Deploy stage execution time: {get_utc_timestamp() - start_time}'
             logger.info(final_output)
+            if build_cache_output:
+                final_output = f'{build_cache_output}\n{final_output}'
         except subprocess.TimeoutExpired:
+            live_log.flush()
             final_output = 'Harvey timed out deploying!'
             kill_deployment(
                 message=final_output,
                 webhook=webhook,
             )
         except subprocess.CalledProcessError as error:
-            final_output = f'{output}\nHarvey could not finish the deploy: {error.output}'
+            live_log.flush()
+            final_output = (
+                f'{output}\nHarvey could not finish the deploy, `docker compose` exited with status {error.returncode}.'
+            )
             kill_deployment(
                 message=final_output,
                 webhook=webhook,
             )
 
-        return final_output
+        return final_output, services
@@ -1,2 +1,10 @@
 class HarveyError(Exception):
     pass
+
+
+class GitError(HarveyError):
+    pass
+
+
+class InvalidRequestError(HarveyError):
+    pass
@@ -0,0 +1,460 @@
+import datetime
+import hashlib
+import json
+import os
+import re
+import subprocess  # nosec
+import threading
+import time
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    List,
+    Optional,
+)
+
+import docker  # type: ignore
+import woodchips
+
+from harvey.config import Config
+from harvey.errors import HarveyError
+
+
+# Options of `git` and `docker compose` that come before the subcommand and take a value (eg: `-C <path>`)
+OPTIONS_WITH_VALUES = {'-C', '-c', '-f', '--file', '-p', '--project-name', '--env-file', '--profile'}
+# Options whose value is a path, replaced by a placeholder in command signatures
+PATH_OPTIONS = {'-C', '-f', '--file', '--env-file'}
+# Arguments that vary between runs of the same command (commits, absolute paths, and remote URLs)
+COMMIT_PATTERN = re.compile(r'^[0-9a-f]{7,64}(?=\^\{commit\}$|$)')
+PATH_PATTERN = re.compile(r'^(/|~|[\w.+-]+://|[\w.-]+@[\w.-]+:)')
+# Paths of requests to the Docker daemon addressing an object by its ID or name (eg: `/containers/<id>/json`)
+DOCKER_OBJECT_PATH_PATTERN = re.compile(r'^/(containers|exec|networks|volumes)/(?!json$|create$|prune$)[^/]+')
+# Outputs up to this size are recorded verbatim so they can be replayed (eg: the commit printed by `git rev-parse`)
+MAX_RECORDED_OUTPUT_BYTES = 4096
+
+
+def get_command_name(command: List[str]) -> str:
+    """Return the program a command runs (eg: `git` or `docker compose`) skipping `env` and its variables."""
+    arguments = _strip_env(command)
+
+    if not arguments:
+        return ''
+
+    program = os.path.basename(arguments[0])
+    if program == 'docker' and len(arguments) > 1 and arguments[1] == 'compose':
+        program = 'docker compose'
+
+    return program
+
+
+def get_command_key(command: List[str]) -> str:
+    """Return the program and subcommand a command runs (eg: `git fetch` or `docker compose up`), commands are
+    recorded and replayed by their key.
+    """
+    name = get_command_name(command)
+    arguments = _strip_env(command)[2 if name == 'docker compose' else 1 :]
+
+    while arguments and arguments[0].startswith('-'):
+        arguments = arguments[2:] if arguments[0] in OPTIONS_WITH_VALUES else arguments[1:]
+
+    return f'{name} {arguments[0]}' if arguments else name
+
+
+def get_command_signature(command: List[str]) -> str:
+    """Return a command with the arguments that vary between runs (eg: paths and commits) replaced by placeholders,
+    commands with the same signature (eg: `git -C <path> rev-parse HEAD`) are expected to behave alike.
+    """
+    arguments = _strip_env(command)
+    signature = [os.path.basename(arguments[0])] if arguments else []
+
+    for previous_argument, argument in zip(arguments, arguments[1:]):
+        if previous_argument in PATH_OPTIONS or PATH_PATTERN.match(argument):
+            signature.append('<path>')
+        else:
+            signature.append(COMMIT_PATTERN.sub('<commit>', argument))
+
+    return ' '.join(signature)
+
+
+def get_request_path(path: str) -> str:
+    """Return the path of a request to the Docker daemon without its API version, query, or the ID of the object it
+    addresses (eg: `/containers/<id>/json`), requests with the same path are expected to behave alike.
+    """
+    path = re.sub(r'^/v[0-9.]+', '', path.split('?')[0])
+
+    return DOCKER_OBJECT_PATH_PATTERN.sub(r'/\1/<id>', path)
+
+
+def _strip_env(command: List[str]) -> List[str]:
+    arguments = command[1:] if command and command[0] == 'env' else command
+    while arguments and '=' in arguments[0]:
+        arguments = arguments[1:]
+
+    return arguments
+
+
+class SubprocessExecutor:
+    """Runs the commands of deployments (eg: git and `docker compose`) on the host and connects to the local Docker
+    daemon, this is how Harvey executes everything unless `Config.executor` says otherwise.
+    """
+
+    def run(self, command: List[str]) -> str:
+        """Run a command and return its output, raises if it fails or times out."""
+        return subprocess.check_output(  # nosec
+            command,
+            stderr=subprocess.STDOUT,
+            text=True,
+            encoding='utf8',
+            timeout=Config.operation_timeout,
+        )
+
+    def stream(
+        self,
+        command: List[str],
+        output_callback: Callable[[str], None],
+        pid_callback: Optional[Callable[[int], None]] = None,
+    ):
+        """Run a command, passing its output to `output_callback` line by line as it's produced. Raises like
+        `run()` does, with an empty `output` since it has already been handed to the callback.
+        """
+        timed_out = threading.Event()
+
+        with subprocess.Popen(  # nosec
+            command,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True,
+            encoding='utf8',
+        ) as process:
+
+            def kill_process():
+                timed_out.set()
+                process.kill()
+
+            timer = threading.Timer(Config.operation_timeout, kill_process)
+            timer.start()
+
+            try:
+                if pid_callback:
+                    pid_callback(process.pid)
+                for line in process.stdout:  # type: ignore
+                    output_callback(line)
+            except BaseException:
+                process.kill()
+                raise
+            finally:
+                timer.cancel()
+
+            return_code = process.wait()
+
+        if timed_out.is_set():
+            raise subprocess.TimeoutExpired(command, Config.operation_timeout)
+        elif return_code:
+            raise subprocess.CalledProcessError(return_code, command)
+
+    def docker_client(self, **kwargs: Any):
+        """Return a client connected to the Docker daemon, `kwargs` are passed to `docker.from_env`."""
+        return docker.from_env(**kwargs)
+
+
+class RecordingExecutor(SubprocessExecutor):
+    """Executes everything like `SubprocessExecutor` while recording each command's key (see `get_command_key`),
+    arguments, duration, output size, and outcome as JSON lines to a file. Requests made to the Docker daemon are
+    recorded along with their round-trip time.
+
+    Recordings of production runs can be replayed locally via `ReplayExecutor` to reproduce their timings.
+    """
+
+    def __init__(self, recording_path: str):
+        self.recording_path = recording_path
+        self._lock = threading.Lock()
+
+    def run(self, command: List[str]) -> str:
+        start_time = time.monotonic()
+        output = ''
+        return_code = 0
+        timed_out = False
+
+        try:
+            output = super().run(command)
+            return output
+        except subprocess.CalledProcessError as error:
+            output = error.output or ''
+            return_code = error.returncode
+            raise
+        except subprocess.TimeoutExpired:
+            timed_out = True
+            raise
+        finally:
+            output_bytes = len(output.encode())
+            recorded_output = output if output_bytes <= MAX_RECORDED_OUTPUT_BYTES else None
+            self._record_command(
+                command, time.monotonic() - start_time, output_bytes, recorded_output, return_code, timed_out
+            )
+
+    def stream(
+        self,
+        command: List[str],
+        output_callback: Callable[[str], None],
+        pid_callback: Optional[Callable[[int], None]] = None,
+    ):
+        start_time = time.monotonic()
+        # Only small outputs are kept, larger ones are counted without holding them in memory
+        output_lines: List[str] = []
+        output_bytes = [0]
+        return_code = 0
+        timed_out = False
+
+        def record_output(line: str):
+            output_bytes[0] += len(line.encode())
+            if output_bytes[0] <= MAX_RECORDED_OUTPUT_BYTES:
+                output_lines.append(line)
+            output_callback(line)
+
+        try:
+            super().stream(command, record_output, pid_callback=pid_callback)
+        except subprocess.CalledProcessError as error:
+            return_code = error.returncode
+            raise
+        except subprocess.TimeoutExpired:
+            timed_out = True
+            raise
+        finally:
+            output = ''.join(output_lines) if output_bytes[0] <= MAX_RECORDED_OUTPUT_BYTES else None
+            self._record_command(
+                command, time.monotonic() - start_time, output_bytes[0], output, return_code, timed_out
+            )
+
+    def docker_client(self, **kwargs: Any):
+        client = super().docker_client(**kwargs)
+        client.api.hooks['response'].append(self._record_response)
+
+        return client
+
+    def _record_command(
+        self,
+        command: List[str],
+        seconds: float,
+        output_bytes: int,
+        output: Optional[str],
+        return_code: int,
+        timed_out: bool,
+    ):
+        self._record(
+            {
+                'key': get_command_key(command),
+                'signature': get_command_signature(command),
+                'command': command,
+                'duration_seconds': round(seconds, 6),
+                'output_bytes': output_bytes,
+                'output': output,
+                'return_code': return_code,
+                'timed_out': timed_out,
+            }
+        )
+
+    def _record_response(self, response, *args, **kwargs):
+        """Record a request made to the Docker daemon (until its response headers arrived)."""
+        path = get_request_path(response.request.path_url)
+
+        self._record(
+            {
+                'key': f'docker api {response.request.method} {path}',
+                'command': None,
+                'duration_seconds': round(response.elapsed.total_seconds(), 6),
+                'output_bytes': int(response.headers.get('Content-Length') or 0),
+                'output': None,
+                'return_code': 0 if response.ok else response.status_code,
+                'timed_out': False,
+            }
+        )
+
+    def _record(self, record: Dict[str, Any]):
+        # Recording is best-effort, it must never fail what it records
+        try:
+            with self._lock:
+                os.makedirs(os.path.dirname(os.path.abspath(self.recording_path)), exist_ok=True)
+                with open(self.recording_path, 'a') as recording_file:
+                    recording_file.write(json.dumps({'recorded_at': time.time(), **record}) + '\n')
+        except Exception as error:
+            woodchips.get(Config.logger_name).warning(f'Could not record {record["key"]}: {error}')
+
+
+class ReplayExecutor:
+    """Simulates commands and Docker requests from a recording (see `RecordingExecutor`) without running anything:
+    each one takes as long as it took when recorded (divided by `speed`), produces output of the same size (or the
+    recorded output if it was small), and fails or times out if it did.
+
+    Commands are matched to the records of their signature (see `get_command_signature`), or of their key if their
+    signature wasn't recorded, which are replayed in the order they were recorded, starting over once exhausted, so
+    replays are deterministic. Commands that weren't recorded succeed right away. Replayed commands don't touch the
+    filesystem, the project folders must already be checked out. Docker's containers are all simulated as running
+    and recreated by the deployment.
+    """
+
+    def __init__(self, recording_path: str, speed: float = 1.0):
+        self.speed = speed
+        self._lock = threading.Lock()
+        self._records: Dict[str, List[Dict[str, Any]]] = {}
+        self._positions: Dict[str, int] = {}
+
+        try:
+            with open(recording_path, 'r') as recording_file:
+                for line in recording_file:
+                    if line.strip():
+                        record = json.loads(line)
+                        self._records.setdefault(record['key'], []).append(record)
+                        if record.get('signature') and record['signature'] != record['key']:
+                            self._records.setdefault(record['signature'], []).append(record)
+        except (OSError, ValueError) as error:
+            raise HarveyError(f'Harvey could not load the executor recording {recording_path}: {error}')
+
+    def run(self, command: List[str]) -> str:
+        record = self._replay(get_command_signature(command), get_command_key(command))
+        output = self._output(record)
+
+        if record and record['timed_out']:
+            raise subprocess.TimeoutExpired(command, Config.operation_timeout, output=output)
+        elif record and record['return_code']:
+            raise subprocess.CalledProcessError(record['return_code'], command, output=output)
+
+        return output
+
+    def stream(
+        self,
+        command: List[str],
+        output_callback: Callable[[str], None],
+        pid_callback: Optional[Callable[[int], None]] = None,
+    ):
+        # Nothing is spawned so there is no PID to report, the output is handed over once the command "finished"
+        record = self._replay(get_command_signature(command), get_command_key(command))
+        for line in self._output(record).splitlines(keepends=True):
+            output_callback(line)
+
+        if record and record['timed_out']:
+            raise subprocess.TimeoutExpired(command, Config.operation_timeout)
+        elif record and record['return_code']:
+            raise subprocess.CalledProcessError(record['return_code'], command)
+
+    def docker_client(self, **kwargs: Any):
+        return SimulatedDockerClient(self)
+
+    def replay_request(self, method: str, path: str):
+        """Take as long as a recorded request to the Docker daemon took."""
+        self._replay(f'docker api {method} {get_request_path(path)}')
+
+    def _replay(self, *keys: str) -> Optional[Dict[str, Any]]:
+        """Wait for as long as the next record of the first recorded key (eg: a command's signature, then its key)
+        took and return it, `None` if none of the keys were recorded.
+        """
+        with self._lock:
+            key = next((key for key in keys if self._records.get(key)), None)
+            if key is None:
+                woodchips.get(Config.logger_name).debug(f'No recording of {keys[-1]}, it succeeds right away')
+                return None
+
+            records = self._records[key]
+            position = self._positions.get(key, 0)
+            self._positions[key] = position + 1
+
+        record = records[position % len(records)]
+        time.sleep(record['duration_seconds'] / self.speed)
+
+        return record
+
+    @staticmethod
+    def _output(record: Optional[Dict[str, Any]]) -> str:
+        if record is None:
+            return ''
+        elif record['output'] is not None:
+            return record['output']
+
+        # Large outputs (eg: builds) are reproduced by size only, as lines of a typical length
+        line = '.' * 79 + '\n'
+        return (line * (record['output_bytes'] // len(line) + 1))[: record['output_bytes']]
+
+
+class SimulatedDockerClient:
+    """The subset of `docker.DockerClient` Harvey uses, backed by a `ReplayExecutor`. Every container asked for is
+    running and was just created, events are never emitted so healthchecks fall back to polling.
+    """
+
+    def __init__(self, executor: ReplayExecutor):
+        self.api = _SimulatedDockerApi(executor)
+        self._executor = executor
+
+    def ping(self) -> bool:
+        self._executor.replay_request('GET', '/_ping')
+
+        return True
+
+    def events(self, **kwargs: Any) -> '_SimulatedEventStream':
+        return _SimulatedEventStream()
+
+    def close(self):
+        pass
+
+
+class _SimulatedDockerApi:
+    def __init__(self, executor: ReplayExecutor):
+        self.hooks: Dict[str, List[Callable]] = {'response': []}
+        self._executor = executor
+
+    def containers(self, all: bool = False, filters: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
+        self._executor.replay_request('GET', '/containers/json')
+
+        containers = []
+        for name_pattern in (filters or {}).get('name', []):
+            # Names are filtered by anchored and escaped regular expressions, see `Container.inspect_containers`
+            name = re.sub(r'\\(.)', r'\1', re.sub(r'^\^/\?|\$$', '', name_pattern))
+            containers.append(
+                {
+                    'Id': hashlib.sha256(name.encode()).hexdigest(),
+                    'Names': [f'/{name}'],
+                    'Image': name,
+                    'Labels': {},
+                    'State': 'running',
+                    'Status': 'Up Less than a second',
+                    'Created': int(time.time()),
+                }
+            )
+
+        return containers
+
+    def inspect_container(self, container_id: str) -> Dict[str, Any]:
+        self._executor.replay_request('GET', f'/containers/{container_id}/json')
+
+        return {
+            'Id': container_id,
+            'State': {'Status': 'running', 'StartedAt': datetime.datetime.now(datetime.timezone.utc).isoformat()},
+            'HostConfig': {'RestartPolicy': {'Name': 'no'}},
+        }
+
+
+class _SimulatedEventStream:
+    def __init__(self):
+        self._closed = threading.Event()
+
+    def __iter__(self):
+        # Like a real stream, iterating blocks until the stream is closed
+        self._closed.wait()
+        return iter([])
+
+    def close(self):
+        self._closed.set()
+
+
+def create_executor():
+    """Create the executor selected by `Config.executor`."""
+    if Config.executor == 'subprocess':
+        return SubprocessExecutor()
+    elif Config.executor == 'recording':
+        return RecordingExecutor(Config.executor_recording_path)
+    elif Config.executor == 'replay':
+        return ReplayExecutor(Config.executor_recording_path, Config.executor_replay_speed)
+
+    raise HarveyError(f'EXECUTOR must be one of `subprocess`, `recording`, or `replay`, got `{Config.executor}`.')
+
+
+EXECUTOR = create_executor()
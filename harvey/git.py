@@ -1,89 +1,422 @@
+import fcntl
 import os
 import subprocess  # nosec
+from contextlib import contextmanager
 from typing import (
     Any,
+    Callable,
     Dict,
+    Iterator,
+    List,
+    Optional,
 )
 
 import woodchips
 
 from harvey.config import Config
+from harvey.errors import GitError
+from harvey.tracing import TRACER
 from harvey.utils.deployments import kill_deployment
-from harvey.utils.utils import run_subprocess_command
+from harvey.utils.utils import (
+    run_subprocess_command,
+    stream_subprocess_command,
+)
 from harvey.webhooks import Webhook
 
 
+# The ref of a project's mirror pointing to the commit that was last deployed successfully
+DEPLOYED_REF = 'refs/harvey/deployed'
+
+
 class Git:
+    """Git operations are served from a cache of bare mirrors, one per project, under `Config.mirrors_path`.
+
+    A mirror is cloned once and then kept up-to-date via incremental fetches. The project folder compose runs from
+    is a worktree of the mirror with the webhook's commit checked out (detached), so updating it is a local
+    operation that shares the mirror's objects instead of cloning or pulling from the remote again.
+
+    Projects can instead set `git_fetch: commit` to only fetch the pushed commit (without its history), optionally
+    without blobs outside the checkout (`git_filter: blob:none`) and checking out a subset of the project
+    (`git_sparse_checkout: [paths]`) which keeps transfers small for large repos.
+
+    Commits are usually fetched ahead of time (see `Prefetcher`), in which case the git step of a deployment only
+    has to check out the commit.
+    """
+
     @staticmethod
-    def update_git_repo(webhook: Dict[str, Any]) -> str:
-        """Clone or pull repo using Git depending on if it exists or not."""
+    @TRACER.traced('git.update_git_repo')
+    def update_git_repo(
+        webhook: Dict[str, Any],
+        config: Optional[Dict[str, Any]] = None,
+        output_callback: Optional[Callable[[str], None]] = None,
+    ) -> str:
+        """Update the project's mirror and check out the webhook's commit in the project folder, the mirror isn't
+        fetched again if it already has the commit.
+
+        `config` is the project's Harvey config that determines how the commit is fetched and checked out. The
+        output of git is passed to `output_callback` line by line as it's produced if provided.
+        """
+        config = config or {}
         project_path = os.path.join(Config.projects_path, Webhook.repo_full_name(webhook))
+        mirror_path = os.path.join(Config.mirrors_path, f'{Webhook.repo_full_name(webhook)}.git')
+        output = ''
 
-        if os.path.exists(project_path):
-            output = Git.pull_repo(project_path, webhook)
-        else:
-            output = Git.clone_repo(project_path, webhook)
+        try:
+            with Git.lock_mirror(mirror_path):
+                if not Git.has_commit(mirror_path, Webhook.repo_head_commit_id(webhook)):
+                    output += Git.fetch(mirror_path, project_path, webhook, config, output_callback)
+                output += Git.checkout_commit(
+                    project_path, mirror_path, webhook, config.get('git_sparse_checkout'), output_callback
+                )
+        except GitError as error:
+            kill_deployment(message=str(error), webhook=webhook)
 
         return output
 
     @staticmethod
-    def clone_repo(project_path: str, webhook: Dict[str, Any]) -> str:
-        """Clone a repo into the Harvey projects folder."""
+    def prefetch(webhook: Dict[str, Any], config: Optional[Dict[str, Any]] = None) -> bool:
+        """Fetch the webhook's commit into the project's mirror without touching the project folder (which may be
+        in use by a running deployment). Returns `False` if the mirror already had the commit.
+
+        Raises a `GitError` if the commit could not be fetched.
+        """
+        config = config or {}
+        project_path = os.path.join(Config.projects_path, Webhook.repo_full_name(webhook))
+        mirror_path = os.path.join(Config.mirrors_path, f'{Webhook.repo_full_name(webhook)}.git')
+
+        with Git.lock_mirror(mirror_path):
+            if Git.has_commit(mirror_path, Webhook.repo_head_commit_id(webhook)):
+                return False
+
+            Git.fetch(mirror_path, project_path, webhook, config)
+
+        return True
+
+    @staticmethod
+    def fetch(
+        mirror_path: str,
+        project_path: str,
+        webhook: Dict[str, Any],
+        config: Dict[str, Any],
+        output_callback: Optional[Callable[[str], None]] = None,
+    ) -> str:
+        """Fetch the webhook's commit into the project's mirror as configured by the project."""
+        if config.get('git_fetch') == 'commit':
+            return Git.fetch_commit(mirror_path, project_path, webhook, config.get('git_filter'), output_callback)
+
+        return Git.update_mirror(mirror_path, webhook, output_callback)
+
+    @staticmethod
+    def has_commit(mirror_path: str, commit_id: str) -> bool:
+        """Return whether the mirror already has a commit."""
+        if not os.path.exists(mirror_path):
+            return False
+
+        try:
+            # Partial clones would otherwise fetch a missing commit (and its history) from the remote to check for it
+            run_subprocess_command(
+                ['env', 'GIT_NO_LAZY_FETCH=1', 'git', '-C', mirror_path, 'cat-file', '-e', f'{commit_id}^{{commit}}']
+            )
+            return True
+        except (subprocess.CalledProcessError, subprocess.TimeoutExpired):
+            return False
+
+    @staticmethod
+    @contextmanager
+    def lock_mirror(mirror_path: str) -> Iterator[None]:
+        """Hold an exclusive lock on a mirror so concurrent fetches and checkouts of it (from any Harvey process)
+        don't trip over each other.
+        """
+        os.makedirs(os.path.dirname(mirror_path), exist_ok=True)
+
+        with open(f'{mirror_path}.lock', 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    @staticmethod
+    def update_mirror(
+        mirror_path: str,
+        webhook: Dict[str, Any],
+        output_callback: Optional[Callable[[str], None]] = None,
+    ) -> str:
+        """Clone the bare mirror of a project if it doesn't exist yet, otherwise fetch what changed since."""
+        if os.path.exists(mirror_path):
+            commands = [
+                ['git', '-C', mirror_path, 'remote', 'set-url', 'origin', Webhook.repo_url(webhook)],
+                ['git', '-C', mirror_path, 'fetch', '--prune', '--tags', 'origin'],
+            ]
+        else:
+            commands = [
+                ['git', 'clone', '--bare', Webhook.repo_url(webhook), mirror_path],
+                # Bare clones don't fetch anything by default, track the branches of the remote as-is
+                ['git', '-C', mirror_path, 'config', 'remote.origin.fetch', '+refs/heads/*:refs/heads/*'],
+            ]
+
+        return Git._run_git_commands(commands, 'update the mirror of', webhook, output_callback)
+
+    @staticmethod
+    def fetch_commit(
+        mirror_path: str,
+        project_path: str,
+        webhook: Dict[str, Any],
+        fetch_filter: Optional[str] = None,
+        output_callback: Optional[Callable[[str], None]] = None,
+    ) -> str:
+        """Fetch only the webhook's commit into the project's mirror, without its history.
+
+        Falls back to the tip of the pushed ref if the commit can't be fetched by its ID. A `fetch_filter` (eg:
+        `blob:none`) turns the mirror into a partial clone that fetches the blobs it's missing on checkout, this
+        isn't possible for project folders cloned by older versions of Harvey so the filter is ignored for them.
+        """
         logger = woodchips.get(Config.logger_name)
-        command_output = ''
+
+        if os.path.exists(mirror_path):
+            commands = [['git', '-C', mirror_path, 'remote', 'set-url', 'origin', Webhook.repo_url(webhook)]]
+        else:
+            commands = [
+                ['git', 'init', '--bare', '--quiet', mirror_path],
+                ['git', '-C', mirror_path, 'remote', 'add', 'origin', Webhook.repo_url(webhook)],
+            ]
+        output = Git._run_git_commands(commands, 'set up the mirror of', webhook, output_callback)
+
+        if fetch_filter and os.path.isdir(os.path.join(project_path, '.git')):
+            logger.warning(
+                f'Ignoring `git_filter` for {Webhook.repo_full_name(webhook)}, remove its project folder so Harvey'
+                ' can check it out from the mirror to use it.'
+            )
+            fetch_filter = None
+
+        fetch_command = ['git', '-C', mirror_path, 'fetch', '--depth=1']
+        if fetch_filter:
+            fetch_command.append(f'--filter={fetch_filter}')
 
         try:
-            command_output = run_subprocess_command(
-                ['git', 'clone', '--depth=1', Webhook.repo_url(webhook), project_path]
+            output += Git._run_git_command(
+                [*fetch_command, 'origin', Webhook.repo_head_commit_id(webhook)], output_callback
             )
-            logger.debug(command_output)
-        except subprocess.TimeoutExpired:
-            kill_deployment(
-                message='Harvey timed out during git clone operation.',
-                webhook=webhook,
+        except subprocess.CalledProcessError:
+            logger.info(
+                f'Harvey could not fetch the head commit of {Webhook.repo_full_name(webhook)}, fetching its ref'
             )
-        except subprocess.CalledProcessError as error:
-            final_output = f'Harvey could not clone due to error: {error.output} {Webhook.repo_full_name(webhook)}.'
-            kill_deployment(
-                message=final_output,
-                webhook=webhook,
+            ref = webhook.get('ref', 'HEAD')
+            output += Git._run_git_commands(
+                [[*fetch_command, 'origin', f'+{ref}:{ref}']], 'fetch', webhook, output_callback
             )
+        except subprocess.TimeoutExpired:
+            raise GitError(f'Harvey timed out trying to fetch {Webhook.repo_full_name(webhook)}.')
 
-        return command_output
+        return output
 
     @staticmethod
-    def pull_repo(project_path: str, webhook: Dict[str, Any], pull_attempt: int = 1) -> str:
-        """Pull updates for a repo in the Harvey projects folder."""
+    def checkout_commit(
+        project_path: str,
+        mirror_path: str,
+        webhook: Dict[str, Any],
+        sparse_checkout_paths: Optional[List[str]] = None,
+        output_callback: Optional[Callable[[str], None]] = None,
+    ) -> str:
+        """Check out the webhook's commit (detached) in the project folder from the project's mirror, limited to
+        `sparse_checkout_paths` if provided.
+
+        Untracked files such as `.env` files are left in place while local changes to tracked files are discarded.
+        Project folders cloned by older versions of Harvey are kept, they borrow the mirror's objects to check out the
+        commit and then copy the objects they need so they never depend on the mirror (whose objects can be pruned).
+        """
+        commit = Git.resolve_commit(mirror_path, webhook)
+        legacy_clone = os.path.isdir(os.path.join(project_path, '.git'))
+
+        if not os.path.exists(project_path):
+            commands = [
+                # Forget worktrees whose folder was removed so the project folder can be registered again
+                ['git', '-C', mirror_path, 'worktree', 'prune'],
+                [
+                    'git',
+                    '-C',
+                    mirror_path,
+                    'worktree',
+                    'add',
+                    '--detach',
+                    '--force',
+                    '--no-checkout',
+                    project_path,
+                    commit,
+                ],
+            ]
+        else:
+            if legacy_clone:
+                Git._borrow_mirror_objects(project_path, mirror_path)
+            commands = []
+
+        # Sparse checkout patterns are set before checking out so blobs outside of them are never fetched
+        if sparse_checkout_paths:
+            commands.append(['git', '-C', project_path, 'sparse-checkout', 'set', '--no-cone', *sparse_checkout_paths])
+        elif commands == []:
+            commands.append(['git', '-C', project_path, 'sparse-checkout', 'disable'])
+        commands.append(['git', '-C', project_path, 'checkout', '--detach', '--force', commit])
+        if legacy_clone:
+            # Packs the borrowed objects into the clone along with its own
+            commands.append(['git', '-C', project_path, 'repack', '-a', '-d', '--quiet'])
+
+        output = Git._run_git_commands(commands, 'check out', webhook, output_callback)
+
+        if legacy_clone:
+            Git._return_mirror_objects(project_path, mirror_path)
+
+        return output
+
+    @staticmethod
+    def resolve_commit(mirror_path: str, webhook: Dict[str, Any]) -> str:
+        """Return the commit to deploy: the head commit of the push if the mirror has it, otherwise the tip of the
+        pushed ref (eg: webhooks sent via CI may not carry the head commit).
+        """
+        logger = woodchips.get(Config.logger_name)
+
+        for revision in [Webhook.repo_head_commit_id(webhook), webhook.get('ref', 'HEAD')]:
+            try:
+                return run_subprocess_command(
+                    ['git', '-C', mirror_path, 'rev-parse', '--verify', '--quiet', f'{revision}^{{commit}}']
+                ).strip()
+            except (subprocess.CalledProcessError, subprocess.TimeoutExpired):
+                logger.debug(f'{revision} could not be found in the mirror of {Webhook.repo_full_name(webhook)}')
+
+        raise GitError(f'Harvey could not find the commit to deploy for {Webhook.repo_full_name(webhook)}.')
+
+    @staticmethod
+    def changed_paths(webhook: Dict[str, Any]) -> Optional[List[str]]:
+        """Return the paths changed between the last deployed commit of a project and the commit checked out in its
+        project folder, or `None` if they can't be determined (eg: the project was never deployed via the mirror)
+        or the last deployed commit is being deployed again.
+        """
         logger = woodchips.get(Config.logger_name)
-        command_output = ''
+        project_path = os.path.join(Config.projects_path, Webhook.repo_full_name(webhook))
+        mirror_path = os.path.join(Config.mirrors_path, f'{Webhook.repo_full_name(webhook)}.git')
 
         try:
-            command_output = run_subprocess_command(['git', '-C', project_path, 'pull', '--rebase'])
-            logger.debug(f'{command_output}')
-        except subprocess.TimeoutExpired:
-            kill_deployment(
-                message='Harvey timed out during git pull operation.',
-                webhook=webhook,
+            deployed_commit = run_subprocess_command(
+                ['git', '-C', mirror_path, 'rev-parse', '--verify', '--quiet', f'{DEPLOYED_REF}^{{commit}}']
+            ).strip()
+            # Deploying the same commit again (eg: to recover a broken container) is meant to deploy everything
+            if deployed_commit == run_subprocess_command(['git', '-C', project_path, 'rev-parse', 'HEAD']).strip():
+                logger.debug(f'{project_path} is deploying its last deployed commit again')
+                return None
+            # Without rename detection only trees are compared so partial clones don't need to fetch any blobs
+            output = run_subprocess_command(
+                [
+                    'env',
+                    'GIT_NO_LAZY_FETCH=1',
+                    'git',
+                    '-C',
+                    project_path,
+                    'diff',
+                    '--name-only',
+                    '--no-renames',
+                    deployed_commit,
+                    'HEAD',
+                ]
             )
-        except subprocess.CalledProcessError:
-            # The biggest offender of this operation failing is local, uncommitted changes.
-            # Try stashing and retry again before failing.
-            logger.error(f'Harvey could not pull {Webhook.repo_full_name(webhook)}.')
-            logger.info(f'Attempting to stash {Webhook.repo_full_name(webhook)} before pulling again...')
+        except (subprocess.CalledProcessError, subprocess.TimeoutExpired):
+            logger.debug(f'Could not determine the paths changed since the last deployment of {project_path}')
+            return None
+
+        return output.splitlines()
+
+    @staticmethod
+    def record_deployed_commit(webhook: Dict[str, Any]):
+        """Remember the commit checked out in the project folder as the project's last deployed commit, which also
+        keeps it from being pruned from the mirror.
+        """
+        logger = woodchips.get(Config.logger_name)
+        project_path = os.path.join(Config.projects_path, Webhook.repo_full_name(webhook))
+        mirror_path = os.path.join(Config.mirrors_path, f'{Webhook.repo_full_name(webhook)}.git')
+
+        try:
+            commit = run_subprocess_command(['git', '-C', project_path, 'rev-parse', 'HEAD']).strip()
+            with Git.lock_mirror(mirror_path):
+                run_subprocess_command(['git', '-C', mirror_path, 'update-ref', DEPLOYED_REF, commit])
+        except (subprocess.CalledProcessError, subprocess.TimeoutExpired) as error:
+            logger.warning(f'Could not record the deployed commit of {project_path}: {error}')
 
+    @staticmethod
+    def _borrow_mirror_objects(project_path: str, mirror_path: str):
+        """Let a regular clone read objects from the mirror via Git's alternates so commits fetched into the mirror
+        can be checked out without fetching them into the clone as well.
+        """
+        alternates_path = os.path.join(project_path, '.git', 'objects', 'info', 'alternates')
+        mirror_objects_path = os.path.join(os.path.abspath(mirror_path), 'objects')
+
+        alternates = []
+        if os.path.exists(alternates_path):
+            with open(alternates_path, 'r') as alternates_file:
+                alternates = alternates_file.read().splitlines()
+
+        if mirror_objects_path not in alternates:
+            os.makedirs(os.path.dirname(alternates_path), exist_ok=True)
+            with open(alternates_path, 'a') as alternates_file:
+                alternates_file.write(f'{mirror_objects_path}\n')
+
+    @staticmethod
+    def _return_mirror_objects(project_path: str, mirror_path: str):
+        """Stop a regular clone from reading objects from the mirror, it must have copied the objects it needs."""
+        alternates_path = os.path.join(project_path, '.git', 'objects', 'info', 'alternates')
+        mirror_objects_path = os.path.join(os.path.abspath(mirror_path), 'objects')
+
+        with open(alternates_path, 'r') as alternates_file:
+            alternates = [
+                alternate for alternate in alternates_file.read().splitlines() if alternate != mirror_objects_path
+            ]
+
+        if alternates:
+            with open(alternates_path, 'w') as alternates_file:
+                alternates_file.write(''.join(f'{alternate}\n' for alternate in alternates))
+        else:
+            os.remove(alternates_path)
+
+    @staticmethod
+    def _run_git_command(command: List[str], output_callback: Optional[Callable[[str], None]] = None) -> str:
+        """Run a git command and return its output, which is also passed to `output_callback` line by line as it's
+        produced if provided. Raises like `run_subprocess_command` does, including the output on failure.
+        """
+        if output_callback is None:
+            return run_subprocess_command(command)
+
+        output_lines: List[str] = []
+
+        def record_output(line: str):
+            output_lines.append(line)
+            output_callback(line)  # type: ignore
+
+        try:
+            stream_subprocess_command(command, record_output)
+        except subprocess.CalledProcessError as error:
+            error.output = ''.join(output_lines)
+            raise
+
+        return ''.join(output_lines)
+
+    @staticmethod
+    def _run_git_commands(
+        commands: List[List[str]],
+        operation: str,
+        webhook: Dict[str, Any],
+        output_callback: Optional[Callable[[str], None]] = None,
+    ) -> str:
+        """Run git commands one after another, raising a `GitError` if any of them fails."""
+        logger = woodchips.get(Config.logger_name)
+        output = ''
+
+        for command in commands:
             try:
-                command_output = run_subprocess_command(['git', '-C', project_path, 'stash'])
-                logger.debug(f'{command_output}')
-            except (subprocess.CalledProcessError, subprocess.TimeoutExpired):
-                kill_deployment(
-                    message='Harvey could not stash local changes!',
-                    webhook=webhook,
+                command_output = Git._run_git_command(command, output_callback)
+                logger.debug(command_output)
+                output += command_output
+            except subprocess.TimeoutExpired:
+                raise GitError(f'Harvey timed out trying to {operation} {Webhook.repo_full_name(webhook)}.')
+            except subprocess.CalledProcessError as error:
+                raise GitError(
+                    f'Harvey could not {operation} {Webhook.repo_full_name(webhook)} due to error: {error.output}'
                 )
 
-            # Recursively call this function again so we can try pulling after a stash when we fail the first time.
-            # Must use an int here vs bool so we don't have an infinite loop.
-            if pull_attempt == 1:
-                pull_attempt += 1
-                command_output = Git.pull_repo(project_path, webhook, pull_attempt)
-
-        return command_output
+        return output
@@ -1,8 +1,143 @@
+import os
+import queue
+import threading
+import time
+from typing import (
+    List,
+    Optional,
+)
+
 import slack_sdk
 import woodchips
 from sentry_sdk import capture_message
 
 from harvey.config import Config
+from harvey.tracing import TRACER
+
+
+class SlackSender:
+    """Sends Slack messages from a background thread so deployments never wait on Slack being fast or reachable.
+
+    Every message is sent with the same client. Messages that queued up while the sender was busy (eg: waiting on
+    Slack's rate limits during a burst of deployments) are coalesced into digests instead of being sent one by one.
+    Requests that are rate limited or fail to reach Slack are retried with a backoff.
+    """
+
+    # How long to wait before retrying a request Slack didn't say when to retry, the last delay is repeated
+    retry_backoff_seconds = [1.0, 2.0, 4.0, 8.0]
+    max_attempts = 5
+    # Slack truncates messages longer than 40,000 characters, digests are split well before that
+    max_digest_length = 4000
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._queue: 'queue.Queue[Optional[str]]' = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._pid: Optional[int] = None
+        self._client: Optional[slack_sdk.WebClient] = None
+
+    def submit(self, message: str):
+        """Queue a message to be sent in the background."""
+        with self._lock:
+            # Started lazily so the thread belongs to the process that sends messages (eg: after uWSGI forks)
+            if self._thread is None or self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._thread = threading.Thread(name='harvey-slack', target=self._run, daemon=True)
+                self._thread.start()
+
+        self._queue.put(message)
+
+    def stop(self, timeout: Optional[float] = None):
+        """Send the queued messages and stop the sender."""
+        with self._lock:
+            thread, self._thread = self._thread, None
+
+        if thread and thread.is_alive():
+            self._queue.put(None)
+            thread.join(timeout=timeout)
+
+    def _run(self):
+        """Send queued messages until `stop()` is called."""
+        stopping = False
+        while not stopping:
+            messages = [self._queue.get()]
+            # Everything that queued up while the last message was being sent goes out together
+            while True:
+                try:
+                    messages.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            if None in messages:
+                stopping = True
+                messages = [message for message in messages if message is not None]
+
+            for digest in self._digests(messages):
+                self._send(digest)
+
+    def _digests(self, messages: List[str]) -> List[str]:
+        """Coalesce messages into as few messages as Slack can display."""
+        if len(messages) <= 1:
+            return messages
+
+        digests: List[str] = []
+        chunk: List[str] = []
+        for message in messages:
+            if chunk and len('\n\n'.join(chunk + [message])) > self.max_digest_length:
+                digests.append(self._digest(chunk))
+                chunk = []
+            chunk.append(message)
+        digests.append(self._digest(chunk))
+
+        return digests
+
+    @staticmethod
+    def _digest(messages: List[str]) -> str:
+        if len(messages) == 1:
+            return messages[0]
+
+        return f'Harvey digest of {len(messages)} messages:\n\n' + '\n\n'.join(messages)
+
+    @TRACER.traced('slack.send')
+    def _send(self, message: str):
+        """Send a message, retrying if Slack rate limits the request or can't be reached."""
+        logger = woodchips.get(Config.logger_name)
+
+        if self._client is None:
+            self._client = slack_sdk.WebClient(Config.slack_bot_token)
+
+        for attempt in range(1, self.max_attempts + 1):
+            backoff_seconds = self.retry_backoff_seconds[min(attempt, len(self.retry_backoff_seconds)) - 1]
+            try:
+                self._client.chat_postMessage(
+                    channel=Config.slack_channel,
+                    text=message,
+                )
+                logger.debug('Slack message sent!')
+                return
+            except slack_sdk.errors.SlackApiError as error:
+                if error.response.get('error') != 'ratelimited' or attempt == self.max_attempts:
+                    error_message = f'Harvey could not send the Slack message: {str(error)}'
+                    logger.error(error_message)
+                    capture_message(error_message)
+                    return
+
+                retry_after = (getattr(error.response, 'headers', None) or {}).get('Retry-After')
+                backoff_seconds = float(retry_after) if retry_after else backoff_seconds
+                logger.warning(f'Slack rate limited Harvey, retrying in {backoff_seconds} seconds...')
+            except Exception as error:
+                if attempt == self.max_attempts:
+                    error_message = f'Harvey could not reach Slack: {str(error)}'
+                    logger.error(error_message)
+                    capture_message(error_message)
+                    return
+
+                logger.warning(f'Harvey could not reach Slack, retrying in {backoff_seconds} seconds: {error}')
+
+            time.sleep(backoff_seconds)
+
+
+SLACK_SENDER = SlackSender()
 
 
 class Message:
@@ -12,18 +147,5 @@ class Message:
 
     @staticmethod
     def send_slack_message(message: str):
-        """Send a Slack message via a Slackbot."""
-        logger = woodchips.get(Config.logger_name)
-
-        slack_client = slack_sdk.WebClient(Config.slack_bot_token)
-
-        try:
-            slack_client.chat_postMessage(
-                channel=Config.slack_channel,
-                text=message,
-            )
-            logger.debug('Slack message sent!')
-        except slack_sdk.errors.SlackApiError as error:
-            error_message = f'Harvey could not send the Slack message: {str(error)}'
-            logger.error(error_message)
-            capture_message(error_message)
+        """Send a Slack message via a Slackbot in the background, see `SlackSender`."""
+        SLACK_SENDER.submit(message)
@@ -0,0 +1,249 @@
+import bisect
+import math
+import threading
+import time
+from abc import (
+    ABC,
+    abstractmethod,
+)
+from contextlib import contextmanager
+from typing import (
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+)
+
+
+# Deployments and the commands they run take anywhere from seconds to the operation timeout
+DURATION_BUCKETS = [0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0, 1200.0, 3600.0]
+# Database operations take anywhere from microseconds to however long a write waits behind other writes
+DATABASE_BUCKETS = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0]
+
+LabelValues = Tuple[str, ...]
+
+
+class Metric(ABC):
+    """A metric of the Harvey process, optionally split by labels, that can be rendered in the Prometheus text
+    format. Metrics only hold in-process counters, updating one is a dictionary update under a lock.
+    """
+
+    metric_type = 'untyped'
+
+    def __init__(self, name: str, documentation: str, label_names: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        self._lock = threading.Lock()
+
+    def render(self) -> List[str]:
+        """Return the lines of the metric in the Prometheus text format."""
+        lines = [
+            f'# HELP {self.name} {self.documentation}',
+            f'# TYPE {self.name} {self.metric_type}',
+        ]
+        for suffix, labels, value in self.samples():
+            lines.append(f'{self.name}{suffix}{_format_labels(labels)} {_format_value(value)}')
+
+        return lines
+
+    @abstractmethod
+    def samples(self) -> List[Tuple[str, Dict[str, str], float]]:
+        """Return the `(name suffix, labels, value)` of each sample of the metric."""
+
+    def _label_values(self, labels: Dict[str, str]) -> LabelValues:
+        if set(labels) != set(self.label_names):
+            raise ValueError(f'{self.name} expects the labels {self.label_names}, got {tuple(labels)}')
+
+        return tuple(str(labels[label_name]) for label_name in self.label_names)
+
+
+class Counter(Metric):
+    """A value that only goes up (eg: the number of deployments that failed)."""
+
+    metric_type = 'counter'
+
+    def __init__(self, name: str, documentation: str, label_names: Tuple[str, ...] = ()):
+        super().__init__(name, documentation, label_names)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1.0, **labels: str):
+        label_values = self._label_values(labels)
+
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0.0) + amount
+
+    def samples(self) -> List[Tuple[str, Dict[str, str], float]]:
+        with self._lock:
+            values = sorted(self._values.items())
+
+        return [('', dict(zip(self.label_names, label_values)), value) for label_values, value in values]
+
+
+class Gauge(Metric):
+    """A value read when the metrics are rendered (eg: the number of queued deployments)."""
+
+    metric_type = 'gauge'
+
+    def __init__(self, name: str, documentation: str):
+        super().__init__(name, documentation)
+        self._function: Optional[Callable[[], float]] = None
+
+    def set_function(self, function: Callable[[], float]):
+        """Set the function that returns the gauge's value."""
+        self._function = function
+
+    def samples(self) -> List[Tuple[str, Dict[str, str], float]]:
+        return [('', {}, self._function())] if self._function else []
+
+
+class Histogram(Metric):
+    """Observations counted in cumulative buckets (eg: how long deployments take)."""
+
+    metric_type = 'histogram'
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        label_names: Tuple[str, ...] = (),
+        buckets: List[float] = DURATION_BUCKETS,
+    ):
+        super().__init__(name, documentation, label_names)
+        self.buckets = sorted(buckets)
+        # The bucket counts (the last one being `+Inf`) and the sum of the observations of each set of labels
+        self._values: Dict[LabelValues, Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, **labels: str):
+        label_values = self._label_values(labels)
+        bucket_index = bisect.bisect_left(self.buckets, value)
+
+        with self._lock:
+            counts, total = self._values.setdefault(label_values, ([0] * (len(self.buckets) + 1), [0.0]))
+            counts[bucket_index] += 1
+            total[0] += value
+
+    @contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        """Observe how long a block of code took in seconds, even if it fails."""
+        start_time = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - start_time, **labels)
+
+    def samples(self) -> List[Tuple[str, Dict[str, str], float]]:
+        with self._lock:
+            values = sorted(
+                (label_values, (list(counts), total[0])) for label_values, (counts, total) in self._values.items()
+            )
+
+        samples: List[Tuple[str, Dict[str, str], float]] = []
+        for label_values, (counts, total) in values:
+            labels = dict(zip(self.label_names, label_values))
+            cumulative_count = 0
+            for upper_bound, count in zip([*self.buckets, math.inf], counts):
+                cumulative_count += count
+                samples.append(('_bucket', {**labels, 'le': _format_value(upper_bound)}, cumulative_count))
+            samples.append(('_sum', labels, total))
+            samples.append(('_count', labels, cumulative_count))
+
+        return samples
+
+
+class MetricsRegistry:
+    """The metrics of the Harvey process, rendered by the `/metrics` endpoint."""
+
+    def __init__(self):
+        self._metrics: List[Metric] = []
+
+    def counter(self, name: str, documentation: str, label_names: Tuple[str, ...] = ()) -> Counter:
+        return self._register(Counter(name, documentation, label_names))
+
+    def gauge(self, name: str, documentation: str) -> Gauge:
+        return self._register(Gauge(name, documentation))
+
+    def histogram(
+        self,
+        name: str,
+        documentation: str,
+        label_names: Tuple[str, ...] = (),
+        buckets: List[float] = DURATION_BUCKETS,
+    ) -> Histogram:
+        return self._register(Histogram(name, documentation, label_names, buckets))
+
+    def render(self) -> str:
+        """Render every metric in the Prometheus text format."""
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+
+        return '\n'.join(lines) + '\n'
+
+    def _register(self, metric):
+        self._metrics.append(metric)
+
+        return metric
+
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ''
+
+    formatted_labels = ','.join(f'{name}="{_escape_label_value(value)}"' for name, value in labels.items())
+
+    return f'{{{formatted_labels}}}'
+
+
+def _escape_label_value(value: str) -> str:
+    """Escape backslashes, double quotes, and line feeds in a label value."""
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_value(value: float) -> str:
+    return '+Inf' if value == math.inf else repr(float(value))
+
+
+METRICS = MetricsRegistry()
+
+DEPLOYMENT_STAGE_SECONDS = METRICS.histogram(
+    'harvey_deployment_stage_duration_seconds',
+    'How long each stage of a deployment took.',
+    ('stage',),
+)
+DEPLOYMENT_SECONDS = METRICS.histogram(
+    'harvey_deployment_duration_seconds',
+    'How long the deployments of each project took.',
+    ('project',),
+)
+DEPLOYMENTS = METRICS.counter(
+    'harvey_deployments_total',
+    'Deployments run by the process by their outcome.',
+    ('status',),
+)
+QUEUE_DEPTH = METRICS.gauge(
+    'harvey_queue_depth',
+    'Deployments waiting in the queue shared by every Harvey process.',
+)
+IN_FLIGHT_DEPLOYMENTS = METRICS.gauge(
+    'harvey_deployments_in_flight',
+    'Deployments running across every Harvey process.',
+)
+WEBHOOKS = METRICS.counter(
+    'harvey_webhooks_total',
+    'Webhooks received by the process by whether they were accepted and the reason they were rejected.',
+    ('status_code', 'reason'),
+)
+DATABASE_SECONDS = METRICS.histogram(
+    'harvey_database_operation_duration_seconds',
+    'How long SQLite reads and write transactions took, including waiting for a connection or the write lock.',
+    ('operation',),
+    buckets=DATABASE_BUCKETS,
+)
+SUBPROCESS_SECONDS = METRICS.histogram(
+    'harvey_subprocess_duration_seconds',
+    'Wall time of the commands run by Harvey (eg: git and docker compose).',
+    ('command',),
+)
@@ -0,0 +1,77 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import (
+    Any,
+    Dict,
+    Optional,
+)
+
+import woodchips
+
+from harvey.config import Config
+from harvey.deployments import Deployment
+from harvey.git import Git
+from harvey.webhooks import Webhook
+
+
+class Prefetcher:
+    """Fetches the commits of accepted webhooks into their project's mirror in the background so that a
+    deployment's git step only has to check out the commit once the deployment starts (eg: after waiting in the
+    queue behind a running deployment of the project).
+
+    Prefetches run on their own pool of `Config.max_concurrent_prefetches` threads so network I/O isn't bound by
+    the number of deployments that can run at once. Like queued deployments, a pending prefetch of a project is
+    superseded by a newer commit of it. Prefetching is best-effort: a failed prefetch is retried by the deployment.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._pending: Dict[str, Dict[str, Any]] = {}
+
+    def submit(self, webhook: Dict[str, Any]):
+        """Prefetch the commit of a webhook unless prefetching is disabled."""
+        if Config.max_concurrent_prefetches < 1:
+            return
+
+        project = Webhook.repo_full_name(webhook)
+
+        with self._lock:
+            already_pending = project in self._pending
+            self._pending[project] = webhook
+            if already_pending:
+                return
+
+            # Started lazily so the threads belong to the process that serves requests (eg: after uWSGI forks)
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=Config.max_concurrent_prefetches,
+                    thread_name_prefix='harvey-prefetch',
+                )
+            self._executor.submit(self._prefetch, project)
+
+    def stop(self):
+        """Wait for running prefetches to finish."""
+        with self._lock:
+            executor, self._executor = self._executor, None
+
+        if executor:
+            executor.shutdown(wait=True)
+
+    def _prefetch(self, project: str):
+        """Fetch the newest pending commit of a project."""
+        logger = woodchips.get(Config.logger_name)
+
+        with self._lock:
+            webhook = self._pending.pop(project)
+
+        try:
+            # Read before the new commit is checked out, just like the config of the deployment's git step
+            project_config = webhook.get('data') or Deployment.load_project_config(webhook) or {}
+            if Git.prefetch(webhook, project_config):
+                logger.info(f'Prefetched {Webhook.repo_head_commit_id(webhook)} of {project}')
+        except Exception as error:
+            logger.warning(f'Could not prefetch {project}, the deployment will fetch it instead: {error}')
+
+
+PREFETCHER = Prefetcher()
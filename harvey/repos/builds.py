@@ -0,0 +1,68 @@
+from typing import (
+    Any,
+    Dict,
+    Optional,
+)
+
+from harvey.repos.database import (
+    connect,
+    transaction,
+)
+from harvey.utils.utils import (
+    format_project_name,
+    get_utc_timestamp,
+)
+from harvey.webhooks import Webhook
+
+
+def lookup_cached_image(project_name: str, service: str, context_hash: str) -> Optional[Dict[str, Any]]:
+    """Lookup the image previously built for a service from a build context with the same content hash."""
+    with connect() as connection:
+        cached_image = connection.execute(
+            'SELECT image_id, build_seconds FROM build_cache WHERE project = ? AND service = ? AND hash = ?',
+            (format_project_name(project_name), service, context_hash),
+        ).fetchone()
+
+    return dict(cached_image) if cached_image else None
+
+
+def store_cached_image(project_name: str, service: str, context_hash: str, image_id: str, build_seconds: float):
+    """Record the image built for a service from a build context with a given content hash."""
+    with transaction() as connection:
+        connection.execute(
+            'INSERT OR REPLACE INTO build_cache (project, service, hash, image_id, build_seconds, timestamp)'
+            ' VALUES (?, ?, ?, ?, ?, ?)',
+            (
+                format_project_name(project_name),
+                service,
+                context_hash,
+                image_id,
+                build_seconds,
+                str(get_utc_timestamp()),
+            ),
+        )
+
+
+def store_deployment_build(webhook: Dict[str, Any], build: Dict[str, Any]):
+    """Record how a service's image was obtained (built or from the build cache) on the deployment's current
+    attempt.
+    """
+    deployment_id = Webhook.deployment_id(webhook)
+
+    with transaction() as connection:
+        connection.execute(
+            'INSERT OR REPLACE INTO deployment_builds'
+            ' (deployment_id, attempt, service, hash, cache_hit, image_id, build_seconds, seconds_saved)'
+            ' SELECT ?, MAX(attempt), ?, ?, ?, ?, ?, ? FROM deployment_attempts WHERE deployment_id = ?'
+            ' HAVING MAX(attempt) IS NOT NULL',
+            (
+                deployment_id,
+                build['service'],
+                build['hash'],
+                build['cache_hit'],
+                build['image_id'],
+                build['build_seconds'],
+                build['seconds_saved'],
+                deployment_id,
+            ),
+        )
@@ -0,0 +1,418 @@
+import json
+import os
+import pickle  # nosec
+import queue
+import sqlite3
+import threading
+import zlib
+from contextlib import contextmanager
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Tuple,
+    Union,
+)
+
+import woodchips
+
+from harvey.config import Config
+from harvey.metrics import DATABASE_SECONDS
+
+
+# Each statement must be idempotent as the schema is applied whenever a database file is first used by a process.
+# Statements are run one at a time inside a single transaction (`executescript` would commit it early).
+#
+# Logs can be megabytes of build output, they are stored zlib compressed in `deployment_logs` so that reading the
+# metadata of deployments never has to load them. While a deployment is running, the output of its commands is
+# appended to `deployment_log_chunks` as it's produced so it can be followed live, chunks are folded into the
+# compressed log once the deployment finishes.
+#
+# `jobs` is the durable deployment queue shared by every Harvey process, see `Scheduler`. Queue order is the `seq`
+# a job was first queued with, times are Unix timestamps so leases can be compared without parsing. Running jobs
+# double as the registry of in-flight deployments: deployments record the stage they reached and the child process
+# they're waiting on so every process can report on them.
+#
+# `deployment_timings` holds how long each stage of an attempt took (eg: `git`, `deploy`, `total`) in milliseconds.
+#
+# `deployment_counts` is maintained by triggers so the API can report totals without counting every attempt. Attempts
+# must therefore be updated via upserts, `INSERT OR REPLACE` would count an existing attempt a second time.
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS deployments (
+    id TEXT PRIMARY KEY,
+    slug TEXT NOT NULL,
+    project TEXT NOT NULL,
+    commit_id TEXT NOT NULL,
+    status TEXT NOT NULL,
+    timestamp TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS deployments_slug_idx ON deployments (slug);
+CREATE INDEX IF NOT EXISTS deployments_project_idx ON deployments (project, timestamp, id);
+CREATE INDEX IF NOT EXISTS deployments_commit_idx ON deployments (commit_id);
+CREATE INDEX IF NOT EXISTS deployments_status_idx ON deployments (status);
+CREATE INDEX IF NOT EXISTS deployments_timestamp_idx ON deployments (timestamp, id);
+
+CREATE TABLE IF NOT EXISTS deployment_attempts (
+    deployment_id TEXT NOT NULL REFERENCES deployments (id) ON DELETE CASCADE,
+    attempt INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    timestamp TEXT NOT NULL,
+    runtime TEXT,
+    PRIMARY KEY (deployment_id, attempt)
+);
+
+CREATE TABLE IF NOT EXISTS deployment_logs (
+    deployment_id TEXT NOT NULL,
+    attempt INTEGER NOT NULL,
+    log BLOB NOT NULL,
+    PRIMARY KEY (deployment_id, attempt),
+    FOREIGN KEY (deployment_id, attempt) REFERENCES deployment_attempts (deployment_id, attempt) ON DELETE CASCADE
+);
+
+CREATE TABLE IF NOT EXISTS deployment_log_chunks (
+    id INTEGER PRIMARY KEY,
+    deployment_id TEXT NOT NULL,
+    attempt INTEGER NOT NULL,
+    output TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS deployment_log_chunks_attempt_idx ON deployment_log_chunks (deployment_id, attempt, id);
+
+CREATE TABLE IF NOT EXISTS deployment_counts (
+    project TEXT PRIMARY KEY,
+    attempts INTEGER NOT NULL DEFAULT 0
+);
+CREATE TRIGGER IF NOT EXISTS deployment_attempts_count_insert AFTER INSERT ON deployment_attempts BEGIN
+    INSERT INTO deployment_counts (project, attempts)
+    VALUES ((SELECT project FROM deployments WHERE id = NEW.deployment_id), 1)
+    ON CONFLICT (project) DO UPDATE SET attempts = attempts + 1;
+END;
+CREATE TRIGGER IF NOT EXISTS deployment_attempts_count_delete AFTER DELETE ON deployment_attempts BEGIN
+    UPDATE deployment_counts SET attempts = attempts - 1
+    WHERE project = (SELECT project FROM deployments WHERE id = OLD.deployment_id);
+END;
+
+CREATE TABLE IF NOT EXISTS locks (
+    project TEXT PRIMARY KEY,
+    locked INTEGER NOT NULL,
+    system_lock INTEGER
+);
+
+CREATE TABLE IF NOT EXISTS webhooks (
+    project TEXT PRIMARY KEY,
+    webhook TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS jobs (
+    seq INTEGER PRIMARY KEY,
+    id TEXT NOT NULL UNIQUE,
+    project TEXT NOT NULL,
+    webhook TEXT NOT NULL,
+    status TEXT NOT NULL,
+    enqueued_at REAL NOT NULL,
+    scheduled_for REAL NOT NULL,
+    started_at REAL,
+    waiting_for_lock INTEGER NOT NULL DEFAULT 0,
+    runner TEXT,
+    pid INTEGER,
+    heartbeat_at REAL,
+    lease_expires_at REAL,
+    stage TEXT,
+    stage_started_at REAL,
+    child_pid INTEGER
+);
+CREATE INDEX IF NOT EXISTS jobs_status_idx ON jobs (status, scheduled_for);
+CREATE INDEX IF NOT EXISTS jobs_project_idx ON jobs (project, status);
+
+CREATE TABLE IF NOT EXISTS build_cache (
+    project TEXT NOT NULL,
+    service TEXT NOT NULL,
+    hash TEXT NOT NULL,
+    image_id TEXT NOT NULL,
+    build_seconds REAL NOT NULL,
+    timestamp TEXT NOT NULL,
+    PRIMARY KEY (project, service, hash)
+);
+
+CREATE TABLE IF NOT EXISTS deployment_builds (
+    deployment_id TEXT NOT NULL,
+    attempt INTEGER NOT NULL,
+    service TEXT NOT NULL,
+    hash TEXT NOT NULL,
+    cache_hit INTEGER NOT NULL,
+    image_id TEXT,
+    build_seconds REAL,
+    seconds_saved REAL,
+    PRIMARY KEY (deployment_id, attempt, service),
+    FOREIGN KEY (deployment_id, attempt) REFERENCES deployment_attempts (deployment_id, attempt) ON DELETE CASCADE
+);
+
+CREATE TABLE IF NOT EXISTS deployment_timings (
+    deployment_id TEXT NOT NULL,
+    attempt INTEGER NOT NULL,
+    stage TEXT NOT NULL,
+    milliseconds REAL NOT NULL,
+    PRIMARY KEY (deployment_id, attempt, stage),
+    FOREIGN KEY (deployment_id, attempt) REFERENCES deployment_attempts (deployment_id, attempt) ON DELETE CASCADE
+);
+"""
+
+PRAGMAS = [
+    # Readers never block behind a writer (and vice versa) in write-ahead logging mode
+    'PRAGMA journal_mode = WAL',
+    # Safe from corruption in WAL mode, only the most recent commits can be lost on power failure
+    'PRAGMA synchronous = NORMAL',
+    'PRAGMA cache_size = -16000',  # 16mb per connection
+    'PRAGMA temp_store = MEMORY',
+    'PRAGMA foreign_keys = ON',
+]
+
+_pools: Dict[Tuple[int, str], 'ConnectionPool'] = {}
+_pools_lock = threading.Lock()
+
+
+class ConnectionPool:
+    """A thread-safe pool of long-lived connections to a single database file.
+
+    Connections are handed out to one thread at a time and returned to the pool afterwards instead of
+    being closed. Writes are serialized within the process by a lock so that concurrent deployments queue
+    up in Python rather than spinning on SQLite's busy handler, `BEGIN IMMEDIATE` serializes them across processes.
+    """
+
+    def __init__(self, database_file: str, size: int):
+        self.database_file = database_file
+        self.write_lock = threading.Lock()
+        self._idle_connections: 'queue.LifoQueue[sqlite3.Connection]' = queue.LifoQueue()
+        self._all_connections: List[sqlite3.Connection] = []
+        self._available = threading.BoundedSemaphore(size)
+
+        with self.connection() as connection:
+            _ensure_schema(connection)
+
+    @contextmanager
+    def connection(self) -> Iterator[sqlite3.Connection]:
+        """Borrow a connection from the pool, opening a new one if none are idle."""
+        self._available.acquire()
+        try:
+            try:
+                connection = self._idle_connections.get_nowait()
+            except queue.Empty:
+                connection = self._open_connection()
+
+            try:
+                yield connection
+            finally:
+                if connection.in_transaction:
+                    connection.execute('ROLLBACK')
+                self._idle_connections.put(connection)
+        finally:
+            self._available.release()
+
+    def close(self):
+        """Close every connection opened by the pool."""
+        for connection in self._all_connections:
+            connection.close()
+
+        self._all_connections.clear()
+
+    def _open_connection(self) -> sqlite3.Connection:
+        """Open a connection in autocommit mode that can be shared across threads (one at a time)."""
+        connection = sqlite3.connect(
+            self.database_file,
+            timeout=Config.operation_timeout,
+            isolation_level=None,
+            check_same_thread=False,
+        )
+        connection.row_factory = sqlite3.Row
+
+        for pragma in PRAGMAS:
+            connection.execute(pragma)
+
+        self._all_connections.append(connection)
+
+        return connection
+
+
+def get_pool() -> ConnectionPool:
+    """Return the connection pool of `Config.database_file` for the current process.
+
+    Pools are keyed by process ID as SQLite connections must not be carried across a fork (eg: uWSGI workers).
+    """
+    key = (os.getpid(), Config.database_file)
+
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = _pools[key] = ConnectionPool(Config.database_file, Config.database_pool_size)
+
+    return pool
+
+
+def close_pools():
+    """Close every connection pool opened by the current process."""
+    with _pools_lock:
+        for key in [key for key in _pools if key[0] == os.getpid()]:
+            _pools.pop(key).close()
+
+
+@contextmanager
+def connect() -> Iterator[sqlite3.Connection]:
+    """Borrow a connection to the Harvey database from the pool.
+
+    Connections run in autocommit mode, use `transaction()` when writing so that multiple statements
+    are applied atomically.
+    """
+    with DATABASE_SECONDS.time(operation='read'), get_pool().connection() as connection:
+        yield connection
+
+
+@contextmanager
+def transaction() -> Iterator[sqlite3.Connection]:
+    """Borrow a connection to the Harvey database and wrap every statement run against it in a single
+    write transaction that is committed on success and rolled back on error.
+    """
+    pool = get_pool()
+
+    with DATABASE_SECONDS.time(operation='write'), pool.write_lock, pool.connection() as connection:
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            yield connection
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        else:
+            connection.execute('COMMIT')
+
+
+def compress_log(log: Union[str, Iterable[str]]) -> bytes:
+    """Compress a deployment log for storage, build output compresses extremely well.
+
+    The log can be passed as an iterable of strings so large logs can be compressed without joining them first.
+    """
+    compressor = zlib.compressobj(level=6)
+    parts = [log] if isinstance(log, str) else log
+    compressed_log = b''.join(compressor.compress(part.encode()) for part in parts)
+
+    return compressed_log + compressor.flush()
+
+
+def decompress_log(compressed_log: bytes) -> str:
+    """Decompress a deployment log stored via `compress_log`."""
+    return zlib.decompress(compressed_log).decode()
+
+
+def _ensure_schema(connection: sqlite3.Connection):
+    """Create the tables Harvey needs and migrate data stored by older versions of Harvey."""
+    connection.execute('BEGIN IMMEDIATE')
+    try:
+        # Legacy `sqlitedict` tables and the functions importing their records into the new schema
+        legacy_importers = {
+            'deployments': _import_legacy_deployment,
+            'locks': _import_legacy_lock,
+            'webhooks': _import_legacy_webhook,
+        }
+        legacy_tables = {
+            _rename_legacy_table(connection, table_name): importer for table_name, importer in legacy_importers.items()
+        }
+
+        for statement in _split_statements(SCHEMA):
+            connection.execute(statement)
+
+        for legacy_table_name, importer in legacy_tables.items():
+            if legacy_table_name:
+                _migrate_legacy_table(connection, legacy_table_name, importer)
+    except BaseException:
+        connection.execute('ROLLBACK')
+        raise
+    else:
+        connection.execute('COMMIT')
+
+
+def _split_statements(script: str) -> List[str]:
+    """Split a SQL script into its individual statements, keeping trigger bodies intact."""
+    statements = []
+    statement = ''
+
+    for line in script.strip().splitlines(keepends=True):
+        statement += line
+        if sqlite3.complete_statement(statement):
+            statements.append(statement)
+            statement = ''
+
+    return statements
+
+
+def _rename_legacy_table(connection: sqlite3.Connection, table_name: str) -> str:
+    """Older versions of Harvey stored each table as a pickled key/value store via `sqlitedict`. If the
+    table still has that layout, move it out of the way so the new schema can be created in its place.
+
+    Returns the name of the renamed table or an empty string if there was nothing to migrate.
+    """
+    columns = {row['name'] for row in connection.execute(f'PRAGMA table_info("{table_name}")')}
+
+    if columns != {'key', 'value'}:
+        return ''
+
+    legacy_table_name = f'{table_name}_sqlitedict'
+    connection.execute(f'ALTER TABLE "{table_name}" RENAME TO "{legacy_table_name}"')
+
+    return legacy_table_name
+
+
+def _migrate_legacy_table(
+    connection: sqlite3.Connection,
+    legacy_table_name: str,
+    importer: Callable[[sqlite3.Connection, str, Dict[str, Any]], None],
+):
+    """Import every record of a legacy `sqlitedict` table and drop the legacy table afterwards."""
+    logger = woodchips.get(Config.logger_name)
+    logger.info(f'Migrating the legacy "{legacy_table_name}" table...')
+
+    for row in connection.execute(f'SELECT key, value FROM "{legacy_table_name}"').fetchall():
+        # These records were written by Harvey itself via `sqlitedict`, which pickles its values
+        importer(connection, row['key'], pickle.loads(bytes(row['value'])))  # nosec
+
+    connection.execute(f'DROP TABLE "{legacy_table_name}"')
+
+
+def _import_legacy_deployment(connection: sqlite3.Connection, key: str, value: Dict[str, Any]):
+    """Import a legacy deployment record keyed by `project@commit_id`."""
+    attempts = sorted(value.get('attempts', []), key=lambda attempt: attempt['attempt'])
+    slug = key.replace('@', '-', 1)
+    status = attempts[-1]['status'] if attempts else 'Failure'
+
+    connection.execute(
+        'INSERT OR REPLACE INTO deployments (id, slug, project, commit_id, status, timestamp)'
+        ' VALUES (?, ?, ?, ?, ?, ?)',
+        (key, slug, value['project'], value['commit'], status, value['timestamp']),
+    )
+    connection.executemany(
+        'INSERT OR IGNORE INTO deployment_attempts (deployment_id, attempt, status, timestamp, runtime)'
+        ' VALUES (?, ?, ?, ?, ?)',
+        [
+            (key, attempt['attempt'], attempt['status'], attempt['timestamp'], attempt.get('runtime'))
+            for attempt in attempts
+        ],
+    )
+    connection.executemany(
+        'INSERT OR IGNORE INTO deployment_logs (deployment_id, attempt, log) VALUES (?, ?, ?)',
+        [(key, attempt['attempt'], compress_log(attempt['log'])) for attempt in attempts],
+    )
+
+
+def _import_legacy_lock(connection: sqlite3.Connection, key: str, value: Dict[str, Any]):
+    """Import a legacy lock record keyed by the formatted project name."""
+    connection.execute(
+        'INSERT OR REPLACE INTO locks (project, locked, system_lock) VALUES (?, ?, ?)',
+        (key, value['locked'], value.get('system_lock')),
+    )
+
+
+def _import_legacy_webhook(connection: sqlite3.Connection, key: str, value: Dict[str, Any]):
+    """Import a legacy webhook record keyed by the formatted project name."""
+    connection.execute(
+        'INSERT OR REPLACE INTO webhooks (project, webhook) VALUES (?, ?)',
+        (key, json.dumps(value['webhook'])),
+    )
@@ -1,122 +1,439 @@
+import datetime
+import itertools
+import time
 from typing import (
     Any,
     Dict,
+    Iterable,
+    Iterator,
     List,
+    Optional,
 )
 
 import flask
 import woodchips
-from sqlitedict import SqliteDict  # type: ignore
 
 from harvey.config import Config
-from harvey.errors import HarveyError
-from harvey.utils.api_utils import get_page_size
-from harvey.utils.utils import get_utc_timestamp
+from harvey.errors import (
+    HarveyError,
+    InvalidRequestError,
+)
+from harvey.repos.database import (
+    compress_log,
+    connect,
+    decompress_log,
+    transaction,
+)
+from harvey.tracing import TRACER
+from harvey.utils.api_utils import (
+    encode_cursor,
+    get_cursor,
+    get_page_size,
+)
+from harvey.utils.utils import (
+    format_project_name,
+    get_utc_timestamp,
+)
 from harvey.webhooks import Webhook
 
 
-DATABASE_TABLE_NAME = 'deployments'
+# Statuses that start a new attempt rather than finishing the current one, superseded deployments never start
+NEW_ATTEMPT_STATUSES = {'In-Progress', 'Superseded'}
+
+LIVE_LOG_HEADER = '\nCommand output:\n'
+LIVE_LOG_POLL_INTERVAL_SECONDS = 0.5
+LIVE_LOG_KEEPALIVE_SECONDS = 15
+LIVE_LOG_RETENTION_SECONDS = 60
 
 
-def store_deployment_details(webhook: Dict[str, Any], final_output: str = 'NA'):
+@TRACER.traced('store_deployment_details')
+def store_deployment_details(webhook: Dict[str, Any], final_output: str = 'NA', status: Optional[str] = None):
     """Store the deployment's details including logs and metadata to a Sqlite database.
 
-    A project ID consists of the `project_name@commit_id`.
+    A project ID consists of the `project_name@commit_id`. The status of the attempt is determined from the
+    output unless explicitly provided.
     """
     logger = woodchips.get(Config.logger_name)
 
     logger.debug(f'Storing deployment details for {Webhook.repo_full_name(webhook)}...')
 
-    with SqliteDict(filename=Config.database_file, tablename=DATABASE_TABLE_NAME) as database_table:
-        if 'deployment succeeded' in final_output.lower():
-            deployment_status = 'Success'
-        elif final_output == 'NA':
-            deployment_status = 'In-Progress'
-        else:
-            deployment_status = 'Failure'
+    if status:
+        deployment_status = status
+    elif 'deployment succeeded' in final_output.lower():
+        deployment_status = 'Success'
+    elif final_output == 'NA':
+        deployment_status = 'In-Progress'
+    else:
+        deployment_status = 'Failure'
 
-        now = str(get_utc_timestamp())
+    now = str(get_utc_timestamp())
 
-        if 'Deployment execution time:' in final_output:
-            total_runtime = final_output.partition('Deployment execution time: ')[2].split('\n\n')[0]
-        elif 'Pull execution time:' in final_output:
-            total_runtime = final_output.partition('Pull execution time: ')[2].split('\n\n')[0]
-        else:
-            total_runtime = None
+    if 'Deployment execution time:' in final_output:
+        total_runtime = final_output.partition('Deployment execution time: ')[2].split('\n\n')[0]
+    elif 'Pull execution time:' in final_output:
+        total_runtime = final_output.partition('Pull execution time: ')[2].split('\n\n')[0]
+    else:
+        total_runtime = None
 
-        attempt: Dict[str, Any] = {
-            'log': final_output,
-            'status': deployment_status,
-            'timestamp': now,
-            'runtime': total_runtime,
-        }
+    deployment_id = Webhook.deployment_id(webhook)
+    project_name = format_project_name(Webhook.repo_full_name(webhook))
+    commit_id = Webhook.repo_commit_id(webhook)
 
-        if database_table.get(Webhook.deployment_id(webhook)):
-            attempts = database_table[Webhook.deployment_id(webhook)].get('attempts', [])
-        else:
-            attempts = []
+    with transaction() as connection:
+        connection.execute(
+            'INSERT INTO deployments (id, slug, project, commit_id, status, timestamp) VALUES (?, ?, ?, ?, ?, ?)'
+            ' ON CONFLICT (id) DO UPDATE SET status = excluded.status, timestamp = excluded.timestamp',
+            # This timestamp will be the most recent attempt's timestamp, important to have at the root for sorting
+            (deployment_id, Webhook.deployment_slug(webhook), project_name, commit_id, deployment_status, now),
+        )
+
+        latest_attempt = connection.execute(
+            'SELECT MAX(attempt) FROM deployment_attempts WHERE deployment_id = ?',
+            (deployment_id,),
+        ).fetchone()[0]
 
-        if deployment_status == 'In-Progress':
-            attempt_number = len(attempts) + 1
-            attempt['attempt'] = attempt_number
-            attempts.append(attempt)
+        if deployment_status in NEW_ATTEMPT_STATUSES or latest_attempt is None:
+            attempt_number = (latest_attempt or 0) + 1
         else:
-            # If we get here, we failed or succeeded, take the previous "In-Progress entry and update it"
-            attempt_number = len(attempts)
-            attempt['attempt'] = attempt_number
-            attempts[-1] = attempt
-
-        database_table[Webhook.deployment_id(webhook)] = {
-            'project': Webhook.repo_full_name(webhook).replace("/", "-"),
-            'commit': Webhook.repo_commit_id(webhook),
-            # This timestamp will be the most recent attempt's timestamp, important to have at the root for sorting
-            'timestamp': now,
-            'attempts': attempts,
-        }
+            # If we get here, we failed or succeeded, take the previous "In-Progress" entry and update it
+            attempt_number = latest_attempt
+
+        connection.execute(
+            'INSERT INTO deployment_attempts (deployment_id, attempt, status, timestamp, runtime)'
+            ' VALUES (?, ?, ?, ?, ?) ON CONFLICT (deployment_id, attempt) DO UPDATE SET'
+            ' status = excluded.status, timestamp = excluded.timestamp, runtime = excluded.runtime',
+            (deployment_id, attempt_number, deployment_status, now, total_runtime),
+        )
+        # Fold the output streamed while the deployment was running into its log
+        chunks = connection.execute(
+            'SELECT output FROM deployment_log_chunks WHERE deployment_id = ? AND attempt = ? ORDER BY id',
+            (deployment_id, attempt_number),
+        )
+        log = _log_with_live_output(final_output, chunks)
+        connection.execute(
+            'INSERT OR REPLACE INTO deployment_logs (deployment_id, attempt, log) VALUES (?, ?, ?)',
+            (deployment_id, attempt_number, compress_log(log)),
+        )
+
+        # Live output is kept for a short while after an attempt finishes so that streams can catch up
+        retention_cutoff = str(get_utc_timestamp() - datetime.timedelta(seconds=LIVE_LOG_RETENTION_SECONDS))
+        connection.execute(
+            'DELETE FROM deployment_log_chunks WHERE id IN ('
+            ' SELECT chunk.id FROM deployment_log_chunks AS chunk JOIN deployment_attempts AS attempt'
+            ' ON attempt.deployment_id = chunk.deployment_id AND attempt.attempt = chunk.attempt'
+            " WHERE attempt.status != 'In-Progress' AND attempt.timestamp < ?)",
+            (retention_cutoff,),
+        )
+
+
+def next_attempt_number(webhook: Dict[str, Any]) -> int:
+    """Return the number the next attempt of a deployment will be stored as."""
+    with connect() as connection:
+        latest_attempt = connection.execute(
+            'SELECT MAX(attempt) FROM deployment_attempts WHERE deployment_id = ?',
+            (Webhook.deployment_id(webhook),),
+        ).fetchone()[0]
+
+    return (latest_attempt or 0) + 1
+
+
+def store_deployment_timings(webhook: Dict[str, Any], timings: Dict[str, float]):
+    """Store how long each stage of the deployment's current attempt took, in milliseconds."""
+    deployment_id = Webhook.deployment_id(webhook)
+
+    with transaction() as connection:
+        connection.executemany(
+            'INSERT OR REPLACE INTO deployment_timings (deployment_id, attempt, stage, milliseconds)'
+            ' SELECT ?, MAX(attempt), ?, ? FROM deployment_attempts WHERE deployment_id = ?'
+            ' HAVING MAX(attempt) IS NOT NULL',
+            [(deployment_id, stage, milliseconds, deployment_id) for stage, milliseconds in timings.items()],
+        )
 
-        database_table.commit()
+
+def append_deployment_log(webhook: Dict[str, Any], output: str):
+    """Append output to the live log of a deployment's current attempt so it can be followed while it runs."""
+    deployment_id = Webhook.deployment_id(webhook)
+
+    with transaction() as connection:
+        connection.execute(
+            'INSERT INTO deployment_log_chunks (deployment_id, attempt, output)'
+            ' SELECT ?, MAX(attempt), ? FROM deployment_attempts WHERE deployment_id = ?'
+            ' HAVING MAX(attempt) IS NOT NULL',
+            (deployment_id, output, deployment_id),
+        )
 
 
 def retrieve_deployment(deployment_id: str) -> Dict[str, Any]:
-    """Retrieve a deployment's details from a given `deployment_id`."""
-    with SqliteDict(filename=Config.database_file, tablename=DATABASE_TABLE_NAME) as database_table:
-        for key, value in database_table.items():
-            transformed_key = key.split('@')
-            if deployment_id == f'{transformed_key[0]}-{transformed_key[1]}':
-                if value.get('attempts'):
-                    value['attempts'] = sorted(value['attempts'], key=lambda x: x['attempt'], reverse=True)
-                return value
+    """Retrieve a deployment's details from a given `deployment_id`, including the logs of each attempt."""
+    with connect() as connection:
+        deployment = _lookup_deployment(connection, deployment_id)
+        formatted_deployment = _format_deployment(connection, deployment)
+        logs = _retrieve_logs(connection, deployment['id'])
+
+    for attempt in formatted_deployment['attempts']:
+        attempt['log'] = logs.get(attempt['attempt'])
+
+    return formatted_deployment
+
+
+def retrieve_deployment_logs(deployment_id: str, request: flask.Request) -> Dict[str, Any]:
+    """Retrieve the logs of a deployment's attempts, most recent first.
+
+    The user can optionally pass a URL param of `attempt` to only retrieve the log of a single attempt.
+    """
+    attempt = request.args.get('attempt')
+
+    try:
+        attempt_number = int(attempt) if attempt is not None else None
+    except ValueError:
+        raise InvalidRequestError(f'Invalid attempt: {attempt}')
+    # Attempts are numbered from 1
+    if attempt_number is not None and attempt_number < 1:
+        raise InvalidRequestError(f'Invalid attempt: {attempt}')
+
+    with connect() as connection:
+        deployment = _lookup_deployment(connection, deployment_id)
+        logs = _retrieve_logs(connection, deployment['id'], attempt_number)
+
+    return {
+        'logs': [{'attempt': attempt_number, 'log': log} for attempt_number, log in logs.items()],
+    }
+
+
+def stream_deployment_log(deployment_id: str, last_event_id: int = 0) -> Iterator[str]:
+    """Stream the log of a deployment's most recent attempt as Server-Sent Events until the attempt finishes.
+
+    Each chunk of output is sent as a `message` event whose ID can be passed back via `last_event_id` to resume
+    the stream, an `end` event carrying the status of the attempt closes the stream. If the attempt has already
+    finished, its complete log is sent at once.
+    """
+    with connect() as connection:
+        deployment = _lookup_deployment(connection, deployment_id)
+        attempt = connection.execute(
+            'SELECT attempt, status FROM deployment_attempts WHERE deployment_id = ? ORDER BY attempt DESC LIMIT 1',
+            (deployment['id'],),
+        ).fetchone()
+        finished_log = (
+            _retrieve_logs(connection, deployment['id'], attempt['attempt'])[attempt['attempt']]
+            if attempt['status'] != 'In-Progress'
+            else None
+        )
+
+    def events() -> Iterator[str]:
+        if finished_log is not None:
+            yield _format_event(finished_log)
+            yield _format_event(attempt['status'], event='end')
+            return
+
+        event_id = last_event_id
+        last_event_time = time.monotonic()
+
+        while True:
+            with connect() as connection:
+                # Read the status and output from the same snapshot so no output can be missed
+                connection.execute('BEGIN')
+                status = connection.execute(
+                    'SELECT status FROM deployment_attempts WHERE deployment_id = ? AND attempt = ?',
+                    (deployment['id'], attempt['attempt']),
+                ).fetchone()['status']
+                chunks = connection.execute(
+                    'SELECT id, output FROM deployment_log_chunks'
+                    ' WHERE deployment_id = ? AND attempt = ? AND id > ? ORDER BY id LIMIT 1000',
+                    (deployment['id'], attempt['attempt'], event_id),
+                ).fetchall()
+                connection.execute('COMMIT')
+
+            for chunk in chunks:
+                event_id = chunk['id']
+                yield _format_event(chunk['output'], event_id=event_id)
+
+            if chunks:
+                last_event_time = time.monotonic()
+            elif status != 'In-Progress':
+                yield _format_event(status, event='end')
+                return
+            else:
+                if time.monotonic() - last_event_time >= LIVE_LOG_KEEPALIVE_SECONDS:
+                    # Comments keep proxies from closing the connection during quiet stretches of a build
+                    yield ': keepalive\n\n'
+                    last_event_time = time.monotonic()
+                time.sleep(LIVE_LOG_POLL_INTERVAL_SECONDS)
+
+    return events()
 
-    raise HarveyError(f'Could not retrieve deployment details for {deployment_id}!')
 
+def retrieve_deployments(request: flask.Request) -> Dict[str, Any]:
+    """Retrieve a page of deployments, most recent first.
 
-def retrieve_deployments(request: flask.Request) -> Dict[str, List[Any]]:
-    """Retrieve a list of deployments until the pagination limit is reached."""
+    Pagination is keyset based: when more deployments are available, the response includes a `next_cursor`
+    that can be passed back via the `cursor` URL param to retrieve the following page. Each page only reads
+    the records it returns regardless of how many deployments are stored.
+    """
     deployments: Dict[str, Any] = {'deployments': []}
 
     page_size = get_page_size(request)
+    cursor = get_cursor(request)
     project_name = request.args.get('project')
 
-    with SqliteDict(filename=Config.database_file, tablename=DATABASE_TABLE_NAME) as database_table:
-        for _, value in database_table.items():
-            # If a project name is provided, only return deployments for that project
-            if project_name and value['project'] == project_name:
-                if value.get('attempts'):
-                    value['attempts'] = sorted(value['attempts'], key=lambda x: x['attempt'], reverse=True)
-                deployments['deployments'].append(value)
-            # This block is for a generic list of deployments (all deployments)
-            elif not project_name:
-                if value.get('attempts'):
-                    value['attempts'] = sorted(value['attempts'], key=lambda x: x['attempt'], reverse=True)
-                deployments['deployments'].append(value)
-            # If a project name was specified but doesn't match, don't add to list
-            else:
-                pass
+    conditions = []
+    parameters: List[Any] = []
 
-    sorted_deployments = sorted(deployments['deployments'], key=lambda i: i['timestamp'], reverse=True)[:page_size]
-    deployments['total_count'] = len(
-        [attempt for deployment in deployments['deployments'] for attempt in deployment.get('attempts', [])]
-    )
-    deployments['deployments'] = sorted_deployments
+    # If a project name is provided, only return deployments for that project
+    if project_name:
+        conditions.append('project = ?')
+        parameters.append(project_name)
+    if cursor:
+        conditions.append('(timestamp, id) < (?, ?)')
+        parameters.extend(cursor)
+
+    where_clause = f'WHERE {" AND ".join(conditions)}' if conditions else ''
+
+    with connect() as connection:
+        # Fetch one extra record to know if there is another page without having to count the remaining records
+        records = connection.execute(
+            f'SELECT * FROM deployments {where_clause} ORDER BY timestamp DESC, id DESC LIMIT ?',  # nosec
+            (*parameters, page_size + 1),
+        ).fetchall()
+        page = records[:page_size]
+
+        deployments['deployments'] = [_format_deployment(connection, record) for record in page]
+        deployments['total_count'] = _count_attempts(connection, project_name)
+        deployments['next_cursor'] = (
+            encode_cursor([page[-1]['timestamp'], page[-1]['id']]) if len(records) > page_size else None
+        )
 
     return deployments
+
+
+def _count_attempts(connection, project_name: Optional[str] = None) -> int:
+    """Count the attempts of all deployments (or a single project's) via the counters maintained by the schema."""
+    if project_name:
+        count = connection.execute(
+            'SELECT attempts FROM deployment_counts WHERE project = ?',
+            (project_name,),
+        ).fetchone()
+        total_count = count[0] if count else 0
+    else:
+        total_count = connection.execute('SELECT COALESCE(SUM(attempts), 0) FROM deployment_counts').fetchone()[0]
+
+    return total_count
+
+
+def _lookup_deployment(connection, deployment_id: str):
+    """Lookup a deployment record by its public ID (`project-commit_id`)."""
+    deployment = connection.execute(
+        'SELECT * FROM deployments WHERE slug = ? ORDER BY timestamp DESC LIMIT 1',
+        (deployment_id,),
+    ).fetchone()
+
+    if not deployment:
+        raise HarveyError(f'Could not retrieve deployment details for {deployment_id}!')
+
+    return deployment
+
+
+def _retrieve_logs(connection, deployment_id: str, attempt: Optional[int] = None) -> Dict[int, str]:
+    """Load and decompress the logs of a deployment's attempts (or a single attempt), most recent first.
+
+    Attempts that are still running include the live output they have produced so far.
+    """
+    if attempt is not None:
+        records = connection.execute(
+            'SELECT attempt, log FROM deployment_logs WHERE deployment_id = ? AND attempt = ?',
+            (deployment_id, attempt),
+        ).fetchall()
+    else:
+        records = connection.execute(
+            'SELECT attempt, log FROM deployment_logs WHERE deployment_id = ? ORDER BY attempt DESC',
+            (deployment_id,),
+        ).fetchall()
+
+    logs = {record['attempt']: decompress_log(record['log']) for record in records}
+
+    live_output = connection.execute(
+        'SELECT chunk.attempt, chunk.output FROM deployment_log_chunks AS chunk JOIN deployment_attempts AS attempt'
+        ' ON attempt.deployment_id = chunk.deployment_id AND attempt.attempt = chunk.attempt'
+        " WHERE chunk.deployment_id = ? AND attempt.status = 'In-Progress' ORDER BY chunk.attempt, chunk.id",
+        (deployment_id,),
+    ).fetchall()
+    for attempt_number, chunks in itertools.groupby(live_output, key=lambda chunk: chunk['attempt']):
+        if attempt_number in logs:
+            logs[attempt_number] = ''.join(_log_with_live_output(logs[attempt_number], chunks))
+
+    return logs
+
+
+def _log_with_live_output(log: str, chunks: Iterable[Any]) -> Iterator[str]:
+    """Yield the parts of a log followed by the output its attempt streamed while running, if any.
+
+    Chunks can be passed as a cursor so that large outputs are never held in memory all at once.
+    """
+    yield log
+
+    for index, chunk in enumerate(chunks):
+        if index == 0:
+            yield LIVE_LOG_HEADER
+        yield chunk['output']
+
+
+def _format_event(data: str, event: str = 'message', event_id: Optional[int] = None) -> str:
+    """Format a Server-Sent Event, each line of the data must be sent as its own `data` field."""
+    lines = [f'event: {event}']
+    if event_id is not None:
+        lines.append(f'id: {event_id}')
+    lines.extend(f'data: {line}' for line in data.split('\n'))
+
+    return '\n'.join(lines) + '\n\n'
+
+
+def _format_deployment(connection, deployment) -> Dict[str, Any]:
+    """Build the API representation of a deployment record along with its attempts, most recent first.
+
+    Logs are not included, they are only loaded when retrieving a single deployment.
+    """
+    attempts = connection.execute(
+        'SELECT attempt, status, timestamp, runtime FROM deployment_attempts'
+        ' WHERE deployment_id = ? ORDER BY attempt DESC',
+        (deployment['id'],),
+    ).fetchall()
+    builds = connection.execute(
+        'SELECT attempt, service, hash, cache_hit, image_id, build_seconds, seconds_saved FROM deployment_builds'
+        ' WHERE deployment_id = ? ORDER BY attempt, service',
+        (deployment['id'],),
+    ).fetchall()
+
+    timings = connection.execute(
+        'SELECT attempt, stage, milliseconds FROM deployment_timings WHERE deployment_id = ?',
+        (deployment['id'],),
+    ).fetchall()
+
+    attempt_timings: Dict[int, Dict[str, float]] = {}
+    for timing in timings:
+        attempt_timings.setdefault(timing['attempt'], {})[timing['stage']] = timing['milliseconds']
+
+    attempt_builds: Dict[int, List[Dict[str, Any]]] = {}
+    for build in builds:
+        attempt_builds.setdefault(build['attempt'], []).append(
+            {
+                'service': build['service'],
+                'hash': build['hash'],
+                'cache_hit': bool(build['cache_hit']),
+                'image_id': build['image_id'],
+                'build_seconds': build['build_seconds'],
+                'seconds_saved': build['seconds_saved'],
+            }
+        )
+
+    return {
+        'project': deployment['project'],
+        'commit': deployment['commit_id'],
+        'timestamp': deployment['timestamp'],
+        'attempts': [
+            {
+                **dict(attempt),
+                'timings_ms': attempt_timings.get(attempt['attempt'], {}),
+                'builds': attempt_builds.get(attempt['attempt'], []),
+            }
+            for attempt in attempts
+        ],
+    }
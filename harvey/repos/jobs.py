@@ -0,0 +1,302 @@
+import json
+import os
+import sqlite3
+import time
+from typing import (
+    Any,
+    Dict,
+    List,
+    Optional,
+)
+
+from harvey.repos.database import (
+    connect,
+    transaction,
+)
+from harvey.utils.utils import format_unix_timestamp
+from harvey.webhooks import Webhook
+
+
+def enqueue_job(job: Dict[str, Any]) -> Dict[str, Any]:
+    """Add a job to the end of the queue, or take the place of the job already queued for the same project.
+
+    Returns the position of the job in the queue and the job it superseded, if any.
+    """
+    with transaction() as connection:
+        superseded_job = connection.execute(
+            "SELECT * FROM jobs WHERE project = ? AND status = 'queued'",
+            (job['project'],),
+        ).fetchone()
+
+        if superseded_job:
+            connection.execute(
+                'UPDATE jobs SET id = ?, webhook = ?, enqueued_at = ?, scheduled_for = ?, waiting_for_lock = 0'
+                ' WHERE seq = ?',
+                (
+                    job['id'],
+                    json.dumps(job['webhook']),
+                    job['enqueued_at'],
+                    job['scheduled_for'],
+                    superseded_job['seq'],
+                ),
+            )
+            seq = superseded_job['seq']
+        else:
+            seq = connection.execute(
+                'INSERT INTO jobs (id, project, webhook, status, enqueued_at, scheduled_for)'
+                " VALUES (?, ?, ?, 'queued', ?, ?)",
+                (job['id'], job['project'], json.dumps(job['webhook']), job['enqueued_at'], job['scheduled_for']),
+            ).lastrowid
+
+        position = connection.execute(
+            "SELECT COUNT(*) FROM jobs WHERE status = 'queued' AND seq <= ?",
+            (seq,),
+        ).fetchone()[0]
+
+    return {
+        'position': position,
+        'superseded_job': _format_job(superseded_job) if superseded_job else None,
+    }
+
+
+def claim_job(runner: str, lease_seconds: float) -> Optional[Dict[str, Any]]:
+    """Claim the first queued job that is due to start for a runner, leasing it for `lease_seconds`.
+
+    Jobs of a project that already has a running job are skipped so a project is only ever deployed by one runner.
+    """
+    now = time.time()
+
+    with transaction() as connection:
+        job = connection.execute(
+            "SELECT * FROM jobs WHERE status = 'queued' AND scheduled_for <= ?"
+            " AND project NOT IN (SELECT project FROM jobs WHERE status = 'running')"
+            ' ORDER BY seq LIMIT 1',
+            (now,),
+        ).fetchone()
+
+        if job is None:
+            return None
+
+        connection.execute(
+            "UPDATE jobs SET status = 'running', runner = ?, pid = ?, started_at = ?, heartbeat_at = ?,"
+            " lease_expires_at = ?, stage = 'starting', stage_started_at = ? WHERE seq = ?",
+            (runner, os.getpid(), now, now, now + lease_seconds, now, job['seq']),
+        )
+        job = connection.execute('SELECT * FROM jobs WHERE seq = ?', (job['seq'],)).fetchone()
+
+    return _format_job(job)
+
+
+def renew_job_leases(runner: str, lease_seconds: float):
+    """Record a heartbeat for every job a runner is running and extend their leases."""
+    now = time.time()
+
+    with transaction() as connection:
+        connection.execute(
+            "UPDATE jobs SET heartbeat_at = ?, lease_expires_at = ? WHERE runner = ? AND status = 'running'",
+            (now, now + lease_seconds, runner),
+        )
+
+
+def update_job_stage(project: str, stage: str):
+    """Record the stage the running job of a project reached, which also counts as a heartbeat."""
+    now = time.time()
+
+    with transaction() as connection:
+        connection.execute(
+            'UPDATE jobs SET stage = ?, stage_started_at = ?, child_pid = NULL, heartbeat_at = ?'
+            " WHERE project = ? AND status = 'running'",
+            (stage, now, now, project),
+        )
+
+
+def update_job_child_pid(project: str, child_pid: Optional[int]):
+    """Record the PID of the child process (eg: `docker compose`) the running job of a project is waiting on."""
+    with transaction() as connection:
+        connection.execute(
+            "UPDATE jobs SET child_pid = ?, heartbeat_at = ? WHERE project = ? AND status = 'running'",
+            (child_pid, time.time(), project),
+        )
+
+
+def reclaim_expired_jobs(runner: str, lease_seconds: float) -> List[Dict[str, Any]]:
+    """Take over the running jobs whose lease expired (ie: their runner died), leasing them to `runner` so that
+    only one runner reclaims them. The reclaimed jobs are returned as they were when their lease expired, they
+    should be put back in the queue via `requeue_job` once the interruption is recorded.
+    """
+    now = time.time()
+
+    with transaction() as connection:
+        expired_jobs = connection.execute(
+            "SELECT * FROM jobs WHERE status = 'running' AND lease_expires_at < ?",
+            (now,),
+        ).fetchall()
+        connection.executemany(
+            'UPDATE jobs SET runner = ?, heartbeat_at = ?, lease_expires_at = ? WHERE seq = ?',
+            [(runner, now, now + lease_seconds, job['seq']) for job in expired_jobs],
+        )
+
+    return [_format_job(job) for job in expired_jobs]
+
+
+def requeue_job(job_id: str, scheduled_for: float, waiting_for_lock: bool = False) -> Optional[Dict[str, Any]]:
+    """Put a running job back at its place in the queue.
+
+    The job is dropped instead if a newer job of its project was queued in the meantime, that job is returned.
+    """
+    with transaction() as connection:
+        job = connection.execute('SELECT seq, project FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        if job is None:
+            return None
+
+        newer_job = _requeue_or_drop_job(connection, job['seq'], job['project'], scheduled_for, waiting_for_lock)
+
+    return _format_job(newer_job) if newer_job else None
+
+
+def wake_waiting_jobs(project: str):
+    """Make the queued jobs of a project that wait on its lock due right away."""
+    with transaction() as connection:
+        connection.execute(
+            "UPDATE jobs SET scheduled_for = ? WHERE project = ? AND status = 'queued' AND waiting_for_lock = 1",
+            (time.time(), project),
+        )
+
+
+def count_jobs(status: str) -> int:
+    """Count the jobs with a status (`queued` or `running`) across every Harvey process."""
+    with connect() as connection:
+        return connection.execute('SELECT COUNT(*) FROM jobs WHERE status = ?', (status,)).fetchone()[0]
+
+
+def has_leased_job(project: str, excluded_job_id: str) -> bool:
+    """Return whether a job of a project other than `excluded_job_id` is running under a lease that hasn't expired,
+    ie: whether a live runner may hold the project's lock.
+    """
+    with connect() as connection:
+        return (
+            connection.execute(
+                "SELECT 1 FROM jobs WHERE project = ? AND id != ? AND status = 'running' AND lease_expires_at >= ?",
+                (project, excluded_job_id, time.time()),
+            ).fetchone()
+            is not None
+        )
+
+
+def is_deployment_running(webhook: Dict[str, Any]) -> bool:
+    """Return whether a running job (of any runner) is deploying the commit of a webhook."""
+    deployment_id = Webhook.deployment_id(webhook)
+
+    with connect() as connection:
+        jobs = connection.execute(
+            "SELECT webhook FROM jobs WHERE project = ? AND status = 'running'",
+            (Webhook.repo_full_name(webhook),),
+        ).fetchall()
+
+    return any(Webhook.deployment_id(json.loads(job['webhook'])) == deployment_id for job in jobs)
+
+
+def finish_job(job_id: str, runner: str):
+    """Remove a job from the queue once it ran, regardless of the outcome of its deployment.
+
+    Only the runner the job is leased to can finish it, a job reclaimed by another runner (eg: its lease expired
+    while its runner was unresponsive) is left to that runner.
+    """
+    with transaction() as connection:
+        connection.execute('DELETE FROM jobs WHERE id = ? AND runner = ?', (job_id, runner))
+
+
+def retrieve_active_deployments() -> Dict[str, Any]:
+    """Retrieve the deployments in flight across every Harvey process, oldest first."""
+    now = time.time()
+
+    with connect() as connection:
+        jobs = connection.execute("SELECT * FROM jobs WHERE status = 'running' ORDER BY started_at").fetchall()
+
+    active_deployments = []
+    for job in jobs:
+        webhook = json.loads(job['webhook'])
+        active_deployments.append(
+            {
+                'deployment_id': Webhook.deployment_slug(webhook),
+                'project': job['project'],
+                'commit': Webhook.repo_commit_id(webhook),
+                'stage': job['stage'],
+                'started_at': format_unix_timestamp(job['started_at']),
+                'stage_started_at': format_unix_timestamp(job['stage_started_at']),
+                'elapsed_seconds': round(now - job['started_at'], 3),
+                'runner': job['runner'],
+                'pid': job['pid'],
+                'child_pid': job['child_pid'],
+                'last_heartbeat_at': format_unix_timestamp(job['heartbeat_at']),
+            }
+        )
+
+    return {
+        'deployments': active_deployments,
+        'total_count': len(active_deployments),
+    }
+
+
+def retrieve_jobs() -> List[Dict[str, Any]]:
+    """Retrieve every running and queued job, in the order they were queued."""
+    with connect() as connection:
+        jobs = connection.execute('SELECT * FROM jobs ORDER BY seq').fetchall()
+
+    return [_format_job(job) for job in jobs]
+
+
+def next_scheduled_time() -> Optional[float]:
+    """Return when the next queued job is due to start or `None` if nothing is queued."""
+    with connect() as connection:
+        return connection.execute("SELECT MIN(scheduled_for) FROM jobs WHERE status = 'queued'").fetchone()[0]
+
+
+def _requeue_or_drop_job(
+    connection: sqlite3.Connection,
+    seq: int,
+    project: str,
+    scheduled_for: float,
+    waiting_for_lock: bool = False,
+) -> Optional[sqlite3.Row]:
+    """Put a job back in the queue unless a newer job of its project is queued already, in which case it's dropped
+    and the newer job is returned.
+    """
+    newer_job = connection.execute(
+        "SELECT * FROM jobs WHERE project = ? AND status = 'queued' AND seq != ?",
+        (project, seq),
+    ).fetchone()
+
+    if newer_job:
+        connection.execute('DELETE FROM jobs WHERE seq = ?', (seq,))
+        return newer_job
+
+    connection.execute(
+        "UPDATE jobs SET status = 'queued', scheduled_for = ?, waiting_for_lock = ?, runner = NULL, pid = NULL,"
+        ' started_at = NULL, heartbeat_at = NULL, lease_expires_at = NULL, stage = NULL, stage_started_at = NULL,'
+        ' child_pid = NULL WHERE seq = ?',
+        (scheduled_for, waiting_for_lock, seq),
+    )
+
+    return None
+
+
+def _format_job(job: sqlite3.Row) -> Dict[str, Any]:
+    """Format a job row, the webhook is stored as JSON."""
+    return {
+        'id': job['id'],
+        'project': job['project'],
+        'webhook': json.loads(job['webhook']),
+        'status': job['status'],
+        'enqueued_at': job['enqueued_at'],
+        'scheduled_for': job['scheduled_for'],
+        'started_at': job['started_at'],
+        'waiting_for_lock': bool(job['waiting_for_lock']),
+        'runner': job['runner'],
+        'pid': job['pid'],
+        'heartbeat_at': job['heartbeat_at'],
+        'lease_expires_at': job['lease_expires_at'],
+        'stage': job['stage'],
+        'stage_started_at': job['stage_started_at'],
+        'child_pid': job['child_pid'],
+    }
@@ -7,17 +7,18 @@ from typing import (
 
 import flask
 import woodchips
-from sqlitedict import SqliteDict  # type: ignore
 
 from harvey.config import Config
 from harvey.errors import HarveyError
+from harvey.repos.database import (
+    connect,
+    transaction,
+)
+from harvey.tracing import TRACER
 from harvey.utils.api_utils import get_page_size
 from harvey.utils.utils import format_project_name
 
 
-DATABASE_TABLE_NAME = 'locks'
-
-
 def update_project_lock(project_name: str, locked: bool = False, system_lock: Optional[bool] = True) -> bool:
     """Locks or unlocks the project's deployments to ensure we don't crash Docker with two inflight deployments.
     This function will also create locks for new projects.
@@ -33,25 +34,73 @@ def update_project_lock(project_name: str, locked: bool = False, system_lock: Op
     formatted_project_name = format_project_name(project_name)
     system_lock_value = None if locked is False else system_lock  # Don't allow this to be set if unlocking
 
-    with SqliteDict(filename=Config.database_file, tablename=DATABASE_TABLE_NAME) as database_table:
-        database_table[formatted_project_name] = {
-            'locked': locked,
-            'system_lock': system_lock_value,
-        }
-
-        database_table.commit()
+    with transaction() as connection:
+        connection.execute(
+            'INSERT OR REPLACE INTO locks (project, locked, system_lock) VALUES (?, ?, ?)',
+            (formatted_project_name, locked, system_lock_value),
+        )
 
     return locked
 
 
+@TRACER.traced('acquire_project_lock')
+def acquire_project_lock(project_name: str) -> bool:
+    """Atomically lock a project's deployments for the system if they aren't locked already.
+
+    Returns `True` if the lock was acquired, checking and setting the lock happen in a single write transaction
+    so two deployments can never both acquire the lock of a project.
+    """
+    logger = woodchips.get(Config.logger_name)
+
+    formatted_project_name = format_project_name(project_name)
+
+    with transaction() as connection:
+        acquired = connection.execute(
+            'INSERT INTO locks (project, locked, system_lock) VALUES (?, 1, 1)'
+            ' ON CONFLICT (project) DO UPDATE SET locked = 1, system_lock = 1 WHERE locked = 0',
+            (formatted_project_name,),
+        ).rowcount
+
+    if acquired:
+        logger.info(f'Locking deployments for {project_name}...')
+
+    return bool(acquired)
+
+
+def release_project_lock(project_name: str) -> bool:
+    """Unlock a project's deployments if they were locked by the system, user requested locks are preserved.
+
+    Returns `True` if the lock was released.
+    """
+    logger = woodchips.get(Config.logger_name)
+
+    formatted_project_name = format_project_name(project_name)
+
+    with transaction() as connection:
+        released = connection.execute(
+            'UPDATE locks SET locked = 0, system_lock = NULL WHERE project = ? AND locked = 1 AND system_lock = 1',
+            (formatted_project_name,),
+        ).rowcount
+
+    if released:
+        logger.info(f'Unlocking deployments for {project_name}...')
+
+    return bool(released)
+
+
+@TRACER.traced('lookup_project_lock')
 def lookup_project_lock(project_name: str) -> Dict[str, Any]:
     """Looks up a project's lock object by its full name."""
     formatted_project_name = format_project_name(project_name)
 
-    with SqliteDict(filename=Config.database_file, tablename=DATABASE_TABLE_NAME) as database_table:
-        for key, value in database_table.items():
-            if key == formatted_project_name:
-                return value
+    with connect() as connection:
+        lock = connection.execute(
+            'SELECT locked, system_lock FROM locks WHERE project = ?',
+            (formatted_project_name,),
+        ).fetchone()
+
+    if lock:
+        return _format_lock(lock)
 
     raise HarveyError('Lock does not exist!')
 
@@ -61,18 +110,20 @@ def retrieve_locks(request: flask.Request) -> Dict[str, List[Any]]:
 
     page_size = get_page_size(request)
 
-    with SqliteDict(filename=Config.database_file, tablename=DATABASE_TABLE_NAME) as database_table:
-        for key, values in database_table.items():
-            locks['locks'].append(
-                {
-                    'project': key,
-                    'locked': values['locked'],
-                    'system_lock': values.get('system_lock'),
-                }
-            )
-
-    sorted_locks = sorted(locks['locks'], key=lambda x: x['project'])[:page_size]
-    locks['total_count'] = len(locks['locks'])
-    locks['locks'] = sorted_locks
+    with connect() as connection:
+        records = connection.execute(
+            'SELECT project, locked, system_lock FROM locks ORDER BY project LIMIT ?',
+            (page_size,),
+        ).fetchall()
+        locks['locks'] = [{'project': record['project'], **_format_lock(record)} for record in records]
+        locks['total_count'] = connection.execute('SELECT COUNT(*) FROM locks').fetchone()[0]
 
     return locks
+
+
+def _format_lock(lock) -> Dict[str, Any]:
+    """SQLite stores booleans as integers, convert them back for the API."""
+    return {
+        'locked': bool(lock['locked']),
+        'system_lock': None if lock['system_lock'] is None else bool(lock['system_lock']),
+    }
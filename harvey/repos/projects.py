@@ -7,8 +7,11 @@ from typing import (
 
 import flask
 
+from harvey.compose import Compose
 from harvey.config import Config
+from harvey.containers import Container
 from harvey.utils.api_utils import get_page_size
+from harvey.webhooks import Webhook
 
 
 def retrieve_projects(request: flask.Request) -> Dict[str, List[Any]]:
@@ -34,3 +37,17 @@ def retrieve_projects(request: flask.Request) -> Dict[str, List[Any]]:
     projects['total_count'] = total_projects
 
     return projects
+
+
+def retrieve_project_containers(webhook: Dict[str, Any]) -> Dict[str, Any]:
+    """Retrieve the status of every container (running or not) of a project's compose project."""
+    project_path = os.path.join(Config.projects_path, Webhook.repo_full_name(webhook))
+    containers = Container.inspect_containers(
+        Container.create_client(),
+        compose_project=Compose.project_name(project_path),
+    )
+
+    return {
+        'containers': [containers[container_name] for container_name in sorted(containers)],
+        'total_count': len(containers),
+    }
@@ -0,0 +1,35 @@
+import signal
+
+import woodchips
+
+# Importing the app bootstraps Harvey (logging, Sentry, the database directory) the same way `wsgi.py` does
+from harvey.app import APP  # noqa: F401
+from harvey.config import Config
+from harvey.messages import SLACK_SENDER
+from harvey.scheduler import SCHEDULER
+
+
+def main():
+    """Run the deployments queued by the Harvey API in a standalone process (the `harvey-runner` command).
+
+    Set `EXTERNAL_RUNNER` on the API so it only queues deployments, then run as many runners as needed. Runners
+    finish the deployments they are running and send their Slack messages before exiting when asked to stop
+    (SIGINT/SIGTERM).
+    """
+    logger = woodchips.get(Config.logger_name)
+
+    def stop(signal_number, frame):
+        logger.info('Stopping the Harvey runner once running deployments finish...')
+        SCHEDULER.stop(timeout=0)
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    logger.info(f'Harvey runner started, running up to {Config.max_concurrent_deployments} deployments at once')
+    SCHEDULER.run()
+    # Deliver the notifications of the last deployments before exiting
+    SLACK_SENDER.stop(timeout=30)
+
+
+if __name__ == '__main__':
+    main()
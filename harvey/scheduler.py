@@ -0,0 +1,401 @@
+import os
+import socket
+import threading
+import time
+import uuid
+from typing import (
+    Any,
+    Dict,
+    List,
+    Optional,
+)
+
+import woodchips
+import yaml
+
+from harvey.config import Config
+from harvey.deployments import Deployment
+from harvey.metrics import (
+    IN_FLIGHT_DEPLOYMENTS,
+    QUEUE_DEPTH,
+)
+from harvey.repos.deployments import (
+    next_attempt_number,
+    store_deployment_details,
+)
+from harvey.repos.jobs import (
+    claim_job,
+    count_jobs,
+    enqueue_job,
+    finish_job,
+    has_leased_job,
+    is_deployment_running,
+    next_scheduled_time,
+    reclaim_expired_jobs,
+    renew_job_leases,
+    requeue_job,
+    retrieve_jobs,
+    wake_waiting_jobs,
+)
+from harvey.repos.locks import (
+    acquire_project_lock,
+    lookup_project_lock,
+    release_project_lock,
+)
+from harvey.tracing import (
+    TRACER,
+    get_trace_id,
+)
+from harvey.utils.deployments import kill_deployment
+from harvey.utils.utils import format_unix_timestamp
+from harvey.webhooks import Webhook
+
+
+class Scheduler:
+    """Runs deployments on a bounded pool of worker threads, fed by a durable queue stored in the database.
+
+    Deployments beyond `Config.max_concurrent_deployments` wait in a FIFO queue until a worker frees up so that
+    a burst of webhooks can't start an unbounded number of builds on the host at once. As the queue lives in the
+    database, queued deployments survive restarts and can be run by a separate `harvey-runner` process (see
+    `Config.external_runner`) so the HTTP tier and deployment execution scale independently. Workers lease the
+    jobs they run and renew the lease while running them, the jobs of a runner that dies are reclaimed once their
+    lease expires and run again.
+
+    Only the newest commit of a project is worth building: a deployment still waiting in the queue is superseded
+    by any newer deployment of the same project, which takes its place in the queue. Projects can additionally
+    debounce deployments so that a series of pushes only results in a single deployment once they settle.
+
+    A deployment only starts once it acquires its project's lock. Deployments of a project locked by the system
+    (ie: another deployment of it is in flight) wait in the queue and start as soon as the lock is released while
+    deployments of a project locked by a user are rejected.
+    """
+
+    # How often a deployment waiting on a lock held outside of this scheduler checks if it was released
+    lock_retry_seconds = 5
+    # How often idle workers check the queue for jobs queued by other processes
+    poll_interval_seconds = 1.0
+    lease_seconds = 60
+    heartbeat_interval_seconds = 15
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._wakeups = 0
+        self._workers: List[threading.Thread] = []
+        self._stopping = threading.Event()
+        self._runner_id = ''
+
+    def submit(self, webhook: Dict[str, Any], redeploy: bool = False) -> Dict[str, Any]:
+        """Queue a deployment and return its job details, including its position in the queue.
+
+        A `redeploy` (eg: requested via the API to recover a broken container) deploys every service of the project
+        even if its commit was deployed already, the flag is carried by the job's webhook.
+        """
+        logger = woodchips.get(Config.logger_name)
+
+        if redeploy:
+            webhook = {**webhook, 'redeploy': True}
+
+        now = time.time()
+        job = {
+            'id': uuid.uuid4().hex,
+            'project': Webhook.repo_full_name(webhook),
+            'webhook': webhook,
+            'enqueued_at': now,
+            'scheduled_for': now + self._debounce_seconds(webhook),
+            'started_at': None,
+            'waiting_for_lock': False,
+        }
+        queued_job = enqueue_job(job)
+        position = queued_job['position']
+
+        logger.info(f'Queued deployment for {job["project"]} at position {position}')
+
+        if queued_job['superseded_job']:
+            self._supersede(queued_job['superseded_job'], job)
+
+        if not Config.external_runner:
+            self._start_workers()
+        self._notify()
+
+        return {**self._format_job(job), 'position': position}
+
+    def status(self) -> Dict[str, Any]:
+        """Return the running and queued jobs of every runner, queued jobs are listed in the order they will start."""
+        jobs = retrieve_jobs()
+        running = [self._format_job(job) for job in jobs if job['status'] == 'running']
+        queued = [
+            {**self._format_job(job), 'position': position}
+            for position, job in enumerate((job for job in jobs if job['status'] == 'queued'), start=1)
+        ]
+
+        return {
+            'max_concurrent_deployments': Config.max_concurrent_deployments,
+            'running': running,
+            'queued': queued,
+        }
+
+    def start(self):
+        """Start running queued jobs in the background, including the jobs left in the queue by a previous run and
+        the jobs of runners that died. Called when Harvey boots unless deployments run via `harvey-runner`.
+        """
+        self._start_workers()
+        self._notify()
+
+    def run(self):
+        """Run queued jobs until `stop()` is called, used by the standalone `harvey-runner` process."""
+        self._start_workers()
+        self._stopping.wait()
+
+        for worker in self._workers:
+            worker.join()
+
+    def stop(self, timeout: Optional[float] = None):
+        """Stop claiming new jobs and wait for the workers to finish the jobs they are running."""
+        self._stopping.set()
+        self._notify()
+
+        for worker in self._workers:
+            worker.join(timeout=timeout)
+
+    def _notify(self):
+        """Wake up idle workers so they check the queue right away."""
+        with self._condition:
+            self._wakeups += 1
+            self._condition.notify_all()
+
+    def _start_workers(self):
+        """Start the worker threads and the heartbeat thread unless they are running already.
+
+        They are started by `start()` or `run()` rather than when the scheduler is created so they are started in the
+        process that serves requests (eg: after uWSGI forks, see `lazy-apps`).
+        """
+        with self._condition:
+            if self._workers:
+                return
+
+            self._runner_id = f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+
+            for index in range(Config.max_concurrent_deployments):
+                worker = threading.Thread(name=f'harvey-worker-{index + 1}', target=self._work, daemon=True)
+                worker.start()
+                self._workers.append(worker)
+
+            threading.Thread(name='harvey-heartbeat', target=self._heartbeat, daemon=True).start()
+
+    def _heartbeat(self):
+        """Renew the leases of the jobs this scheduler runs and reclaim the jobs of runners that died.
+
+        Once the scheduler is stopping, leases are renewed until the workers finished the jobs they are running so
+        no other runner reclaims (and deploys again) a job while it's being drained.
+        """
+        logger = woodchips.get(Config.logger_name)
+
+        while True:
+            stopping = self._stopping.is_set()
+            try:
+                renew_job_leases(self._runner_id, self.lease_seconds)
+                if not stopping:
+                    for job in reclaim_expired_jobs(self._runner_id, self.lease_seconds):
+                        self._record_interruption(job)
+                        requeue_job(job['id'], time.time())
+                        self._notify()
+            except Exception as error:
+                logger.error(f'Could not renew deployment leases: {error}')
+
+            if self._stopping.wait(timeout=self.heartbeat_interval_seconds) and self._join_workers(
+                timeout=self.heartbeat_interval_seconds
+            ):
+                return
+
+    def _join_workers(self, timeout: float) -> bool:
+        """Wait up to `timeout` seconds for the workers to exit, returns whether they all did."""
+        deadline = time.monotonic() + timeout
+        for worker in self._workers:
+            worker.join(timeout=max(deadline - time.monotonic(), 0))
+
+        return not any(worker.is_alive() for worker in self._workers)
+
+    def _claim_job(self) -> Optional[Dict[str, Any]]:
+        """Claim the next job due to start, waiting for one to be queued if there is none."""
+        logger = woodchips.get(Config.logger_name)
+
+        with self._condition:
+            wakeups = self._wakeups
+
+        try:
+            job = claim_job(self._runner_id, self.lease_seconds)
+            timeout = self._seconds_until_next_job()
+        except Exception as error:
+            logger.error(f'Could not claim a deployment: {error}')
+            job = None
+            timeout = self.poll_interval_seconds
+
+        if job is None:
+            with self._condition:
+                # Don't wait if a job was queued while we were claiming
+                if self._wakeups == wakeups and not self._stopping.is_set():
+                    self._condition.wait(timeout=timeout)
+
+        return job
+
+    def _seconds_until_next_job(self) -> float:
+        """Return how long an idle worker can wait before checking the queue again."""
+        next_start = next_scheduled_time()
+        if next_start is None:
+            return self.poll_interval_seconds
+
+        return min(max(next_start - time.time(), 0), self.poll_interval_seconds)
+
+    def _acquire_lock(self, job: Dict[str, Any]) -> bool:
+        """Acquire the project lock for a job, returns `False` if the job has to wait for the lock instead.
+
+        Deployments of projects locked by a user are killed. A system lock that no running job holds (eg: left
+        behind by a Harvey process that crashed) is stale, it's released so the job can acquire it.
+        """
+        logger = woodchips.get(Config.logger_name)
+
+        if acquire_project_lock(job['project']):
+            return True
+
+        if lookup_project_lock(job['project'])['system_lock'] is not True:
+            # Raises, the job is finished as failed
+            kill_deployment(
+                f'{job["project"]} deployments are locked. Please try again later or unlock deployments.',
+                job['webhook'],
+            )
+        elif not has_leased_job(job['project'], job['id']):
+            logger.warning(f'Releasing the stale system lock of {job["project"]}, no running deployment holds it')
+            release_project_lock(job['project'])
+            if acquire_project_lock(job['project']):
+                return True
+
+        self._wait_for_lock(job)
+
+        return False
+
+    def _wait_for_lock(self, job: Dict[str, Any]):
+        """Put a job back at its place in the queue until the system lock of its project is released.
+
+        The job is retried as soon as a deployment of the project finishes in this scheduler, or every
+        `lock_retry_seconds` in case the lock is held elsewhere. A newer deployment of the project that was queued
+        in the meantime supersedes it.
+        """
+        logger = woodchips.get(Config.logger_name)
+        logger.info(f'Deployments of {job["project"]} are locked by the system, waiting for the lock to be released')
+
+        newer_job = requeue_job(job['id'], time.time() + self.lock_retry_seconds, waiting_for_lock=True)
+        if newer_job:
+            self._supersede(job, newer_job)
+
+    @staticmethod
+    def _supersede(superseded_job: Dict[str, Any], job: Dict[str, Any]):
+        """Record that a queued job was skipped in favor of a newer commit of its project.
+
+        Nothing is recorded if the commit of the superseded job is being deployed by another job (eg: the webhook
+        was redelivered), that job records the outcome of the deployment on its own attempt.
+        """
+        logger = woodchips.get(Config.logger_name)
+
+        message = (
+            f'Harvey skipped this deployment since a newer commit ({Webhook.repo_commit_id(job["webhook"])})'
+            f' of {job["project"]} was queued.'
+        )
+        logger.info(message)
+
+        if not is_deployment_running(superseded_job['webhook']):
+            store_deployment_details(superseded_job['webhook'], message, status='Superseded')
+
+    @staticmethod
+    def _record_interruption(job: Dict[str, Any]):
+        """Fail the attempt of a job whose runner died and release the lock it held so the job can run again."""
+        logger = woodchips.get(Config.logger_name)
+
+        message = (
+            f'Harvey was interrupted while deploying {job["project"]}'
+            f' (runner {job["runner"]} stopped responding), the deployment will be retried.'
+        )
+        logger.warning(message)
+        store_deployment_details(job['webhook'], message)
+        release_project_lock(job['project'])
+
+    @staticmethod
+    def _debounce_seconds(webhook: Dict[str, Any]) -> float:
+        """Return how long a project's deployments wait for newer commits before starting.
+
+        Projects can set `debounce_seconds` in their config (falling back to the currently checked out
+        `.harvey.yaml` since the new commit hasn't been pulled yet), otherwise `Config.deployment_debounce_seconds`.
+        An invalid config doesn't keep the deployment from being queued, its deployment reports the error instead.
+        """
+        try:
+            project_config = webhook.get('data') or Deployment.load_project_config(webhook) or {}
+
+            return float(project_config.get('debounce_seconds', Config.deployment_debounce_seconds))
+        except (OSError, yaml.YAMLError, AttributeError, TypeError, ValueError) as error:
+            woodchips.get(Config.logger_name).warning(
+                f'Could not read the debounce window of {Webhook.repo_full_name(webhook)}, using the default: {error}'
+            )
+
+            return Config.deployment_debounce_seconds
+
+    @staticmethod
+    def _format_job(job: Dict[str, Any]) -> Dict[str, Any]:
+        """Return the API representation of a job."""
+        wait_time = (job['started_at'] or time.time()) - job['enqueued_at']
+
+        return {
+            'id': job['id'],
+            'project': job['project'],
+            'commit': Webhook.repo_commit_id(job['webhook']),
+            'enqueued_at': format_unix_timestamp(job['enqueued_at']),
+            'scheduled_for': format_unix_timestamp(job['scheduled_for']),
+            'started_at': format_unix_timestamp(job['started_at']),
+            'wait_seconds': round(wait_time, 3),
+            'waiting_for_lock': job['waiting_for_lock'],
+        }
+
+    def _work(self):
+        """Run queued jobs one after another until the scheduler is stopped."""
+        logger = woodchips.get(Config.logger_name)
+        worker = threading.current_thread()
+        worker_name = worker.name
+
+        while not self._stopping.is_set():
+            job = self._claim_job()
+            if job is None:
+                continue
+
+            # Threads are named after the project they deploy so they can be identified via the `/threads` endpoint
+            worker.name = job['project']
+            deployed = False
+            finished = True
+
+            try:
+                trace_id = get_trace_id(Webhook.deployment_slug(job['webhook']), next_attempt_number(job['webhook']))
+                with TRACER.trace(trace_id), TRACER.span('deployment', job_id=job['id']):
+                    if self._acquire_lock(job):
+                        deployed = True
+                        Deployment.run_deployment(
+                            job['webhook'],
+                            queue_wait_seconds=job['started_at'] - job['enqueued_at'],
+                        )
+                    else:
+                        finished = False
+            except Exception as error:
+                logger.error(f'Deployment of {job["project"]} errored: {error}')
+            finally:
+                worker.name = worker_name
+                try:
+                    if finished:
+                        finish_job(job['id'], self._runner_id)
+                    if deployed:
+                        # The deployment released the project lock, start the next deployment of it right away
+                        wake_waiting_jobs(job['project'])
+                except Exception as error:
+                    logger.error(f'Could not update the queue after deploying {job["project"]}: {error}')
+                self._notify()
+
+
+SCHEDULER = Scheduler()
+
+QUEUE_DEPTH.set_function(lambda: count_jobs('queued'))
+IN_FLIGHT_DEPLOYMENTS.set_function(lambda: count_jobs('running'))
@@ -0,0 +1,258 @@
+import json
+import os
+import re
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from functools import wraps
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+)
+
+import flask
+import woodchips
+
+from harvey.config import Config
+from harvey.errors import InvalidRequestError
+
+
+# Spans that don't belong to a deployment (eg: Slack messages sent in the background) are exported together
+UNTRACED_FILENAME = 'harvey.jsonl'
+# The file of untraced spans is rotated (keeping the previous file as `harvey.jsonl.1`) once it reaches this size
+MAX_UNTRACED_BYTES = 10 * 1024 * 1024
+TIMELINE_WIDTH = 60
+
+
+class JsonLinesExporter:
+    """Appends finished spans as JSON lines to a file per deployment under `Config.traces_path`.
+
+    Traces last written to more than `retention_days` ago are removed whenever a new trace starts.
+    """
+
+    def __init__(self, traces_path: str, retention_days: float = Config.trace_retention_days):
+        self.traces_path = traces_path
+        self.retention_days = retention_days
+        self._lock = threading.Lock()
+
+    def export(self, span: Dict[str, Any]):
+        filename = f'{span["trace_id"]}.jsonl' if span['trace_id'] else UNTRACED_FILENAME
+        trace_filepath = os.path.join(self.traces_path, filename)
+
+        with self._lock:
+            os.makedirs(self.traces_path, exist_ok=True)
+            if span['trace_id'] and not os.path.exists(trace_filepath):
+                self._remove_expired_traces()
+            elif not span['trace_id'] and _file_size(trace_filepath) >= MAX_UNTRACED_BYTES:
+                os.replace(trace_filepath, f'{trace_filepath}.1')
+
+            with open(trace_filepath, 'a') as trace_file:
+                trace_file.write(json.dumps(span) + '\n')
+
+    def attempts(self, deployment_id: str) -> List[int]:
+        """List the attempts of a deployment that were traced, oldest first."""
+        try:
+            filenames = os.listdir(self.traces_path)
+        except FileNotFoundError:
+            return []
+
+        trace_filename_pattern = re.compile(rf'{re.escape(deployment_id)}\.(\d+)\.jsonl')
+        matches = [trace_filename_pattern.fullmatch(filename) for filename in filenames]
+
+        return sorted(int(match.group(1)) for match in matches if match)
+
+    def _remove_expired_traces(self):
+        expiration_time = time.time() - self.retention_days * 24 * 60 * 60
+
+        for entry in os.scandir(self.traces_path):
+            try:
+                if entry.name.endswith('.jsonl') and entry.name != UNTRACED_FILENAME:
+                    if entry.stat().st_mtime < expiration_time:
+                        os.remove(entry.path)
+            except FileNotFoundError:
+                pass  # Removed by another Harvey process in the meantime
+
+    def load(self, trace_id: str) -> List[Dict[str, Any]]:
+        """Load the spans of a deployment, an empty list if it wasn't traced."""
+        trace_filepath = os.path.join(self.traces_path, f'{trace_id}.jsonl')
+        # Trace IDs come from the API, they must not point outside of the traces folder
+        if os.path.dirname(os.path.abspath(trace_filepath)) != os.path.abspath(self.traces_path):
+            return []
+
+        try:
+            with open(trace_filepath, 'r') as trace_file:
+                return [json.loads(line) for line in trace_file if line.strip()]
+        except FileNotFoundError:
+            return []
+
+
+class _NoopSpan:
+    """Returned by `Tracer.span` when tracing is disabled so spans cost a single attribute check."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+class Tracer:
+    """Records spans (named and timed sections of work) around the stages of deployments.
+
+    Tracing is disabled unless an exporter is set, see `Config.trace_exporter`. The spans of a deployment's attempt
+    share a trace ID (see `get_trace_id`), spans opened while another span of the same thread is open are its children.
+    """
+
+    def __init__(self, exporter: Optional[JsonLinesExporter] = None):
+        self.exporter = exporter
+        self._context = threading.local()
+
+    @contextmanager
+    def trace(self, trace_id: str) -> Iterator[None]:
+        """Attribute the spans recorded by the current thread to a trace (eg: a deployment)."""
+        previous_trace_id = getattr(self._context, 'trace_id', None)
+        self._context.trace_id = trace_id
+        try:
+            yield
+        finally:
+            self._context.trace_id = previous_trace_id
+
+    def span(self, name: str, **attributes: Any):
+        """Record a span around a block of code, its attributes describe the work (eg: the project)."""
+        if self.exporter is None:
+            return NOOP_SPAN
+
+        return self._record_span(name, attributes)
+
+    def traced(self, name: str) -> Callable:
+        """Decorate a function so each call is recorded as a span."""
+
+        def decorator(function):
+            @wraps(function)
+            def traced_function(*args, **kwargs):
+                if self.exporter is None:
+                    return function(*args, **kwargs)
+
+                with self._record_span(name, {}):
+                    return function(*args, **kwargs)
+
+            return traced_function
+
+        return decorator
+
+    @contextmanager
+    def _record_span(self, name: str, attributes: Dict[str, Any]) -> Iterator[None]:
+        stack = self._context.__dict__.setdefault('stack', [])
+        span = {
+            'trace_id': getattr(self._context, 'trace_id', None),
+            'span_id': uuid.uuid4().hex[:16],
+            'parent_id': stack[-1] if stack else None,
+            'name': name,
+            'thread': threading.current_thread().name,
+            'start': time.time(),
+            'duration_ms': None,
+            'attributes': attributes,
+            'error': None,
+        }
+        start_time = time.monotonic()
+        stack.append(span['span_id'])
+
+        try:
+            yield
+        except BaseException as error:
+            span['error'] = f'{type(error).__name__}: {error}'
+            raise
+        finally:
+            stack.pop()
+            span['duration_ms'] = round((time.monotonic() - start_time) * 1000, 3)
+            try:
+                self.exporter.export(span)  # type: ignore
+            except Exception as error:
+                woodchips.get(Config.logger_name).warning(f'Could not export the {name} span: {error}')
+
+
+def _file_size(filepath: str) -> int:
+    try:
+        return os.path.getsize(filepath)
+    except FileNotFoundError:
+        return 0
+
+
+def get_trace_id(deployment_id: str, attempt: int) -> str:
+    """Return the trace ID of a deployment's attempt, `deployment_id` being the ID the API uses for deployments."""
+    return f'{deployment_id}.{attempt}'
+
+
+def render_timeline(spans: List[Dict[str, Any]]) -> str:
+    """Render the spans of a trace as a flame-style timeline: one row per span, nested under its parent, with a
+    bar showing when it ran relative to the root span it belongs to.
+    """
+    children: Dict[Optional[str], List[Dict[str, Any]]] = {}
+    span_ids = {span['span_id'] for span in spans}
+    for span in sorted(spans, key=lambda span: span['start']):
+        # Spans whose parent wasn't exported (eg: it's still running) are shown as roots
+        parent_id = span['parent_id'] if span['parent_id'] in span_ids else None
+        children.setdefault(parent_id, []).append(span)
+
+    rows = []
+
+    def add_rows(span: Dict[str, Any], depth: int, root: Dict[str, Any]):
+        root_seconds = max(root['duration_ms'] / 1000, 1e-9)
+        offset = int((span['start'] - root['start']) / root_seconds * TIMELINE_WIDTH)
+        length = max(1, round(span['duration_ms'] / 1000 / root_seconds * TIMELINE_WIDTH))
+        offset = min(offset, TIMELINE_WIDTH - 1)
+        bar = (' ' * offset + '#' * length)[:TIMELINE_WIDTH].ljust(TIMELINE_WIDTH)
+        label = '  ' * depth + span['name'] + (' (error)' if span['error'] else '')
+        rows.append((label, bar, span['duration_ms']))
+
+        for child in children.get(span['span_id'], []):
+            add_rows(child, depth + 1, root)
+
+    for root in children.get(None, []):
+        add_rows(root, 0, root)
+
+    if not rows:
+        return ''
+
+    label_width = max(len(label) for label, _, _ in rows)
+
+    return '\n'.join(f'{label.ljust(label_width)} |{bar}| {duration_ms:.1f}ms' for label, bar, duration_ms in rows)
+
+
+def retrieve_trace(deployment_id: str, request: flask.Request) -> Dict[str, Any]:
+    """Retrieve the spans of a traced deployment along with their timeline.
+
+    The spans of the most recent attempt are retrieved unless the user passes a URL param of `attempt`.
+    """
+    attempt = request.args.get('attempt')
+    exporter = JsonLinesExporter(Config.traces_path)
+
+    try:
+        attempt_number = int(attempt) if attempt is not None else None
+    except ValueError:
+        raise InvalidRequestError(f'Invalid attempt: {attempt}')
+    if attempt_number is not None and attempt_number < 1:
+        raise InvalidRequestError(f'Invalid attempt: {attempt}')
+
+    if attempt_number is None:
+        traced_attempts = exporter.attempts(deployment_id)
+        attempt_number = traced_attempts[-1] if traced_attempts else None
+
+    spans = exporter.load(get_trace_id(deployment_id, attempt_number)) if attempt_number is not None else []
+
+    return {
+        'attempt': attempt_number,
+        'spans': spans,
+        'timeline': render_timeline(spans),
+    }
+
+
+TRACER = Tracer(JsonLinesExporter(Config.traces_path) if Config.trace_exporter == 'jsonl' else None)
@@ -1,6 +1,16 @@
+import base64
+import binascii
+import json
+from typing import (
+    Any,
+    List,
+    Optional,
+)
+
 import flask
 
 from harvey.config import Config
+from harvey.errors import InvalidRequestError
 
 
 def get_page_size(request: flask.Request) -> int:
@@ -10,3 +20,28 @@ def get_page_size(request: flask.Request) -> int:
         if request.args.get('page_size')
         else Config.pagination_limit
     )
+
+
+def get_cursor(request: flask.Request) -> Optional[List[Any]]:
+    """Return the decoded pagination cursor of the request (the `timestamp` and `id` of the last deployment of the
+    previous page), if any.
+    """
+    cursor = request.args.get('cursor')
+
+    if not cursor:
+        return None
+
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (binascii.Error, ValueError):
+        values = None
+
+    if not (isinstance(values, list) and len(values) == 2 and all(isinstance(value, str) for value in values)):
+        raise InvalidRequestError(f'Invalid cursor: {cursor}')
+
+    return values
+
+
+def encode_cursor(values: List[Any]) -> str:
+    """Encode the values of the last record of a page into an opaque cursor for the next page."""
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
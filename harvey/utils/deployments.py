@@ -1,6 +1,10 @@
+import time
+from contextlib import contextmanager
 from typing import (
     Any,
     Dict,
+    Iterator,
+    List,
 )
 
 import woodchips
@@ -8,11 +12,17 @@ import woodchips
 from harvey.config import Config
 from harvey.errors import HarveyError
 from harvey.messages import Message
-from harvey.repos.deployments import store_deployment_details
-from harvey.repos.locks import (
-    lookup_project_lock,
-    update_project_lock,
+from harvey.metrics import (
+    DEPLOYMENT_SECONDS,
+    DEPLOYMENT_STAGE_SECONDS,
 )
+from harvey.repos.deployments import (
+    append_deployment_log,
+    store_deployment_details,
+    store_deployment_timings,
+)
+from harvey.repos.locks import release_project_lock
+from harvey.tracing import TRACER
 from harvey.webhooks import Webhook
 
 
@@ -30,9 +40,7 @@ def kill_deployment(message: str, webhook: Dict[str, Any]):
         logger.error(deployment_logs)
 
     # Only unlock deployments that were locked by the system and not a user to preserve their preferences
-    deployment_lock = lookup_project_lock(project_name=Webhook.repo_full_name(webhook))
-    if deployment_lock.get('system_lock'):
-        update_project_lock(project_name=Webhook.repo_full_name(webhook), locked=False)
+    release_project_lock(Webhook.repo_full_name(webhook))
 
     if Config.use_slack:
         Message.send_slack_message(error_message)
@@ -50,7 +58,8 @@ def succeed_deployment(message: str, webhook: Dict[str, Any]):
     deployment_logs = success_message + '\n' + message
     store_deployment_details(webhook, _strip_emojis_from_logs(deployment_logs))
 
-    update_project_lock(project_name=Webhook.repo_full_name(webhook), locked=False)
+    # Only unlock deployments that were locked by the system and not a user to preserve their preferences
+    release_project_lock(Webhook.repo_full_name(webhook))
 
     if Config.use_slack:
         Message.send_slack_message(success_message)
@@ -65,3 +74,76 @@ def _strip_emojis_from_logs(output: str) -> str:
     )
 
     return logs_without_emoji
+
+
+class LiveLog:
+    """Collects the output of a running command and appends it to the live log of a deployment in small batches
+    so that it can be followed while running without costing a database write per line of output.
+    """
+
+    flush_interval_seconds = 0.5
+    max_buffered_lines = 100
+
+    def __init__(self, webhook: Dict[str, Any]):
+        self.webhook = webhook
+        self._lines: List[str] = []
+        self._last_flush = time.monotonic()
+
+    def write(self, output: str):
+        """Buffer a line of output, flushing the buffer if it's full or hasn't been flushed for a while."""
+        self._lines.append(output)
+
+        if (
+            len(self._lines) >= self.max_buffered_lines
+            or time.monotonic() - self._last_flush >= self.flush_interval_seconds
+        ):
+            self.flush()
+
+    def flush(self):
+        """Append the buffered output to the deployment's live log."""
+        if self._lines:
+            append_deployment_log(self.webhook, ''.join(self._lines))
+            self._lines = []
+
+        self._last_flush = time.monotonic()
+
+
+class DeploymentTimer:
+    """Times the stages of a deployment with a monotonic clock so they can be stored as numbers rather than only
+    as text in the deployment's log.
+    """
+
+    def __init__(self):
+        self.start_time = time.monotonic()
+        self.timings: Dict[str, float] = {}
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        """Time a stage (and trace it), it's recorded even if the stage fails."""
+        start_time = time.monotonic()
+        try:
+            with TRACER.span(f'stage.{name}'):
+                yield
+        finally:
+            self.record(name, time.monotonic() - start_time)
+
+    def record(self, name: str, seconds: float):
+        """Record how long a stage took."""
+        self.timings[name] = round(seconds * 1000, 1)
+
+    def store(self, webhook: Dict[str, Any]):
+        """Record the total time since the timer started and store every timing on the deployment's current
+        attempt, they are also reported via the `/metrics` endpoint.
+        """
+        self.record('total', time.monotonic() - self.start_time)
+
+        for stage, milliseconds in self.timings.items():
+            if stage == 'total':
+                DEPLOYMENT_SECONDS.observe(milliseconds / 1000, project=Webhook.repo_full_name(webhook))
+            else:
+                DEPLOYMENT_STAGE_SECONDS.observe(milliseconds / 1000, stage=stage)
+
+        try:
+            store_deployment_timings(webhook, self.timings)
+        except Exception as error:
+            woodchips.get(Config.logger_name).warning(f'Could not store the timings of the deployment: {error}')
@@ -1,10 +1,18 @@
 import datetime
-import subprocess  # nosec
-from typing import List
+from typing import (
+    Callable,
+    List,
+    Optional,
+)
 
 import woodchips
 
 from harvey.config import Config
+from harvey.executors import (
+    EXECUTOR,
+    get_command_name,
+)
+from harvey.metrics import SUBPROCESS_SECONDS
 
 
 def format_project_name(project_name: str) -> str:
@@ -30,14 +38,33 @@ def get_utc_timestamp():
     return datetime.datetime.now(datetime.timezone.utc)
 
 
+def format_unix_timestamp(timestamp: Optional[float]) -> Optional[str]:
+    """Format a Unix timestamp the same way UTC timestamps are formatted throughout Harvey."""
+    if timestamp is None:
+        return None
+
+    return str(datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc))
+
+
 def run_subprocess_command(command: List[str]) -> str:
-    """Runs a shell command via subprocess."""
-    command_output = subprocess.check_output(  # nosec
-        command,
-        stderr=subprocess.STDOUT,
-        text=True,
-        encoding='utf8',
-        timeout=Config.operation_timeout,
-    )
+    """Runs a shell command via the executor (see `harvey.executors`)."""
+    with SUBPROCESS_SECONDS.time(command=get_command_name(command)):
+        command_output = EXECUTOR.run(command)
 
     return command_output
+
+
+def stream_subprocess_command(
+    command: List[str],
+    output_callback: Callable[[str], None],
+    pid_callback: Optional[Callable[[int], None]] = None,
+):
+    """Runs a shell command via the executor (see `harvey.executors`), passing its output to `output_callback` line
+    by line as it's produced instead of buffering it in memory until the command finishes. `pid_callback` is called
+    with the PID of the command once it started.
+
+    Raises the same exceptions as `run_subprocess_command` on timeout or failure, their `output` will be empty
+    since it has already been handed to the callback.
+    """
+    with SUBPROCESS_SECONDS.time(command=get_command_name(command)):
+        EXECUTOR.stream(command, output_callback, pid_callback=pid_callback)
@@ -60,6 +60,13 @@ class Webhook:
         """Return the repo's ID from the webhook JSON."""
         return str(webhook['commits'][0]['id'])
 
+    @staticmethod
+    def repo_head_commit_id(webhook: Dict[str, Any]) -> str:
+        """Return the commit the push moved the ref to, `commits` starts with the oldest commit of the push."""
+        head_commit = webhook.get('head_commit') or {}
+
+        return str(webhook.get('after') or head_commit.get('id') or Webhook.repo_commit_id(webhook))
+
     @staticmethod
     def repo_commit_message(webhook: Dict[str, Any]) -> str:
         """Return the repo's commit message from the webhook JSON."""
@@ -69,3 +76,8 @@ class Webhook:
     def deployment_id(webhook: Dict[str, Any]) -> str:
         """Return the deployment ID used for the SQLite stores."""
         return f'{format_project_name(Webhook.repo_full_name(webhook))}@{Webhook.repo_commit_id(webhook)}'
+
+    @staticmethod
+    def deployment_slug(webhook: Dict[str, Any]) -> str:
+        """Return the deployment ID used by the API (eg: `username-repo_name-commit_id`)."""
+        return f'{format_project_name(Webhook.repo_full_name(webhook))}-{Webhook.repo_commit_id(webhook)}'
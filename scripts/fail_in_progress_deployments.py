@@ -1,25 +1,25 @@
-from sqlitedict import SqliteDict  # type: ignore
+from harvey.repos.database import transaction
 
-from harvey.config import Config
 
-
-# This script will change "in-progress" deployments to "failed" if they get stuck
-
-DATABASE_LOCATION = Config.database_file
-DEPLOYMENTS_TABLE_NAME = 'deployments'
+# This script will change "in-progress" deployments to "failed" if they get stuck and release the locks they held
 
 
 def main():
-    with SqliteDict(filename=DATABASE_LOCATION, tablename=DEPLOYMENTS_TABLE_NAME) as deployments_table:
-        for key, data in deployments_table.items():
-            for index, attempt in enumerate(data.get('attempts', [])):
-                if deployments_table[key]['attempts'][index]['status'] == 'In-Progress':
-                    # sqlitedict doesn't know about dictionaries in memory, must be assigned back
-                    data['attempts'][index]['status'] = 'Failure'
-                    deployments_table[key] = data
-                    print(f'{key} status updated from "In-Progress" to "Failure"!')
-
-        deployments_table.commit()
+    with transaction() as connection:
+        stuck_deployments = connection.execute(
+            "SELECT deployment_id, attempt FROM deployment_attempts WHERE status = 'In-Progress'"
+        ).fetchall()
+
+        for deployment in stuck_deployments:
+            connection.execute(
+                "UPDATE deployment_attempts SET status = 'Failure' WHERE deployment_id = ? AND attempt = ?",
+                (deployment['deployment_id'], deployment['attempt']),
+            )
+            print(f'{deployment["deployment_id"]} status updated from "In-Progress" to "Failure"!')
+
+        connection.execute("UPDATE deployments SET status = 'Failure' WHERE status = 'In-Progress'")
+        # Queued deployments wait for system locks to be released, release those held by the stuck deployments
+        connection.execute('UPDATE locks SET locked = 0, system_lock = NULL WHERE locked = 1 AND system_lock = 1')
 
     print('All "In-Progress" deployments have been changed to "Failure".')
 
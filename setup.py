@@ -23,7 +23,6 @@ REQUIREMENTS = [
     'requests_unixsocket == 0.3.*',
     'sentry-sdk == 2.*',
     'slack_sdk == 3.*',
-    'sqlitedict == 2.1.*',
     'uwsgi == 2.0.27',
     'woodchips == 1.*',
 ]
@@ -64,6 +63,11 @@ setuptools.setup(
         "License :: OSI Approved :: MIT License",
         "Operating System :: OS Independent",
     ],
+    entry_points={
+        'console_scripts': [
+            'harvey-runner=harvey.runner:main',
+        ]
+    },
     install_requires=REQUIREMENTS,
     extras_require={
         'dev': DEV_REQUIREMENTS,
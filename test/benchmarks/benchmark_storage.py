@@ -0,0 +1,302 @@
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import resource
+import sqlite3
+import sys
+import tempfile
+import time
+import tracemalloc
+import types
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    List,
+)
+
+from harvey.config import Config
+from harvey.repos.database import (
+    close_pools,
+    compress_log,
+    transaction,
+)
+from harvey.repos.deployments import (
+    retrieve_deployment,
+    retrieve_deployments,
+    store_deployment_details,
+)
+from harvey.repos.locks import (
+    lookup_project_lock,
+    retrieve_locks,
+)
+from harvey.repos.webhooks import retrieve_webhook
+
+
+# USAGE: venv/bin/python test/benchmarks/benchmark_storage.py --deployments 100k
+#
+# Generates a synthetic Harvey database of the given size, times the storage functions the API and deployments rely
+# on, and writes their latency percentiles and peak memory to a JSON file (`--output`) so runs can be compared.
+
+BATCH_SIZE = 10000
+LOG_VARIANTS = 256
+START_DATE = datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+def parse_count(value: str) -> int:
+    """Parse counts such as `1000`, `100k`, or `1M`."""
+    multipliers = {'k': 1000, 'm': 1000000}
+    suffix = value[-1].lower()
+
+    return int(float(value[:-1]) * multipliers[suffix]) if suffix in multipliers else int(value)
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Benchmark the Harvey storage layer against a synthetic database.')
+    parser.add_argument('--deployments', type=parse_count, default=1000, help='eg: 1k, 100k, 1M (default: 1k)')
+    parser.add_argument('--projects', type=parse_count, default=200, help='projects deployments are spread across')
+    parser.add_argument('--locks', type=parse_count, default=2000)
+    parser.add_argument('--webhooks', type=parse_count, default=2000)
+    parser.add_argument('--log-size', type=int, default=4096, help='approximate size of each log in bytes')
+    parser.add_argument('--iterations', type=int, default=200, help='timed calls of each benchmark')
+    parser.add_argument('--memory-iterations', type=int, default=20, help='calls traced to measure peak memory')
+    parser.add_argument(
+        '--database',
+        help='database file to use and keep, generated if it does not exist (default: a temporary database)',
+    )
+    parser.add_argument('--output', default='benchmark-storage.json', help='file the results are written to')
+    parser.add_argument('--seed', type=int, default=50)
+
+    return parser.parse_args()
+
+
+def project_name(index: int) -> str:
+    return f'benchmark_user-project-{index}'
+
+
+def commit_id(index: int) -> str:
+    return f'{index:040x}'
+
+
+def mock_webhook(project_index: int, commit: str) -> Dict[str, Any]:
+    """A push webhook similar to the ones GitHub sends (a few KB of JSON)."""
+    return {
+        'ref': 'refs/heads/main',
+        'repository': {
+            'name': f'project-{project_index}',
+            'full_name': f'benchmark_user/project-{project_index}',
+            'html_url': f'https://github.com/benchmark_user/project-{project_index}',
+            'ssh_url': f'git@github.com:benchmark_user/project-{project_index}.git',
+            'owner': {'name': 'benchmark_user'},
+            'description': 'A project deployed by Harvey. ' * 10,
+        },
+        'commits': [
+            {
+                'id': commit,
+                'author': {'name': 'benchmark_user', 'email': 'benchmark@example.com'},
+                'message': 'Update the project\n\n' + 'Details of the change. ' * 20,
+                'added': [f'src/file_{index}.py' for index in range(10)],
+                'modified': [f'src/module_{index}.py' for index in range(20)],
+                'removed': [],
+            }
+        ],
+    }
+
+
+def mock_log(rng: random.Random, log_size: int) -> str:
+    """A deployment log made of the preamble Harvey writes followed by `docker compose` build output."""
+    lines = [
+        'Success! `benchmark_user/project` deployment succeeded!',
+        'benchmark_user/project Deploy',
+        f'Harvey: v{Config.harvey_version}',
+        f'Deployment Started: {START_DATE}',
+        '',
+        'Command output:',
+    ]
+    step = 1
+    while sum(len(line) + 1 for line in lines) < log_size:
+        lines.append(f'#{step} [api {step}/20] RUN pip install -r requirements.txt')
+        lines.append(f'#{step} sha256:{rng.getrandbits(256):064x} {rng.randint(1, 500)}MB / 500MB done')
+        lines.append(f'#{step} DONE {rng.random() * 30:.1f}s')
+        step += 1
+    lines.append('Deployment execution time: 0:01:23.456789')
+
+    return '\n'.join(lines)
+
+
+def generate_database(args: argparse.Namespace):
+    """Fill the database with deployments (each with a compressed log), locks, and webhooks."""
+    rng = random.Random(args.seed)
+    compressed_logs = [compress_log(mock_log(rng, args.log_size)) for _ in range(LOG_VARIANTS)]
+    statuses = ['Success'] * 8 + ['Failure']
+
+    for batch_start in range(0, args.deployments, BATCH_SIZE):
+        deployments = []
+        attempts = []
+        logs = []
+        for index in range(batch_start, min(batch_start + BATCH_SIZE, args.deployments)):
+            project = project_name(index % args.projects)
+            commit = commit_id(index)
+            deployment_id = f'{project}@{commit}'
+            timestamp = str(START_DATE + datetime.timedelta(minutes=index))
+            status = statuses[index % len(statuses)]
+            deployments.append((deployment_id, f'{project}-{commit}', project, commit, status, timestamp))
+            attempts.append((deployment_id, 1, status, timestamp, '0:01:23.456789'))
+            logs.append((deployment_id, 1, compressed_logs[index % LOG_VARIANTS]))
+
+        with transaction() as connection:
+            connection.executemany(
+                'INSERT INTO deployments (id, slug, project, commit_id, status, timestamp) VALUES (?, ?, ?, ?, ?, ?)',
+                deployments,
+            )
+            connection.executemany(
+                'INSERT INTO deployment_attempts (deployment_id, attempt, status, timestamp, runtime)'
+                ' VALUES (?, ?, ?, ?, ?)',
+                attempts,
+            )
+            connection.executemany('INSERT INTO deployment_logs (deployment_id, attempt, log) VALUES (?, ?, ?)', logs)
+
+    with transaction() as connection:
+        connection.executemany(
+            'INSERT INTO locks (project, locked, system_lock) VALUES (?, ?, ?)',
+            [(project_name(index), index % 10 == 0, 1 if index % 10 == 0 else None) for index in range(args.locks)],
+        )
+        connection.executemany(
+            'INSERT INTO webhooks (project, webhook) VALUES (?, ?)',
+            [
+                (project_name(index), json.dumps(mock_webhook(index, commit_id(index))))
+                for index in range(args.webhooks)
+            ],
+        )
+
+
+def mock_request(**args) -> Any:
+    """A stand-in for the Flask request the API passes to the storage functions."""
+    return types.SimpleNamespace(args=args)
+
+
+def benchmarks(args: argparse.Namespace) -> Dict[str, Callable[[random.Random], Any]]:
+    """The storage operations to time, each picks the records it reads at random."""
+    next_commit = [args.deployments]
+
+    def store_deployment(rng: random.Random):
+        project_index = rng.randrange(args.projects)
+        webhook = mock_webhook(project_index, commit_id(next_commit[0]))
+        next_commit[0] += 1
+        store_deployment_details(webhook)
+        store_deployment_details(webhook, mock_log(rng, args.log_size))
+
+    def deployment_slug(rng: random.Random) -> str:
+        index = rng.randrange(args.deployments)
+        return f'{project_name(index % args.projects)}-{commit_id(index)}'
+
+    return {
+        'retrieve_deployment': lambda rng: retrieve_deployment(deployment_slug(rng)),
+        'retrieve_deployments': lambda rng: retrieve_deployments(mock_request()),
+        'retrieve_deployments_project': lambda rng: retrieve_deployments(
+            mock_request(project=project_name(rng.randrange(args.projects)))
+        ),
+        'retrieve_locks': lambda rng: retrieve_locks(mock_request()),
+        'lookup_project_lock': lambda rng: lookup_project_lock(project_name(rng.randrange(args.locks))),
+        'retrieve_webhook': lambda rng: retrieve_webhook(project_name(rng.randrange(args.webhooks))),
+        'store_deployment_details': store_deployment,
+    }
+
+
+def percentile(sorted_values: List[float], percent: float) -> float:
+    """Return the nearest-rank percentile of sorted values."""
+    index = max(0, min(len(sorted_values) - 1, int(round(percent / 100 * len(sorted_values))) - 1))
+
+    return sorted_values[index]
+
+
+def run_benchmark(function: Callable[[random.Random], Any], args: argparse.Namespace) -> Dict[str, Any]:
+    rng = random.Random(args.seed)
+    durations = []
+
+    for _ in range(args.iterations):
+        start_time = time.perf_counter()
+        function(rng)
+        durations.append((time.perf_counter() - start_time) * 1000)
+
+    # Memory is measured separately since tracing allocations slows every call down
+    tracemalloc.start()
+    for _ in range(args.memory_iterations):
+        function(rng)
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    durations.sort()
+
+    return {
+        'iterations': args.iterations,
+        'mean_ms': round(sum(durations) / len(durations), 4),
+        'p50_ms': round(percentile(durations, 50), 4),
+        'p90_ms': round(percentile(durations, 90), 4),
+        'p99_ms': round(percentile(durations, 99), 4),
+        'max_ms': round(durations[-1], 4),
+        'peak_memory_bytes': peak_memory,
+    }
+
+
+def run_benchmarks(args: argparse.Namespace, database_file: str) -> Dict[str, Any]:
+    """Run the benchmarks against a database, generating it first if it doesn't exist, and return their report."""
+    Config.database_file = database_file
+    generate = not os.path.exists(database_file)
+
+    generation_seconds = None
+    if generate:
+        print(f'Generating a database of {args.deployments} deployments at {database_file}...')
+        start_time = time.perf_counter()
+        generate_database(args)
+        generation_seconds = round(time.perf_counter() - start_time, 3)
+
+    results = {}
+    for name, function in benchmarks(args).items():
+        print(f'Running {name}...')
+        results[name] = run_benchmark(function, args)
+        print(f'  p50 {results[name]["p50_ms"]}ms, p99 {results[name]["p99_ms"]}ms')
+
+    close_pools()
+
+    return {
+        'timestamp': str(datetime.datetime.now(datetime.timezone.utc)),
+        'parameters': {key: value for key, value in vars(args).items() if key != 'output'},
+        'environment': {
+            'python': sys.version.split()[0],
+            'sqlite': sqlite3.sqlite_version,
+            'platform': platform.platform(),
+        },
+        'database': {
+            # Generated databases are removed once the benchmarks ran, only a database passed via `--database` is kept
+            'file': args.database,
+            'size_bytes': os.path.getsize(database_file),
+            'generated': generate,
+            'generation_seconds': generation_seconds,
+        },
+        # `ru_maxrss` is in kilobytes on Linux and bytes on macOS
+        'max_rss_bytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024),
+        'results': results,
+    }
+
+
+def main():
+    args = parse_args()
+
+    if args.database:
+        report = run_benchmarks(args, args.database)
+    else:
+        with tempfile.TemporaryDirectory(prefix='harvey-benchmark-') as database_path:
+            report = run_benchmarks(args, os.path.join(database_path, 'database.sqlite'))
+
+    with open(args.output, 'w') as output_file:
+        json.dump(report, output_file, indent=4)
+
+    print(f'Results written to {args.output}')
+
+
+if __name__ == '__main__':
+    main()
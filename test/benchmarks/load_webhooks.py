@@ -0,0 +1,311 @@
+import argparse
+import datetime
+import hashlib
+import hmac
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess  # nosec
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import (
+    Any,
+    Dict,
+    List,
+    Optional,
+)
+
+
+# USAGE: venv/bin/python test/benchmarks/load_webhooks.py --webhooks 500 --rate 50
+#
+# Replays synthetic GitHub push webhooks against the `/deploy` endpoint of an in-process Harvey at a fixed rate.
+# `git` and `docker` are replaced by the fakes in `fake_bin/` which simulate latency and failures without a network
+# or Docker daemon. Reports how long webhooks took to be accepted, how long deployments waited to start after being
+# accepted, and how long they took end-to-end along with the thread count and RSS of the process over time.
+#
+# Set `EXECUTOR=replay` and `EXECUTOR_RECORDING` to replay the commands of a recording instead of the fakes.
+
+FAKE_BIN_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fake_bin')
+WEBHOOK_SECRET = 'harvey-load-test'
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Load test Harvey with synthetic webhooks and fake git and Docker.')
+    parser.add_argument('--webhooks', type=int, default=200, help='webhooks to send')
+    parser.add_argument('--rate', type=float, default=20.0, help='webhooks sent per second, 0 sends them all at once')
+    parser.add_argument('--projects', type=int, default=50, help='projects the pushes are spread across')
+    parser.add_argument('--clients', type=int, default=32, help='webhooks that can be in flight at once')
+    parser.add_argument('--max-concurrent-deployments', type=int, default=4)
+    parser.add_argument('--git-latency', type=float, default=0.5, help='seconds each fetch takes (+/- 50%%)')
+    parser.add_argument('--git-failure-rate', type=float, default=0.0, help='share of fetches that fail')
+    parser.add_argument('--compose-latency', type=float, default=2.0, help='seconds compose builds and ups take')
+    parser.add_argument('--compose-failure-rate', type=float, default=0.0, help='share of compose commands that fail')
+    parser.add_argument('--sample-interval', type=float, default=0.5, help='seconds between thread and RSS samples')
+    parser.add_argument('--timeout', type=float, default=600.0, help='seconds to wait for the deployments to finish')
+    parser.add_argument('--log-level', default='CRITICAL', help="Harvey's log level, simulated failures log errors")
+    parser.add_argument('--output', default='benchmark-webhooks.json', help='file the results are written to')
+    parser.add_argument('--seed', type=int, default=50)
+
+    return parser.parse_args()
+
+
+def configure_environment(args: argparse.Namespace, harvey_path: str):
+    """Point Harvey at a temporary `HARVEY_PATH` and the fake executables, must run before Harvey is imported since
+    its config is read on import.
+    """
+    os.environ.update(
+        {
+            'PATH': f'{FAKE_BIN_PATH}{os.pathsep}{os.environ.get("PATH", "")}',
+            'HARVEY_PATH': harvey_path,
+            'WEBHOOK_SECRET': WEBHOOK_SECRET,
+            'MAX_CONCURRENT_DEPLOYMENTS': str(args.max_concurrent_deployments),
+            'LOG_LEVEL': args.log_level,
+            'USE_SLACK': '',
+            'SENTRY_URL': '',
+            'EXTERNAL_RUNNER': '',
+            'TRACE_EXPORTER': '',
+            'HARVEY_FAKE_GIT_REMOTE': os.path.join(harvey_path, 'fake_remote'),
+            'HARVEY_FAKE_GIT_LATENCY_SECONDS': str(args.git_latency),
+            'HARVEY_FAKE_GIT_FAILURE_RATE': str(args.git_failure_rate),
+            'HARVEY_FAKE_COMPOSE_LATENCY_SECONDS': str(args.compose_latency),
+            'HARVEY_FAKE_COMPOSE_FAILURE_RATE': str(args.compose_failure_rate),
+            'HARVEY_FAKE_DOCKER_STATE': os.path.join(harvey_path, 'fake_docker'),
+        }
+    )
+
+
+def mock_webhook(project_index: int, commit: str) -> Dict[str, Any]:
+    """A push webhook similar to the ones GitHub sends."""
+    return {
+        'ref': 'refs/heads/main',
+        'after': commit,
+        'repository': {
+            'name': f'project-{project_index}',
+            'full_name': f'load_test/project-{project_index}',
+            'html_url': f'https://github.com/load_test/project-{project_index}',
+            'ssh_url': f'git@github.com:load_test/project-{project_index}.git',
+            'owner': {'name': 'load_test'},
+        },
+        'commits': [
+            {
+                'id': commit,
+                'author': {'name': 'load_test'},
+                'message': 'Update the project',
+            }
+        ],
+    }
+
+
+def push_commit(project_index: int, commit: str):
+    """Add a commit to the fake remote of a project so the fake `git` can fetch it."""
+    remote_path = os.path.join(os.environ['HARVEY_FAKE_GIT_REMOTE'], 'load_test', f'project-{project_index}')
+    os.makedirs(os.path.dirname(remote_path), exist_ok=True)
+
+    with open(remote_path, 'a') as remote_file:
+        remote_file.write(f'{commit}\n')
+
+
+def check_out_projects(projects: int):
+    """Check the projects out up front, needed when replaying a recording (`EXECUTOR=replay`) since replayed
+    commands don't touch the filesystem.
+    """
+    for project_index in range(projects):
+        project_path = os.path.join(os.environ['HARVEY_PATH'], 'projects', 'load_test', f'project-{project_index}')
+        subprocess.check_call([os.path.join(FAKE_BIN_PATH, 'git'), '-C', project_path, 'checkout', 'initial'])  # nosec
+
+
+def current_rss_bytes() -> int:
+    """Return the resident set size of the process, its peak if the current one can't be read (eg: on macOS)."""
+    try:
+        with open('/proc/self/status', 'r') as status_file:
+            for line in status_file:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except FileNotFoundError:
+        pass
+
+    # `ru_maxrss` is in kilobytes on Linux and bytes on macOS
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+
+
+def percentile(sorted_values: List[float], percent: float) -> float:
+    """Return the nearest-rank percentile of sorted values."""
+    index = max(0, min(len(sorted_values) - 1, int(round(percent / 100 * len(sorted_values))) - 1))
+
+    return sorted_values[index]
+
+
+def summarize(values: List[float]) -> Optional[Dict[str, float]]:
+    """Return the count, mean, and percentiles of durations in seconds."""
+    if not values:
+        return None
+
+    values = sorted(values)
+
+    return {
+        'count': len(values),
+        'mean_seconds': round(sum(values) / len(values), 4),
+        'p50_seconds': round(percentile(values, 50), 4),
+        'p90_seconds': round(percentile(values, 90), 4),
+        'p99_seconds': round(percentile(values, 99), 4),
+        'max_seconds': round(values[-1], 4),
+    }
+
+
+def run_load_test(args: argparse.Namespace, harvey_path: str) -> Dict[str, Any]:
+    """Send the webhooks to a Harvey whose files live under `harvey_path` and return the report of the load test."""
+    rng = random.Random(args.seed)
+    configure_environment(args, harvey_path)
+
+    # Harvey is imported once the environment is set up since its config is read (and the app bootstrapped) on import
+    from harvey.app import APP
+    from harvey.deployments import Deployment
+    from harvey.repos.database import (
+        close_pools,
+        connect,
+    )
+    from harvey.repos.jobs import count_jobs
+    from harvey.scheduler import SCHEDULER
+    from harvey.webhooks import Webhook
+
+    lock = threading.Lock()
+    sent_at: Dict[str, float] = {}
+    queue_waits: List[float] = []
+    finished_at: Dict[str, float] = {}
+    accept_latencies: List[float] = []
+    status_codes: Dict[str, int] = {}
+
+    run_deployment = Deployment.run_deployment
+
+    def timed_run_deployment(webhook: Dict[str, Any], queue_wait_seconds: Optional[float] = None):
+        deployment_id = Webhook.deployment_id(webhook)
+        # The time from a webhook's job being queued (as soon as it's accepted) to its deployment starting
+        if queue_wait_seconds is not None:
+            with lock:
+                queue_waits.append(queue_wait_seconds)
+        try:
+            run_deployment(webhook, queue_wait_seconds=queue_wait_seconds)
+        finally:
+            finished_at[deployment_id] = time.monotonic()
+
+    Deployment.run_deployment = staticmethod(timed_run_deployment)  # type: ignore
+
+    def send_webhook(webhook: Dict[str, Any]):
+        deployment_id = Webhook.deployment_id(webhook)
+        payload = json.dumps(webhook).encode()
+        signature = hmac.new(WEBHOOK_SECRET.encode(), payload, hashlib.sha256).hexdigest()
+
+        start_time = time.monotonic()
+        with lock:
+            sent_at[deployment_id] = start_time
+        response = APP.test_client().post(
+            '/deploy',
+            data=payload,
+            headers={'Content-Type': 'application/json', 'X-Hub-Signature-256': f'sha256={signature}'},
+        )
+        end_time = time.monotonic()
+
+        with lock:
+            accept_latencies.append(end_time - start_time)
+            status_codes[str(response.status_code)] = status_codes.get(str(response.status_code), 0) + 1
+
+    samples: List[Dict[str, Any]] = []
+    load_start_time = time.monotonic()
+    sampling = threading.Event()
+
+    def sample():
+        while not sampling.is_set():
+            samples.append(
+                {
+                    'elapsed_seconds': round(time.monotonic() - load_start_time, 3),
+                    'threads': threading.active_count(),
+                    'rss_bytes': current_rss_bytes(),
+                    'queued': count_jobs('queued'),
+                    'running': count_jobs('running'),
+                }
+            )
+            sampling.wait(timeout=args.sample_interval)
+
+    sampler = threading.Thread(name='load-sampler', target=sample, daemon=True)
+    sampler.start()
+
+    if os.getenv('EXECUTOR') == 'replay':
+        check_out_projects(args.projects)
+
+    print(f'Sending {args.webhooks} webhooks for {args.projects} projects at {args.rate or "max"} webhooks/s...')
+    with ThreadPoolExecutor(max_workers=args.clients, thread_name_prefix='load-client') as executor:
+        for index in range(args.webhooks):
+            if args.rate:
+                # Webhooks are sent on a fixed schedule regardless of how long previous ones took (open loop)
+                time.sleep(max(0.0, load_start_time + index / args.rate - time.monotonic()))
+            project_index = rng.randrange(args.projects)
+            commit = hashlib.sha1(f'{args.seed}-{index}'.encode()).hexdigest()  # nosec
+            push_commit(project_index, commit)
+            executor.submit(send_webhook, mock_webhook(project_index, commit))
+    send_seconds = time.monotonic() - load_start_time
+
+    print('Waiting for the deployments to finish...')
+    deadline = time.monotonic() + args.timeout
+    while time.monotonic() < deadline and count_jobs('queued') + count_jobs('running') > 0:
+        time.sleep(args.sample_interval)
+    timed_out = count_jobs('queued') + count_jobs('running') > 0
+    total_seconds = time.monotonic() - load_start_time
+
+    sampling.set()
+    sampler.join()
+    SCHEDULER.stop(timeout=args.compose_latency * 3 + 10)
+
+    with connect() as connection:
+        deployment_statuses = dict(
+            connection.execute('SELECT status, COUNT(*) FROM deployments GROUP BY status').fetchall()
+        )
+    close_pools()
+
+    return {
+        'timestamp': str(datetime.datetime.now(datetime.timezone.utc)),
+        'parameters': {key: value for key, value in vars(args).items() if key != 'output'},
+        'environment': {
+            'python': sys.version.split()[0],
+            'platform': platform.platform(),
+        },
+        'send_seconds': round(send_seconds, 3),
+        'total_seconds': round(total_seconds, 3),
+        'timed_out': timed_out,
+        'webhook_status_codes': status_codes,
+        'deployment_statuses': deployment_statuses,
+        'accept_latency': summarize(accept_latencies),
+        'accept_to_start': summarize(queue_waits),
+        'end_to_end': summarize([finished_at[key] - sent_at[key] for key in finished_at if key in sent_at]),
+        'max_threads': max(sample['threads'] for sample in samples),
+        'max_rss_bytes': max(sample['rss_bytes'] for sample in samples),
+        'samples': samples,
+    }
+
+
+def main():
+    args = parse_args()
+
+    harvey_path = tempfile.mkdtemp(prefix='harvey-load-')
+    try:
+        report = run_load_test(args, harvey_path)
+    finally:
+        shutil.rmtree(harvey_path, ignore_errors=True)
+
+    with open(args.output, 'w') as output_file:
+        json.dump(report, output_file, indent=4)
+
+    for name in ['accept_latency', 'accept_to_start', 'end_to_end']:
+        if report[name]:
+            print(f'{name}: p50 {report[name]["p50_seconds"]}s, p99 {report[name]["p99_seconds"]}s')
+    print(f'Deployments: {report["deployment_statuses"]}, max threads: {report["max_threads"]}')
+    print(f'Results written to {args.output}')
+
+
+if __name__ == '__main__':
+    main()
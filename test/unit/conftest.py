@@ -1,8 +1,25 @@
-from unittest.mock import MagicMock
+from unittest.mock import (
+    MagicMock,
+    patch,
+)
 
 import pytest
 
-import harvey.app as app
+from harvey.repos.database import close_pools
+
+
+# Importing the app bootstraps Harvey, which would otherwise start running the deployments queued in the real database
+with patch('harvey.config.Config.external_runner', True):
+    import harvey.app as app
+
+
+@pytest.fixture(autouse=True)
+def mock_database(tmp_path):
+    """Run every test against a throwaway database so the test suite never touches a real Harvey database."""
+    with patch('harvey.config.Config.database_file', str(tmp_path / 'database.sqlite')):
+        yield
+
+    close_pools()
 
 
 @pytest.fixture
@@ -0,0 +1,20 @@
+import pickle
+import sqlite3
+from typing import (
+    Any,
+    Dict,
+)
+
+from harvey.config import Config
+
+
+def create_legacy_table(table_name: str, records: Dict[str, Any]):
+    """Create a table the way older versions of Harvey did via `sqlitedict` (pickled values keyed by strings)."""
+    with sqlite3.connect(Config.database_file) as connection:
+        connection.execute(f'CREATE TABLE "{table_name}" (key TEXT PRIMARY KEY, value BLOB)')
+        connection.executemany(
+            f'INSERT INTO "{table_name}" (key, value) VALUES (?, ?)',
+            [(key, pickle.dumps(value)) for key, value in records.items()],
+        )
+
+    connection.close()
@@ -0,0 +1,37 @@
+import threading
+
+from harvey.repos.database import (
+    connect,
+    get_pool,
+    transaction,
+)
+
+
+def test_connections_are_reused():
+    with connect() as connection:
+        first_connection = connection
+
+    with connect() as connection:
+        assert connection is first_connection
+        assert connection.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+
+
+def test_reads_do_not_block_behind_writes():
+    """A reader can borrow a connection and read committed data while another thread holds the write lock."""
+    with transaction() as connection:
+        connection.execute("INSERT INTO webhooks (project, webhook) VALUES ('mock-project', '{}')")
+
+    results = []
+    with transaction() as connection:
+        connection.execute("DELETE FROM webhooks WHERE project = 'mock-project'")
+
+        def read():
+            with connect() as reader:
+                results.append(reader.execute('SELECT COUNT(*) FROM webhooks').fetchone()[0])
+
+        reader_thread = threading.Thread(target=read)
+        reader_thread.start()
+        reader_thread.join(timeout=5)
+
+    assert results == [1]
+    assert get_pool().write_lock.locked() is False
@@ -0,0 +1,229 @@
+import base64
+from test.unit.repos import create_legacy_table
+from unittest.mock import (
+    MagicMock,
+    mock_open,
+    patch,
+)
+
+import pytest
+
+from harvey.errors import (
+    HarveyError,
+    InvalidRequestError,
+)
+from harvey.repos.database import connect
+from harvey.repos.deployments import (
+    append_deployment_log,
+    retrieve_deployment,
+    retrieve_deployment_logs,
+    retrieve_deployments,
+    store_deployment_details,
+    store_deployment_timings,
+    stream_deployment_log,
+)
+from harvey.utils.api_utils import encode_cursor
+
+
+MOCK_DEPLOYMENT_ID = 'test_user-test-repo-name-123456'
+
+
+def mock_request(**args):
+    """A mock Flask request carrying the given URL params."""
+    request = MagicMock()
+    request.args = args
+
+    return request
+
+
+@patch('logging.Logger.debug')
+def test_store_deployment_details(mock_logger, mock_output, mock_webhook):
+    with patch('builtins.open', mock_open()):
+        store_deployment_details(mock_webhook, mock_output)
+
+        mock_logger.assert_called()
+
+
+def test_store_deployment_details_attempts(mock_webhook):
+    """An in-progress deployment starts a new attempt which is then updated once the deployment finishes."""
+    store_deployment_details(mock_webhook)
+    store_deployment_details(mock_webhook, 'Deployment succeeded!\nDeployment execution time: 0:00:01\n\n')
+    store_deployment_details(mock_webhook)
+
+    deployment = retrieve_deployment(MOCK_DEPLOYMENT_ID)
+
+    assert deployment['project'] == 'test_user-test-repo-name'
+    assert deployment['commit'] == '123456'
+    assert [attempt['attempt'] for attempt in deployment['attempts']] == [2, 1]
+    assert deployment['attempts'][0]['status'] == 'In-Progress'
+    assert deployment['attempts'][1]['status'] == 'Success'
+    assert deployment['attempts'][1]['runtime'] == '0:00:01'
+
+
+def test_store_deployment_timings(mock_webhook):
+    """Timings are stored on the current attempt of a deployment."""
+    store_deployment_details(mock_webhook)
+    store_deployment_timings(mock_webhook, {'git': 1500.0, 'total': 2000.5})
+    store_deployment_details(mock_webhook)
+
+    deployment = retrieve_deployment(MOCK_DEPLOYMENT_ID)
+
+    assert deployment['attempts'][0]['timings_ms'] == {}
+    assert deployment['attempts'][1]['timings_ms'] == {'git': 1500.0, 'total': 2000.5}
+
+
+def test_deployment_logs_are_stored_compressed_and_loaded_lazily(mock_webhook):
+    build_output = 'Step 1/10 : FROM python:3.12\n' * 1000
+    store_deployment_details(mock_webhook)
+    store_deployment_details(mock_webhook, f'Deployment succeeded!\n{build_output}')
+
+    with connect() as connection:
+        stored_log = connection.execute('SELECT log FROM deployment_logs').fetchone()['log']
+
+    assert len(stored_log) < len(build_output) / 10
+    assert 'log' not in retrieve_deployments(mock_request())['deployments'][0]['attempts'][0]
+    assert retrieve_deployment(MOCK_DEPLOYMENT_ID)['attempts'][0]['log'] == f'Deployment succeeded!\n{build_output}'
+
+
+def test_retrieve_deployment_logs(mock_webhook):
+    store_deployment_details(mock_webhook, 'mock failure')
+    store_deployment_details(mock_webhook)
+
+    all_logs = retrieve_deployment_logs(MOCK_DEPLOYMENT_ID, mock_request())
+    attempt_logs = retrieve_deployment_logs(MOCK_DEPLOYMENT_ID, mock_request(attempt='1'))
+
+    assert all_logs == {'logs': [{'attempt': 2, 'log': 'NA'}, {'attempt': 1, 'log': 'mock failure'}]}
+    assert attempt_logs == {'logs': [{'attempt': 1, 'log': 'mock failure'}]}
+
+
+@pytest.mark.parametrize('attempt', ['latest', '', '0', '-1'])
+def test_retrieve_deployment_logs_invalid_attempt(attempt, mock_webhook):
+    store_deployment_details(mock_webhook)
+
+    with pytest.raises(InvalidRequestError, match=f'Invalid attempt: {attempt}$'):
+        retrieve_deployment_logs(MOCK_DEPLOYMENT_ID, mock_request(attempt=attempt))
+
+
+def test_retrieve_deployment_not_found():
+    with pytest.raises(HarveyError, match='Could not retrieve deployment details for bad-id!'):
+        retrieve_deployment('bad-id')
+
+
+def test_retrieve_deployments(mock_webhook):
+    other_webhook = {**mock_webhook, 'repository': {**mock_webhook['repository'], 'full_name': 'TEST_user/other'}}
+    store_deployment_details(mock_webhook)
+    store_deployment_details(other_webhook)
+
+    all_deployments = retrieve_deployments(mock_request())
+    project_deployments = retrieve_deployments(mock_request(project='test_user-test-repo-name'))
+
+    assert [deployment['project'] for deployment in all_deployments['deployments']] == [
+        'test_user-other',
+        'test_user-test-repo-name',
+    ]
+    assert all_deployments['total_count'] == 2
+    assert [deployment['project'] for deployment in project_deployments['deployments']] == ['test_user-test-repo-name']
+    assert project_deployments['total_count'] == 1
+
+
+def test_retrieve_deployments_legacy_table():
+    """Deployments stored by older versions of Harvey via `sqlitedict` are migrated to the new schema."""
+    create_legacy_table(
+        'deployments',
+        {
+            'test_user-test-repo-name@123456': {
+                'project': 'test_user-test-repo-name',
+                'commit': '123456',
+                'timestamp': '2023-01-01 00:00:00+00:00',
+                'attempts': [
+                    {'attempt': 1, 'status': 'Success', 'timestamp': '2023-01-01 00:00:00+00:00', 'log': 'mock log'},
+                ],
+            },
+        },
+    )
+
+    deployment = retrieve_deployment(MOCK_DEPLOYMENT_ID)
+
+    assert deployment['attempts'] == [
+        {
+            'attempt': 1,
+            'status': 'Success',
+            'timestamp': '2023-01-01 00:00:00+00:00',
+            'runtime': None,
+            'timings_ms': {},
+            'builds': [],
+            'log': 'mock log',
+        }
+    ]
+
+
+def test_retrieve_deployments_pagination(mock_webhook):
+    """Following `next_cursor` walks through every deployment exactly once, most recent first."""
+    for commit_id in range(5):
+        store_deployment_details({**mock_webhook, 'commits': [{**mock_webhook['commits'][0], 'id': commit_id}]})
+
+    commits = []
+    cursor = None
+    while True:
+        page = retrieve_deployments(mock_request(page_size='2', **({'cursor': cursor} if cursor else {})))
+        commits.extend(deployment['commit'] for deployment in page['deployments'])
+        assert page['total_count'] == 5
+        cursor = page['next_cursor']
+        if not cursor:
+            break
+
+    assert commits == ['4', '3', '2', '1', '0']
+
+
+@pytest.mark.parametrize(
+    'cursor',
+    [
+        'bad-cursor',
+        encode_cursor(['2024-01-01 00:00:00']),
+        encode_cursor(['2024-01-01 00:00:00', 'mock-id', 'mock-extra']),
+        encode_cursor([1, 2]),
+        base64.urlsafe_b64encode(b'{"timestamp": "2024-01-01 00:00:00"}').decode(),
+    ],
+)
+def test_retrieve_deployments_invalid_cursor(cursor):
+    """Cursors that aren't a `timestamp` and `id` pair (eg: tampered with or truncated) are rejected."""
+    with pytest.raises(InvalidRequestError, match='Invalid cursor'):
+        retrieve_deployments(mock_request(cursor=cursor))
+
+
+def test_live_log_is_folded_into_the_log(mock_webhook):
+    """Output streamed while a deployment runs is readable live and kept once the deployment finishes."""
+    store_deployment_details(mock_webhook)
+    append_deployment_log(mock_webhook, 'Building\n')
+
+    assert retrieve_deployment(MOCK_DEPLOYMENT_ID)['attempts'][0]['log'] == 'NA\nCommand output:\nBuilding\n'
+
+    append_deployment_log(mock_webhook, 'Built\n')
+    store_deployment_details(mock_webhook, 'Deployment succeeded!')
+
+    assert retrieve_deployment(MOCK_DEPLOYMENT_ID)['attempts'][0]['log'] == (
+        'Deployment succeeded!\nCommand output:\nBuilding\nBuilt\n'
+    )
+
+
+@patch('harvey.repos.deployments.LIVE_LOG_POLL_INTERVAL_SECONDS', 0)
+def test_stream_deployment_log(mock_webhook):
+    store_deployment_details(mock_webhook)
+    append_deployment_log(mock_webhook, 'Building\n')
+    events = stream_deployment_log(MOCK_DEPLOYMENT_ID)
+
+    assert next(events) == 'event: message\nid: 1\ndata: Building\ndata: \n\n'
+
+    store_deployment_details(mock_webhook, 'Deployment succeeded!')
+
+    assert list(events) == ['event: end\ndata: Success\n\n']
+
+
+def test_stream_deployment_log_finished(mock_webhook):
+    """Streaming a finished deployment sends its complete log at once."""
+    store_deployment_details(mock_webhook, 'mock failure')
+
+    assert list(stream_deployment_log(MOCK_DEPLOYMENT_ID)) == [
+        'event: message\ndata: mock failure\n\n',
+        'event: end\ndata: Failure\n\n',
+    ]
@@ -0,0 +1,118 @@
+import os
+import time
+from unittest.mock import ANY
+
+from harvey.repos.jobs import (
+    claim_job,
+    enqueue_job,
+    finish_job,
+    reclaim_expired_jobs,
+    requeue_job,
+    retrieve_active_deployments,
+    retrieve_jobs,
+    update_job_child_pid,
+    update_job_stage,
+)
+
+
+def mock_job(job_id, project='test_user/test-repo-name', scheduled_for=None):
+    return {
+        'id': job_id,
+        'project': project,
+        'webhook': {'mock': job_id},
+        'enqueued_at': time.time(),
+        'scheduled_for': scheduled_for or time.time(),
+    }
+
+
+def test_enqueue_job_supersedes_queued_job_of_project():
+    """A newer job of a project takes the place of its queued job in the queue."""
+    enqueue_job(mock_job('job-1'))
+    enqueue_job(mock_job('job-2', project='test_user/other-project'))
+    queued_job = enqueue_job(mock_job('job-3'))
+
+    assert queued_job['position'] == 1
+    assert queued_job['superseded_job']['id'] == 'job-1'
+    assert [job['id'] for job in retrieve_jobs()] == ['job-3', 'job-2']
+
+
+def test_claim_job():
+    """Jobs are claimed in order once due, skipping projects that are already being deployed."""
+    enqueue_job(mock_job('job-1', scheduled_for=time.time() + 60))
+    enqueue_job(mock_job('job-2', project='test_user/other-project'))
+
+    job = claim_job('mock-runner', lease_seconds=60)
+
+    assert job['id'] == 'job-2'
+    assert job['runner'] == 'mock-runner'
+    assert claim_job('mock-runner', lease_seconds=60) is None
+
+    enqueue_job(mock_job('job-3', project='test_user/other-project'))
+
+    assert claim_job('mock-runner', lease_seconds=60) is None
+
+    finish_job('job-2', 'mock-runner')
+
+    assert claim_job('mock-runner', lease_seconds=60)['id'] == 'job-3'
+
+
+def test_reclaim_expired_jobs():
+    """A job whose lease expired is taken over by another runner and put back at its place in the queue."""
+    enqueue_job(mock_job('job-1'))
+    claim_job('mock-dead-runner', lease_seconds=-1)
+
+    reclaimed_jobs = reclaim_expired_jobs('mock-runner', lease_seconds=60)
+
+    assert [(job['id'], job['runner']) for job in reclaimed_jobs] == [('job-1', 'mock-dead-runner')]
+    assert reclaim_expired_jobs('mock-runner', lease_seconds=60) == []
+
+    assert requeue_job('job-1', time.time()) is None
+    assert claim_job('mock-runner', lease_seconds=60)['id'] == 'job-1'
+
+
+def test_finish_job_of_another_runner():
+    """A job reclaimed by another runner isn't removed when the runner it was taken from finishes it."""
+    enqueue_job(mock_job('job-1'))
+    claim_job('mock-unresponsive-runner', lease_seconds=-1)
+    reclaim_expired_jobs('mock-runner', lease_seconds=60)
+
+    finish_job('job-1', 'mock-unresponsive-runner')
+
+    assert [job['id'] for job in retrieve_jobs()] == ['job-1']
+
+
+def test_requeue_job_dropped_for_newer_job():
+    enqueue_job(mock_job('job-1'))
+    claim_job('mock-runner', lease_seconds=60)
+    enqueue_job(mock_job('job-2'))
+
+    newer_job = requeue_job('job-1', time.time(), waiting_for_lock=True)
+
+    assert newer_job['id'] == 'job-2'
+    assert [job['id'] for job in retrieve_jobs()] == ['job-2']
+
+
+def test_retrieve_active_deployments(mock_webhook):
+    """Running jobs report the stage and child process their deployment reached."""
+    enqueue_job({**mock_job('job-1'), 'webhook': mock_webhook})
+    enqueue_job(mock_job('job-2', project='test_user/other-project'))
+    claim_job('mock-runner', lease_seconds=60)
+    update_job_stage('test_user/test-repo-name', 'deploy')
+    update_job_child_pid('test_user/test-repo-name', 1234)
+
+    active_deployments = retrieve_active_deployments()
+
+    assert active_deployments['total_count'] == 1
+    assert active_deployments['deployments'][0] == {
+        'deployment_id': 'test_user-test-repo-name-123456',
+        'project': 'test_user/test-repo-name',
+        'commit': '123456',
+        'stage': 'deploy',
+        'started_at': ANY,
+        'stage_started_at': ANY,
+        'elapsed_seconds': ANY,
+        'runner': 'mock-runner',
+        'pid': os.getpid(),
+        'child_pid': 1234,
+        'last_heartbeat_at': ANY,
+    }
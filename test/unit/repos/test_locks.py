@@ -0,0 +1,79 @@
+from concurrent.futures import ThreadPoolExecutor
+from test.unit.repos import create_legacy_table
+from unittest.mock import (
+    MagicMock,
+    patch,
+)
+
+import pytest
+
+from harvey.errors import HarveyError
+from harvey.repos.locks import (
+    acquire_project_lock,
+    lookup_project_lock,
+    release_project_lock,
+    retrieve_locks,
+    update_project_lock,
+)
+
+
+@patch('logging.Logger.info')
+def test_update_project_lock(mock_logger):
+    update_project_lock('TEST_user/TEST-repo-name', locked=True, system_lock=False)
+
+    mock_logger.assert_called_once_with('Locking deployments for TEST_user/TEST-repo-name...')
+    assert lookup_project_lock('TEST_user/TEST-repo-name') == {'locked': True, 'system_lock': False}
+
+    update_project_lock('TEST_user/TEST-repo-name', locked=False)
+
+    assert lookup_project_lock('TEST_user/TEST-repo-name') == {'locked': False, 'system_lock': None}
+
+
+def test_acquire_project_lock():
+    """A lock can only be acquired once until it's released."""
+    assert acquire_project_lock('TEST_user/TEST-repo-name') is True
+    assert acquire_project_lock('TEST_user/TEST-repo-name') is False
+    assert lookup_project_lock('TEST_user/TEST-repo-name') == {'locked': True, 'system_lock': True}
+
+    assert release_project_lock('TEST_user/TEST-repo-name') is True
+    assert acquire_project_lock('TEST_user/TEST-repo-name') is True
+
+
+def test_acquire_project_lock_concurrently():
+    """Only one of many threads racing for the same lock acquires it."""
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        results = list(executor.map(acquire_project_lock, ['TEST_user/TEST-repo-name'] * 8))
+
+    assert results.count(True) == 1
+
+
+def test_release_project_lock_preserves_user_locks():
+    update_project_lock('TEST_user/TEST-repo-name', locked=True, system_lock=False)
+
+    assert release_project_lock('TEST_user/TEST-repo-name') is False
+    assert acquire_project_lock('TEST_user/TEST-repo-name') is False
+    assert lookup_project_lock('TEST_user/TEST-repo-name') == {'locked': True, 'system_lock': False}
+
+
+def test_lookup_project_lock_not_found():
+    with pytest.raises(HarveyError, match='Lock does not exist!'):
+        lookup_project_lock('TEST_user/TEST-repo-name')
+
+
+def test_retrieve_locks():
+    create_legacy_table(
+        'locks',
+        {
+            'test_user-b': {'locked': True, 'system_lock': True},
+            'test_user-a': {'locked': False},
+        },
+    )
+    request = MagicMock()
+    request.args = {'page_size': '1'}
+
+    locks = retrieve_locks(request)
+
+    assert locks == {
+        'locks': [{'project': 'test_user-a', 'locked': False, 'system_lock': None}],
+        'total_count': 2,
+    }
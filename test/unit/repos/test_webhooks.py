@@ -0,0 +1,23 @@
+from test.unit.repos import create_legacy_table
+
+from harvey.repos.webhooks import (
+    retrieve_webhook,
+    update_webhook,
+)
+
+
+def test_update_webhook(mock_webhook):
+    update_webhook('TEST_user/TEST-repo-name', mock_webhook)
+
+    assert retrieve_webhook('TEST_user/TEST-repo-name') == mock_webhook
+
+
+def test_retrieve_webhook_not_found():
+    assert retrieve_webhook('TEST_user/TEST-repo-name') is None
+
+
+def test_retrieve_webhook_legacy_table(mock_webhook):
+    """Webhooks stored by older versions of Harvey via `sqlitedict` are migrated to the new schema."""
+    create_legacy_table('webhooks', {'TEST_user-TEST-repo-name': {'webhook': mock_webhook}})
+
+    assert retrieve_webhook('TEST_user/TEST-repo-name') == mock_webhook
@@ -4,14 +4,18 @@ from unittest.mock import (
 )
 
 from harvey.api import Api
+from harvey.metrics import WEBHOOKS
 
 
 @patch('logging.Logger.info')
-@patch('harvey.deployments.Deployment.run_deployment')
-def test_parse_github_webhook(mock_run_deployment, mock_logger, mock_webhook_object):
+@patch('harvey.scheduler.Scheduler.submit')
+@patch('harvey.prefetcher.Prefetcher.submit')
+def test_parse_github_webhook(mock_prefetch, mock_submit, mock_logger, mock_webhook_object):
     webhook = Api.parse_github_webhook(mock_webhook_object)
 
     mock_logger.assert_called()
+    mock_submit.assert_called_once_with(mock_webhook_object.json)
+    mock_prefetch.assert_called_once_with(mock_webhook_object.json)
     assert webhook[0] == {
         'message': 'Started deployment for test_user/test-repo-name',
         'success': True,
@@ -20,8 +24,9 @@ def test_parse_github_webhook(mock_run_deployment, mock_logger, mock_webhook_obj
 
 
 @patch('logging.Logger.error')
-@patch('harvey.deployments.Deployment.run_deployment')
-def test_parse_github_webhook_bad_branch(mock_run_deployment, mock_logger, mock_webhook_object):
+@patch('harvey.scheduler.Scheduler.submit')
+def test_parse_github_webhook_bad_branch(mock_submit, mock_logger, mock_webhook_object):
+    rejected_webhooks = _count_webhooks('422', 'branch_not_allowed')
     webhook = Api.parse_github_webhook(mock_webhook_object(branch='bad_branch_name'))
 
     mock_logger.assert_called()
@@ -31,11 +36,12 @@ def test_parse_github_webhook_bad_branch(mock_run_deployment, mock_logger, mock_
     )
     assert webhook[0]['success'] is False
     assert webhook[1] == 422
+    assert _count_webhooks('422', 'branch_not_allowed') == rejected_webhooks + 1
 
 
 @patch('logging.Logger.error')
-@patch('harvey.deployments.Deployment.run_deployment')
-def test_parse_github_webhook_no_json(mock_run_deployment, mock_logger):
+@patch('harvey.scheduler.Scheduler.submit')
+def test_parse_github_webhook_no_json(mock_submit, mock_logger):
     mock_webhook = MagicMock()
     mock_webhook.json = None
     webhook = Api.parse_github_webhook(mock_webhook)
@@ -51,8 +57,8 @@ def test_parse_github_webhook_no_json(mock_run_deployment, mock_logger):
 @patch('logging.Logger.info')
 @patch('harvey.config.Config.webhook_secret', '123')
 @patch('harvey.webhooks.Webhook.validate_webhook_secret', return_value=False)
-@patch('harvey.deployments.Deployment.run_deployment')
-def test_parse_github_webhook_bad_webhook_secret(mock_run_deployment, mock_logger, mock_webhook_object):
+@patch('harvey.scheduler.Scheduler.submit')
+def test_parse_github_webhook_bad_webhook_secret(mock_submit, mock_logger, mock_webhook_object):
     webhook = Api.parse_github_webhook(mock_webhook_object)
 
     mock_logger.assert_called()
@@ -61,3 +67,10 @@ def test_parse_github_webhook_bad_webhook_secret(mock_run_deployment, mock_logge
         'success': False,
     }
     assert webhook[1] == 403
+
+
+def _count_webhooks(status_code, reason):
+    """Return how many webhooks were counted with a status code and reason."""
+    samples = {tuple(labels.values()): value for _, labels, value in WEBHOOKS.samples()}
+
+    return samples.get((status_code, reason), 0)
@@ -2,18 +2,29 @@ from unittest.mock import patch
 
 import pytest
 
+from harvey.app import bootstrap
+from harvey.repos.webhooks import update_webhook
+
 
 @pytest.mark.parametrize(
     'route',
     [
         'health',
         'deployments',
+        'deployments/active',
         'deployments/mock-deployment-id',
+        'deployments/mock-deployment-id/logs',
+        'deployments/mock-deployment-id/logs/stream',
+        'deployments/mock-deployment-id/trace',
         'projects',
         'projects/mock-project-name/webhook',
+        'projects/mock-project-name/containers',
         'locks',
         'locks/mock-project-name',
         'threads',
+        'queue',
+        'docker',
+        'metrics',
     ],
 )
 def test_routes_are_reachable_get(mock_client, route):
@@ -53,9 +64,78 @@ def test_routes_not_found(mock_client):
     assert response.status_code == 404
 
 
+@pytest.mark.parametrize(
+    'route, target',
+    [
+        ('docker', 'harvey.app.DOCKER_CLIENT_POOL.metrics'),
+        ('queue', 'harvey.app.SCHEDULER.status'),
+    ],
+)
+@patch('logging.Logger.error')
+def test_routes_internal_error(mock_logger, mock_client, route, target):
+    with patch(target, side_effect=Exception('mock error')):
+        response = mock_client.get(route)
+
+    assert response.status_code == 500
+    mock_logger.assert_called_once()
+
+
+def test_routes_bad_request(mock_client):
+    """Invalid URL params are the fault of the request rather than Harvey's."""
+    response = mock_client.get('deployments?cursor=bad-cursor')
+
+    assert response.status_code == 400
+    assert response.json == {'message': 'Invalid cursor: bad-cursor', 'success': False}
+
+
+@pytest.mark.parametrize('route', ['deployments/mock-deployment-id/logs', 'deployments/mock-deployment-id/trace'])
+@pytest.mark.parametrize('attempt', ['latest', '', '0', '-1'])
+def test_routes_bad_request_attempt(mock_client, route, attempt):
+    response = mock_client.get(f'{route}?attempt={attempt}')
+
+    assert response.status_code == 400
+    assert response.json == {'message': f'Invalid attempt: {attempt}', 'success': False}
+
+
+def test_routes_bad_request_last_event_id(mock_client):
+    response = mock_client.get('deployments/mock-deployment-id/logs/stream', headers={'Last-Event-ID': 'latest'})
+
+    assert response.status_code == 400
+    assert response.json == {'message': 'Invalid Last-Event-ID: latest', 'success': False}
+
+
+@patch('harvey.app.SCHEDULER')
+def test_redeploy_project(mock_scheduler, mock_client, mock_webhook):
+    """Redeploys are flagged so every service is deployed even though the commit was deployed already."""
+    update_webhook('TEST_user/TEST-repo-name', mock_webhook)
+
+    response = mock_client.post('projects/TEST_user-TEST-repo-name/redeploy')
+
+    assert response.status_code == 200
+    mock_scheduler.submit.assert_called_once_with(mock_webhook, redeploy=True)
+
+
 @patch('harvey.config.Config.webhook_secret', '123')
 def test_routes_not_authorized(mock_client):
     """We have a secret set but don't pass one resulting in a not authorized response."""
     response = mock_client.get('locks')
 
     assert response.status_code == 401
+
+
+@patch('harvey.app.SCHEDULER')
+@patch('harvey.app.run_subprocess_command', return_value='Docker Compose version v2.20.0')
+def test_bootstrap_starts_scheduler(mock_run_subprocess_command, mock_scheduler):
+    """Deployments left in the queue run as soon as Harvey boots."""
+    bootstrap()
+
+    mock_scheduler.start.assert_called_once()
+
+
+@patch('harvey.config.Config.external_runner', True)
+@patch('harvey.app.SCHEDULER')
+@patch('harvey.app.run_subprocess_command', return_value='Docker Compose version v2.20.0')
+def test_bootstrap_external_runner(mock_run_subprocess_command, mock_scheduler):
+    bootstrap()
+
+    mock_scheduler.start.assert_not_called()
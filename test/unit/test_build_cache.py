@@ -0,0 +1,128 @@
+import json
+from unittest.mock import (
+    ANY,
+    patch,
+)
+
+import pytest
+
+from harvey.build_cache import BuildCache
+from harvey.repos.builds import (
+    lookup_cached_image,
+    store_cached_image,
+)
+from harvey.repos.deployments import (
+    retrieve_deployment,
+    store_deployment_details,
+)
+
+
+MOCK_DEPLOYMENT_ID = 'test_user-test-repo-name-123456'
+
+
+@pytest.fixture
+def mock_context(tmp_path):
+    """A build context with a `.dockerignore` file."""
+    context_path = tmp_path / 'api'
+    (context_path / 'src').mkdir(parents=True)
+    (context_path / 'node_modules' / 'package').mkdir(parents=True)
+    (context_path / 'Dockerfile').write_text('FROM python')
+    (context_path / 'src' / 'app.py').write_text('app')
+    (context_path / 'src' / 'app.pyc').write_text('bytecode')
+    (context_path / 'node_modules' / 'package' / 'index.js').write_text('package')
+    (context_path / 'README.md').write_text('readme')
+    (context_path / 'KEEP.md').write_text('keep')
+    (context_path / '.dockerignore').write_text('# Comment\nnode_modules\n**/*.pyc\n*.md\n!KEEP.md\n')
+
+    return context_path
+
+
+def mock_compose_config(context_path):
+    return json.dumps(
+        {
+            'name': 'test-repo-name',
+            'services': {
+                'api': {'build': {'context': str(context_path), 'dockerfile': 'Dockerfile'}},
+                'db': {'image': 'postgres'},
+            },
+        }
+    )
+
+
+@pytest.mark.parametrize(
+    'path, changes_hash',
+    [
+        ('src/app.py', True),
+        ('Dockerfile', True),
+        ('KEEP.md', True),
+        ('src/app.pyc', False),
+        ('README.md', False),
+        ('node_modules/package/index.js', False),
+    ],
+)
+def test_hash_build_context(mock_context, path, changes_hash):
+    """Files excluded by the `.dockerignore` file don't change the hash of the build context."""
+    build_config = {'context': str(mock_context), 'dockerfile': 'Dockerfile'}
+    context_hash = BuildCache.hash_build_context(build_config)
+
+    (mock_context / path).write_text('changed')
+
+    assert (BuildCache.hash_build_context(build_config) != context_hash) is changes_hash
+
+
+def test_hash_build_context_build_config(mock_context):
+    build_config = {'context': str(mock_context), 'dockerfile': 'Dockerfile'}
+
+    assert BuildCache.hash_build_context(build_config) != BuildCache.hash_build_context(
+        {**build_config, 'args': {'VERSION': '2'}}
+    )
+
+
+@patch('harvey.build_cache.stream_subprocess_command')
+@patch('harvey.build_cache.BuildCache._image_id', return_value='sha256:built')
+@patch('harvey.build_cache.run_subprocess_command')
+def test_build_services_miss(mock_subprocess, mock_image_id, mock_stream, mock_context, mock_webhook):
+    """Services without a cached image are built and their image recorded against their build context's hash."""
+    mock_subprocess.return_value = mock_compose_config(mock_context)
+    store_deployment_details(mock_webhook)
+
+    output = BuildCache.build_services(['docker', 'compose'], None, mock_webhook, print)
+
+    mock_stream.assert_called_once_with(['docker', 'compose', 'build', 'api'], print, pid_callback=None)
+    assert output.startswith('Build cache:\napi: miss (built in ')
+    context_hash = retrieve_deployment(MOCK_DEPLOYMENT_ID)['attempts'][0]['builds'][0]['hash']
+    assert lookup_cached_image('test_user/test-repo-name', 'api', context_hash) == {
+        'image_id': 'sha256:built',
+        'build_seconds': ANY,
+    }
+
+
+@patch('harvey.build_cache.stream_subprocess_command')
+@patch('harvey.build_cache.run_subprocess_command')
+def test_build_services_hit(mock_subprocess, mock_stream, mock_context, mock_webhook):
+    """Services whose build context didn't change are tagged with their cached image instead of being built."""
+    context_hash = BuildCache.hash_build_context({'context': str(mock_context), 'dockerfile': 'Dockerfile'})
+    store_cached_image('test_user/test-repo-name', 'api', context_hash, 'sha256:cached', 42.5)
+    mock_subprocess.side_effect = [mock_compose_config(mock_context), 'sha256:previous\n', '']
+    store_deployment_details(mock_webhook)
+
+    output = BuildCache.build_services(['docker', 'compose'], None, mock_webhook, print)
+
+    mock_stream.assert_not_called()
+    mock_subprocess.assert_called_with(['docker', 'tag', 'sha256:cached', 'test-repo-name-api'])
+    assert output == 'Build cache:\napi: hit (saved 42.5s)'
+    assert retrieve_deployment(MOCK_DEPLOYMENT_ID)['attempts'][0]['builds'] == [
+        {
+            'service': 'api',
+            'hash': context_hash,
+            'cache_hit': True,
+            'image_id': 'sha256:cached',
+            'build_seconds': None,
+            'seconds_saved': 42.5,
+        }
+    ]
+
+
+@patch('harvey.build_cache.run_subprocess_command', side_effect=FileNotFoundError)
+def test_build_services_unavailable(mock_subprocess, mock_webhook):
+    assert BuildCache.build_services(['docker', 'compose'], None, mock_webhook, print) is None
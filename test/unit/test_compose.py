@@ -0,0 +1,83 @@
+import pytest
+
+from harvey.compose import Compose
+
+
+MOCK_COMPOSE_FILE = """
+services:
+  api:
+    build: ./api
+    volumes:
+      - ./config/api.ini:/etc/api.ini
+      - api-data:/data
+  worker:
+    build:
+      context: .
+      dockerfile: worker/Dockerfile
+    env_file: worker.env
+  db:
+    image: postgres
+volumes:
+  api-data:
+"""
+
+
+@pytest.fixture
+def compose_filepaths(tmp_path):
+    compose_filepath = tmp_path / 'docker-compose.yml'
+    compose_filepath.write_text(MOCK_COMPOSE_FILE)
+
+    return [str(compose_filepath)]
+
+
+@pytest.mark.parametrize(
+    'changed_paths, affected_services',
+    [
+        (['README.md'], ['worker']),  # The worker is built from the whole project
+        (['api/app.py'], ['api', 'worker']),
+        (['config/api.ini'], ['api', 'worker']),
+        (['api-data/file.txt'], ['worker']),
+        ([], []),
+    ],
+)
+def test_affected_services(compose_filepaths, changed_paths, affected_services):
+    assert Compose.affected_services(compose_filepaths, changed_paths) == affected_services
+
+
+def test_affected_services_by_build_context(tmp_path):
+    """Services whose build context doesn't contain a changed path are left alone."""
+    compose_filepath = tmp_path / 'docker-compose.yml'
+    compose_filepath.write_text(MOCK_COMPOSE_FILE.replace('context: .', 'context: ./worker').replace('worker/', ''))
+
+    assert Compose.affected_services([str(compose_filepath)], ['README.md']) == []
+    assert Compose.affected_services([str(compose_filepath)], ['api/app.py']) == ['api']
+    assert Compose.affected_services([str(compose_filepath)], ['worker.env']) == ['worker']
+    assert Compose.affected_services([str(compose_filepath)], ['worker/Dockerfile']) == ['worker']
+
+
+@pytest.mark.parametrize('changed_paths', [None, ['docker-compose.yml'], ['.env']])
+def test_affected_services_all(compose_filepaths, changed_paths):
+    """Every service is deployed if the changes are unknown or affect the compose configuration itself."""
+    assert Compose.affected_services(compose_filepaths, changed_paths) is None
+
+
+def test_affected_services_prod_compose(compose_filepaths, tmp_path):
+    """Services redefined by a later compose file are built from the build context it sets."""
+    prod_compose_filepath = tmp_path / 'docker-compose-prod.yml'
+    prod_compose_filepath.write_text('services:\n  worker:\n    build: ./worker\n')
+
+    assert Compose.affected_services([*compose_filepaths, str(prod_compose_filepath)], ['README.md']) == []
+    assert (
+        Compose.affected_services([*compose_filepaths, str(prod_compose_filepath)], ['docker-compose-prod.yml']) is None
+    )
+
+
+def test_project_name(tmp_path):
+    project_path = tmp_path / 'Mock.Project'
+    project_path.mkdir()
+
+    assert Compose.project_name(str(project_path)) == 'mockproject'
+
+    (project_path / 'docker-compose.yml').write_text('name: mock-name\nservices: {}\n')
+
+    assert Compose.project_name(str(project_path)) == 'mock-name'
@@ -1,75 +1,392 @@
+import datetime
+import http.server
+import threading
+import time
 from unittest.mock import (
+    MagicMock,
     Mock,
     patch,
 )
 
-from harvey.containers import Container
+import docker
+import pytest
+
+from harvey.containers import (
+    Container,
+    DockerClientPool,
+)
+from harvey.errors import HarveyError
 from harvey.utils.utils import get_utc_timestamp
 
 
-MOCK_RFC_3339_TIME = get_utc_timestamp().isoformat()[:-4]
+MOCK_RFC_3339_TIME = get_utc_timestamp().strftime('%Y-%m-%dT%H:%M:%S.%f000Z')
 
 
 @patch('logging.Logger.debug')
 @patch('docker.from_env')
 def test_create_client(mock_client, mock_logger):
-    _ = Container.create_client()
+    with patch('harvey.containers.DOCKER_CLIENT_POOL', DockerClientPool()):
+        client = Container.create_client()
 
-    mock_client.assert_called_once()
+        assert Container.create_client() is client
 
+    mock_client.assert_called_once_with(timeout=10, max_pool_size=10)
 
-@patch('logging.Logger.debug')
+
+@patch('logging.Logger.warning')
+@patch('harvey.containers.DockerClientPool.ping_interval_seconds', 0)
 @patch('docker.from_env')
-def test_get_container(mock_client, mock_logger, mock_tag):
-    mock_docker_client = mock_client
-    _ = Container.get_container(mock_docker_client, mock_tag)
+def test_docker_client_pool_reconnects(mock_client, mock_logger):
+    """An idle client that can't reach the Docker daemon anymore is replaced."""
+    pool = DockerClientPool()
+    first_client = pool.client()
+    first_client.ping.side_effect = docker.errors.APIError('mock error')
 
-    mock_logger.assert_called()
-    mock_client.containers.get.assert_called_once_with(mock_tag)
+    pool.client()
+
+    assert mock_client.call_count == 2
+    first_client.close.assert_called_once()
+    assert pool.metrics()['reconnects'] == 1
 
 
-@patch('logging.Logger.debug')
 @patch('docker.from_env')
-def test_list_containers(mock_client, mock_logger, mock_tag):
-    mock_docker_client = mock_client
-    _ = Container.list_containers(mock_docker_client)
+def test_docker_client_pool_metrics(mock_client):
+    """Round-trips to the Docker daemon are measured via the client's response hooks."""
+    mock_client.return_value.api.hooks = {'response': []}
+    pool = DockerClientPool()
+    client = pool.client()
 
-    mock_logger.assert_called()
-    mock_client.containers.list.assert_called_once()
+    for hook in client.api.hooks['response']:
+        hook(Mock(elapsed=datetime.timedelta(milliseconds=10)))
+        hook(Mock(elapsed=datetime.timedelta(milliseconds=30)))
 
+    metrics = pool.metrics()
+    assert metrics['requests'] == 2
+    assert metrics['round_trip_seconds_max'] == 0.03
+    assert metrics['round_trip_seconds_average'] == pytest.approx(0.02)
 
-@patch('logging.Logger.info')
-@patch('time.sleep', return_value=None)
-@patch(
-    'harvey.containers.Container.get_container',
-    return_value=Mock(status='running', attrs={'State': {'StartedAt': MOCK_RFC_3339_TIME}}),
-)
-@patch('docker.from_env')
-def test_run_container_healthcheck_success(
-    mock_client, mock_container, mock_sleep, mock_logger, mock_container_name, mock_webhook
+
+@pytest.fixture
+def mock_docker_daemon():
+    """A Docker daemon that answers every request with an empty JSON response, listening on a local port."""
+
+    class DockerDaemonHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', '2')
+            self.end_headers()
+            self.wfile.write(b'{}')
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), DockerDaemonHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    yield f'tcp://127.0.0.1:{server.server_address[1]}'
+
+    server.shutdown()
+    server.server_close()
+
+
+@patch('harvey.containers.DockerClientPool.ping_interval_seconds', 0)
+def test_docker_client_pool_pings_idle_clients(mock_docker_daemon):
+    """Pinging an idle client records its round-trip via the response hook without deadlocking the pool."""
+    with patch(
+        'docker.from_env',
+        side_effect=lambda **kwargs: docker.DockerClient(base_url=mock_docker_daemon, version='1.41', **kwargs),
+    ):
+        pool = DockerClientPool()
+        first_client = pool.client()
+        clients = []
+        thread = threading.Thread(target=lambda: clients.append(pool.client()), daemon=True)
+        thread.start()
+        thread.join(timeout=5)
+
+    assert not thread.is_alive()
+    assert clients == [first_client]
+    assert pool.metrics()['requests'] == 1
+    assert pool.metrics()['reconnects'] == 0
+    pool.close()
+
+
+@patch('docker.from_env', side_effect=docker.errors.DockerException('mock error'))
+def test_docker_client_pool_unavailable(mock_client):
+    with pytest.raises(HarveyError):
+        DockerClientPool().client()
+
+
+def test_inspect_containers():
+    """Every container of a compose project is fetched with a single list request."""
+    mock_docker_client = MagicMock()
+    mock_docker_client.api.containers.return_value = [
+        {
+            'Id': 'mock-id',
+            'Names': ['/mock-project-api-1'],
+            'Image': 'mock-project-api',
+            'Labels': {'com.docker.compose.project': 'mock-project', 'com.docker.compose.service': 'api'},
+            'State': 'running',
+            'Status': 'Up 5 seconds (health: starting)',
+            'Created': 1577836800,
+        },
+        {
+            'Id': 'mock-id-2',
+            'Names': ['/mock-project-db-1'],
+            'Image': 'postgres',
+            'Labels': {'com.docker.compose.project': 'mock-project', 'com.docker.compose.service': 'db'},
+            'State': 'exited',
+            'Status': 'Exited (1) 2 minutes ago',
+            'Created': 1577836800,
+        },
+    ]
+
+    containers = Container.inspect_containers(mock_docker_client, compose_project='mock-project')
+
+    mock_docker_client.api.containers.assert_called_once_with(
+        all=True,
+        filters={'label': 'com.docker.compose.project=mock-project'},
+    )
+    assert containers == {
+        'mock-project-api-1': {
+            'id': 'mock-id',
+            'name': 'mock-project-api-1',
+            'image': 'mock-project-api',
+            'service': 'api',
+            'state': 'running',
+            'status': 'Up 5 seconds (health: starting)',
+            'health': 'starting',
+            'created_at': '2020-01-01T00:00:00+00:00',
+            'started_at': None,
+            'restart_policy': None,
+        },
+        'mock-project-db-1': {
+            'id': 'mock-id-2',
+            'name': 'mock-project-db-1',
+            'image': 'postgres',
+            'service': 'db',
+            'state': 'exited',
+            'status': 'Exited (1) 2 minutes ago',
+            'health': None,
+            'created_at': '2020-01-01T00:00:00+00:00',
+            'started_at': None,
+            'restart_policy': None,
+        },
+    }
+
+
+def test_inspect_containers_by_name():
+    """Containers are matched by their exact name even though Docker matches names partially."""
+    mock_docker_client = MagicMock()
+    mock_docker_client.api.containers.return_value = [
+        {'Names': ['/api'], 'State': 'running', 'Created': 0},
+        {'Names': ['/api-worker'], 'State': 'running', 'Created': 0},
+    ]
+
+    containers = Container.inspect_containers(mock_docker_client, container_names=['api'])
+
+    assert mock_docker_client.api.containers.call_args.kwargs['filters'] == {'name': ['^/?api$']}
+    assert list(containers) == ['api']
+
+
+@patch('harvey.containers.Container.create_client')
+def test_inspect_containers_docker_error(mock_client):
+    mock_docker_client = MagicMock()
+    mock_docker_client.api.containers.side_effect = docker.errors.APIError('mock-error')
+
+    with pytest.raises(HarveyError):
+        Container.inspect_containers(mock_docker_client, compose_project='mock-project')
+
+
+def mock_container(
+    name='mock_container',
+    status='running',
+    started_at=MOCK_RFC_3339_TIME,
+    health=None,
+    service=None,
+    restart_policy='no',
+    created=None,
 ):
-    mock_docker_client = mock_client
-    healthcheck = Container.run_container_healthcheck(mock_docker_client, mock_container_name, mock_webhook)
+    """A container as listed by Docker (`list`) and as inspected on its own (`attrs`)."""
+    health_status = {'starting': ' (health: starting)', 'healthy': ' (healthy)', 'unhealthy': ' (unhealthy)'}
+
+    return {
+        'list': {
+            'Id': f'{name}-id',
+            'Names': [f'/{name}'],
+            'Labels': {'com.docker.compose.service': service} if service else {},
+            'State': status,
+            'Status': f'Up 5 seconds{health_status.get(health, "")}',
+            'Created': int(time.time()) if created is None else created,
+        },
+        'attrs': {
+            'State': {'StartedAt': started_at},
+            'HostConfig': {'RestartPolicy': {'Name': restart_policy}},
+        },
+    }
+
+
+def mock_docker_client(*rounds):
+    """A Docker client listing the containers of each round of healthchecks in turn, the last round is repeated."""
+    rounds_iterator = iter(rounds)
+    current_round = []
+
+    def list_containers(all, filters):
+        current_round[:] = next(rounds_iterator, current_round)
+        names = [name.replace('^/?', '').replace('$', '').replace('\\', '') for name in filters['name']]
+        return [container['list'] for container in current_round if container['list']['Names'][0][1:] in names]
+
+    def inspect_container(container_id):
+        return next(container['attrs'] for container in current_round if container['list']['Id'] == container_id)
+
+    mock_client = MagicMock()
+    mock_client.api.containers.side_effect = list_containers
+    mock_client.api.inspect_container.side_effect = inspect_container
+
+    return mock_client
+
+
+def test_inspect_container_details():
+    mock_docker_client = MagicMock()
+    mock_docker_client.api.inspect_container.return_value = mock_container(
+        started_at='2020-01-01T00:00:00.123456789Z', restart_policy='unless-stopped'
+    )['attrs']
+
+    details = Container.inspect_container_details(mock_docker_client, {'id': 'mock-id', 'name': 'mock_container'})
+
+    mock_docker_client.api.inspect_container.assert_called_once_with('mock-id')
+    assert details == {'started_at': '2020-01-01T00:00:00.123456+00:00', 'restart_policy': 'unless-stopped'}
+
+
+def test_inspect_container_details_never_started():
+    mock_docker_client = MagicMock()
+    mock_docker_client.api.inspect_container.return_value = {'State': {'StartedAt': '0001-01-01T00:00:00Z'}}
+
+    details = Container.inspect_container_details(mock_docker_client, {'id': 'mock-id', 'name': 'mock_container'})
+
+    assert details == {'started_at': None, 'restart_policy': 'no'}
+
+
+@patch('logging.Logger.info')
+def test_run_container_healthcheck_success(mock_logger):
+    mock_client = mock_docker_client([mock_container()])
+    healthcheck = Container.run_container_healthcheck(mock_client, 'mock_container')
 
     mock_logger.assert_called()
-    mock_container.assert_called_once_with(mock_docker_client, mock_container_name)
+    mock_client.api.containers.assert_called_once_with(all=True, filters={'name': ['^/?mock_container$']})
     assert healthcheck is True
 
 
 @patch('logging.Logger.info')
-@patch('time.sleep', return_value=None)
-@patch('harvey.containers.Container.get_container', return_value=Mock(status='exited'))
-@patch('docker.from_env')
-def test_run_container_healthcheck_failed(
-    mock_client, mock_container, mock_sleep, mock_logger, mock_container_name, mock_webhook
-):
+@patch('harvey.containers.Container.healthcheck_backoff_seconds', [0.01])
+def test_run_container_healthcheck_failed(mock_logger):
     """This test checks that if a healthcheck fails, we properly retry.
 
     This test asserts we never succeed and abandon the retries after the max attempts are made."""
-    mock_docker_client = mock_client
-    healthcheck = Container.run_container_healthcheck(mock_docker_client, mock_container_name, mock_webhook)
+    mock_client = mock_docker_client([mock_container(status='restarting')])
+    healthcheck = Container.run_container_healthcheck(mock_client, 'mock_container')
 
     mock_logger.assert_called()
-    mock_container.assert_called_with(mock_docker_client, mock_container_name)
-    assert mock_container.call_count == 5
+    assert mock_client.api.containers.call_count == 5
     assert healthcheck is False
+
+
+@pytest.mark.parametrize(
+    'container, services, expected_result',
+    [
+        (mock_container(), None, (True, 'passed')),
+        (mock_container(health='healthy'), None, (True, 'passed')),
+        (mock_container(health='unhealthy'), None, (False, 'container is unhealthy')),
+        (mock_container(status='exited'), None, (False, 'container exited and will not be restarted')),
+        (
+            mock_container(started_at='2020-01-01T00:00:00.000000000Z'),
+            None,
+            (False, 'container did not restart on deploy'),
+        ),
+        (mock_container(started_at='2020-01-01T00:00:00.000000000Z', service='db'), ['api'], (True, 'passed')),
+        # Containers restarted in place or started late (eg: `depends_on`) are judged by when they started
+        (mock_container(created=1577836800), None, (True, 'passed')),
+        (None, None, (False, 'Harvey did not get container details from Docker')),
+    ],
+)
+def test_run_container_healthchecks_results(container, services, expected_result):
+    results = Container.run_container_healthchecks(
+        mock_docker_client([container] if container else []), ['mock_container'], services
+    )
+
+    assert results == {'mock_container': expected_result}
+
+
+@patch('harvey.containers.Container.healthcheck_backoff_seconds', [0.01])
+def test_run_container_healthchecks_exited_container_restarts():
+    """Exited containers that Docker restarts are waited on."""
+    mock_client = mock_docker_client(
+        [mock_container(status='exited', restart_policy='always')],
+        [mock_container(health='healthy', restart_policy='always')],
+    )
+
+    results = Container.run_container_healthchecks(mock_client, ['mock_container'])
+
+    assert results == {'mock_container': (True, 'passed')}
+
+
+@patch('harvey.containers.Container.healthcheck_backoff_seconds', [0.01])
+def test_run_container_healthchecks_slow_docker_healthcheck():
+    """A container whose Docker `HEALTHCHECK` is still starting once the restart grace period has passed isn't
+    failed for not having restarted, it has until the timeout to become healthy.
+    """
+    now = get_utc_timestamp()
+    mock_client = mock_docker_client(
+        [mock_container(health='starting')],
+        [mock_container(health='starting')],
+        [mock_container(health='healthy')],
+    )
+
+    with patch(
+        'harvey.containers.get_utc_timestamp',
+        side_effect=[now, now + datetime.timedelta(seconds=90), now + datetime.timedelta(seconds=100)],
+    ):
+        results = Container.run_container_healthchecks(mock_client, ['mock_container'])
+
+    assert results == {'mock_container': (True, 'passed')}
+    # When the container started is only inspected the first time it's seen running
+    mock_client.api.inspect_container.assert_called_once_with('mock_container-id')
+
+
+@patch('harvey.containers.Container.healthcheck_backoff_seconds', [5.0])
+def test_run_container_healthchecks_events():
+    """Containers are checked concurrently and inspected again as soon as Docker reports a relevant event instead of
+    waiting for the next delay.
+    """
+    event_sent = threading.Event()
+
+    def events(**kwargs):
+        yield {'Actor': {'Attributes': {'name': 'unrelated'}}}
+        event_sent.wait(timeout=5)
+        yield {'Actor': {'Attributes': {'name': 'api'}}}
+
+    mock_client = mock_docker_client(
+        [mock_container('api', health='starting'), mock_container('worker')],
+        [mock_container('api', health='healthy'), mock_container('worker')],
+    )
+    mock_client.events.side_effect = lambda **kwargs: MagicMock(__iter__=lambda self: events())
+    list_containers = mock_client.api.containers.side_effect
+
+    def list_containers_then_send_event(all, filters):
+        containers = list_containers(all=all, filters=filters)
+        event_sent.set()
+        return containers
+
+    mock_client.api.containers.side_effect = list_containers_then_send_event
+
+    start_time = time.monotonic()
+    results = Container.run_container_healthchecks(mock_client, ['api', 'worker'])
+
+    assert results == {'api': (True, 'passed'), 'worker': (True, 'passed')}
+    # Both containers are listed together, then only the one Docker reported an event for
+    assert [call.kwargs['filters']['name'] for call in mock_client.api.containers.call_args_list] == [
+        ['^/?api$', '^/?worker$'],
+        ['^/?api$'],
+    ]
+    assert time.monotonic() - start_time < 5
+    assert mock_client.events.call_args.kwargs['filters']['event'] == ['start', 'die', 'health_status']
@@ -24,27 +24,23 @@ def mock_config(deployment_type='deploy', prod_compose=False):
     return mock_config
 
 
-@patch('harvey.deployments.lookup_project_lock')
 @patch('harvey.config.Config.use_slack', True)
 @patch('harvey.git.Git.update_git_repo')
 @patch('harvey.deployments.Deployment.open_project_config', return_value=mock_config())
 @patch('harvey.messages.Message.send_slack_message')
-def test_initialize_deployment_slack(
-    mock_slack_message, mock_open_project_config, mock_update_git_repo, mock_project_lock, mock_webhook
-):
+def test_initialize_deployment_slack(mock_slack_message, mock_open_project_config, mock_update_git_repo, mock_webhook):
     _, _, _ = Deployment.initialize_deployment(mock_webhook)
 
     mock_slack_message.assert_called_once()
 
 
-@patch('harvey.deployments.lookup_project_lock')
 @patch('harvey.git.Git.update_git_repo')
 @patch('harvey.deployments.Deployment.open_project_config', return_value=mock_config())
-def test_initialize_deployment(mock_open_project_config, mock_update_git_repo, mock_project_lock, mock_webhook):
+def test_initialize_deployment(mock_open_project_config, mock_update_git_repo, mock_webhook):
     _, _, _ = Deployment.initialize_deployment(mock_webhook)
 
     mock_open_project_config.assert_called_once_with(mock_webhook)
-    mock_update_git_repo.assert_called_once_with(mock_webhook)
+    mock_update_git_repo.assert_called_once_with(mock_webhook, {}, output_callback=ANY)
 
 
 @patch('os.path.isfile')
@@ -90,9 +86,12 @@ class StringContains(str):
 
 @patch('os.path.exists', return_value=True)
 @patch('harvey.deployments.succeed_deployment')
-@patch('harvey.deployments.Container.run_container_healthcheck', return_value=True)
+@patch(
+    'harvey.deployments.Container.run_container_healthchecks',
+    return_value={'mock_container_name': (True, 'passed')},
+)
 @patch('harvey.containers.Container.create_client')
-@patch('harvey.deployments.Deployment.deploy', return_value='mock-output')
+@patch('harvey.deployments.Deployment.deploy', return_value=('mock-output', None))
 @patch(
     'harvey.deployments.Deployment.initialize_deployment',
     return_value=[mock_config(deployment_type='pull'), MOCK_OUTPUT, MOCK_TIME],
@@ -111,7 +110,7 @@ def test_run_deployment_pull(
     """
     _ = Deployment.run_deployment(mock_webhook)
 
-    mock_initialize_deployment.assert_called_once_with(mock_webhook)
+    mock_initialize_deployment.assert_called_once_with(mock_webhook, timer=ANY)
     mock_deploy_deployment.assert_not_called()
     mock_client.assert_not_called()
     mock_healthcheck.assert_not_called()
@@ -120,9 +119,13 @@ def test_run_deployment_pull(
 
 @patch('os.path.exists', return_value=True)
 @patch('harvey.deployments.succeed_deployment')
-@patch('harvey.deployments.Container.run_container_healthcheck', return_value=True)
+@patch('harvey.deployments.Git.record_deployed_commit')
+@patch(
+    'harvey.deployments.Container.run_container_healthchecks',
+    return_value={'mock_container_name': (True, 'passed')},
+)
 @patch('harvey.containers.Container.create_client')
-@patch('harvey.deployments.Deployment.deploy', return_value='mock-output')
+@patch('harvey.deployments.Deployment.deploy', return_value=('mock-output', None))
 @patch(
     'harvey.deployments.Deployment.initialize_deployment',
     return_value=[mock_config(deployment_type='deploy'), MOCK_OUTPUT, MOCK_TIME],
@@ -132,22 +135,115 @@ def test_run_deployment_deploy(
     mock_deploy_deployment,
     mock_client,
     mock_healthcheck,
+    mock_record_deployed_commit,
     mock_utils_success,
     mock_path_exists,
     mock_webhook,
 ):
     _ = Deployment.run_deployment(mock_webhook)
 
-    mock_initialize_deployment.assert_called_once_with(mock_webhook)
+    mock_initialize_deployment.assert_called_once_with(mock_webhook, timer=ANY)
     mock_deploy_deployment.assert_called_once_with(mock_config(deployment_type='deploy'), mock_webhook, MOCK_OUTPUT)
     mock_client.assert_called_once()
-    mock_healthcheck.assert_called_once()
+    mock_healthcheck.assert_called_once_with(ANY, ['mock_container_name'], services=None)
+    mock_record_deployed_commit.assert_called_once_with(mock_webhook)
+    mock_utils_success.assert_called_once()
+
+
+@patch('harvey.utils.deployments.store_deployment_timings')
+@patch('harvey.deployments.succeed_deployment')
+@patch('harvey.deployments.Git.record_deployed_commit')
+@patch(
+    'harvey.deployments.Container.run_container_healthchecks',
+    return_value={'mock_container_name': (True, 'passed')},
+)
+@patch('harvey.containers.Container.create_client')
+@patch('harvey.deployments.Deployment.deploy', return_value=('mock-output', None))
+@patch(
+    'harvey.deployments.Deployment.initialize_deployment',
+    return_value=[mock_config(deployment_type='deploy'), MOCK_OUTPUT, MOCK_TIME],
+)
+def test_run_deployment_stores_timings(
+    mock_initialize_deployment,
+    mock_deploy_deployment,
+    mock_client,
+    mock_healthcheck,
+    mock_record_deployed_commit,
+    mock_utils_success,
+    mock_store_deployment_timings,
+    mock_webhook,
+):
+    """Every stage of a deployment is timed along with how long it waited in the queue."""
+    _ = Deployment.run_deployment(mock_webhook, queue_wait_seconds=1.5)
+
+    mock_store_deployment_timings.assert_called_once_with(mock_webhook, ANY)
+    timings = mock_store_deployment_timings.call_args.args[1]
+    assert list(timings) == ['queue_wait', 'startup', 'deploy', 'healthcheck', 'total']
+    assert timings['queue_wait'] == 1500.0
+    assert timings['total'] >= timings['startup'] + timings['deploy'] + timings['healthcheck']
+
+
+@patch('harvey.deployments.kill_deployment')
+@patch('harvey.deployments.Git.record_deployed_commit')
+@patch(
+    'harvey.deployments.Container.run_container_healthchecks',
+    return_value={'mock_container_name': (False, 'container is unhealthy')},
+)
+@patch('harvey.containers.Container.create_client')
+@patch('harvey.deployments.Deployment.deploy', return_value=('mock-output', ['api']))
+@patch(
+    'harvey.deployments.Deployment.initialize_deployment',
+    return_value=[mock_config(deployment_type='deploy'), MOCK_OUTPUT, MOCK_TIME],
+)
+def test_run_deployment_deploy_healthcheck_failed(
+    mock_initialize_deployment,
+    mock_deploy_deployment,
+    mock_client,
+    mock_healthcheck,
+    mock_record_deployed_commit,
+    mock_utils_kill,
+    mock_webhook,
+):
+    """Only the deployed services are required to have restarted, a failed healthcheck kills the deployment."""
+    _ = Deployment.run_deployment(mock_webhook)
+
+    mock_healthcheck.assert_called_once_with(ANY, ['mock_container_name'], services=['api'])
+    mock_record_deployed_commit.assert_not_called()
+    assert (
+        'mock_container_name Healthcheck: Failure! (container is unhealthy)'
+        in mock_utils_kill.call_args.kwargs['message']
+    )
+
+
+@patch('harvey.deployments.succeed_deployment')
+@patch('harvey.deployments.Git.record_deployed_commit')
+@patch('harvey.deployments.Container.run_container_healthchecks')
+@patch('harvey.containers.Container.create_client')
+@patch('harvey.deployments.Deployment.deploy', return_value=('mock-output', None))
+@patch(
+    'harvey.deployments.Deployment.initialize_deployment',
+    return_value=[{'deployment_type': 'deploy'}, MOCK_OUTPUT, MOCK_TIME],
+)
+def test_run_deployment_deploy_no_healthcheck(
+    mock_initialize_deployment,
+    mock_deploy_deployment,
+    mock_client,
+    mock_healthcheck,
+    mock_record_deployed_commit,
+    mock_utils_success,
+    mock_webhook,
+):
+    """Projects without healthchecks are deployed without connecting to the Docker daemon."""
+    _ = Deployment.run_deployment(mock_webhook)
+
+    mock_client.assert_not_called()
+    mock_healthcheck.assert_not_called()
     mock_utils_success.assert_called_once()
 
 
 @patch('os.path.exists', return_value=True)
 @patch('harvey.deployments.Container.run_container_healthcheck', return_value=True)
-@patch('subprocess.check_output')
+@patch('harvey.deployments.stream_subprocess_command')
 def test_deploy_stage_success(mock_subprocess, mock_healthcheck, mock_path_exists, mock_webhook):
     _ = Deployment.deploy(mock_config('deploy'), dict(mock_webhook), MOCK_OUTPUT)
 
@@ -162,16 +258,115 @@ def test_deploy_stage_success(mock_subprocess, mock_healthcheck, mock_path_exist
             '--build',
             '--force-recreate',
         ],
-        stderr=-2,
-        text=True,
-        encoding='utf8',
-        timeout=300,
+        ANY,
+        pid_callback=ANY,
+    )
+
+
+@patch('os.path.exists', return_value=True)
+@patch('harvey.deployments.Git.changed_paths', return_value=['api/app.py'])
+@patch('harvey.deployments.Compose.affected_services', return_value=['api'])
+@patch('harvey.deployments.stream_subprocess_command')
+def test_deploy_stage_affected_services(
+    mock_subprocess, mock_affected_services, mock_changed_paths, mock_path_exists, mock_webhook
+):
+    """Only the services affected by the changes are built and recreated, leaving their dependencies as-is."""
+    _, deployed_services = Deployment.deploy(mock_config('deploy'), dict(mock_webhook), MOCK_OUTPUT)
+
+    assert deployed_services == ['api']
+
+    mock_affected_services.assert_called_once_with([ANY], ['api/app.py'])
+    assert mock_subprocess.call_args.args[0][-4:] == ['--build', '--force-recreate', '--no-deps', 'api']
+
+
+@patch('os.path.exists', return_value=True)
+@patch('harvey.deployments.Git.changed_paths', return_value=['README.md'])
+@patch('harvey.deployments.Compose.affected_services', return_value=[])
+@patch('harvey.deployments.stream_subprocess_command')
+def test_deploy_stage_no_affected_services(
+    mock_subprocess, mock_affected_services, mock_changed_paths, mock_path_exists, mock_webhook
+):
+    deploy_output, _ = Deployment.deploy(mock_config('deploy'), dict(mock_webhook), MOCK_OUTPUT)
+
+    mock_subprocess.assert_not_called()
+    assert deploy_output == 'Harvey skipped `docker compose` since no services were affected by the changes.'
+
+
+@patch('os.path.exists', return_value=True)
+@patch('harvey.deployments.Git.changed_paths', return_value=[])
+@patch('harvey.deployments.stream_subprocess_command')
+def test_deploy_stage_redeploy(mock_subprocess, mock_changed_paths, mock_path_exists, mock_webhook):
+    """Redeploying the deployed commit (eg: to recover a broken container) deploys every service."""
+    deploy_output, deployed_services = Deployment.deploy(
+        mock_config('deploy'), {**mock_webhook, 'redeploy': True}, MOCK_OUTPUT
     )
 
+    mock_changed_paths.assert_not_called()
+    assert deployed_services is None
+    assert mock_subprocess.call_args.args[0][-2:] == ['--build', '--force-recreate']
+
+
+@patch('os.path.exists', return_value=True)
+@patch('harvey.deployments.Git.changed_paths', return_value=['README.md'])
+@patch('harvey.deployments.stream_subprocess_command')
+def test_deploy_stage_rebuild_all_services(mock_subprocess, mock_changed_paths, mock_path_exists, mock_webhook):
+    config = {**mock_config('deploy'), 'rebuild_all_services': True}
+    _ = Deployment.deploy(config, dict(mock_webhook), MOCK_OUTPUT)
+
+    mock_changed_paths.assert_not_called()
+    assert mock_subprocess.call_args.args[0][-2:] == ['--build', '--force-recreate']
+
+
+@patch('os.path.exists', return_value=True)
+@patch('harvey.deployments.BuildCache.build_services', return_value='Build cache:\napi: hit (saved 12.5s)')
+@patch('harvey.deployments.stream_subprocess_command')
+def test_deploy_stage_build_cache(mock_subprocess, mock_build_services, mock_path_exists, mock_webhook):
+    """Images are built (or taken from the build cache) before recreating the services which then aren't rebuilt."""
+    deploy_output, _ = Deployment.deploy(mock_config('deploy'), dict(mock_webhook), MOCK_OUTPUT)
+
+    mock_build_services.assert_called_once_with(
+        ['docker', 'compose', '-f', ANY], None, mock_webhook, ANY, pid_callback=ANY
+    )
+    assert mock_subprocess.call_args.args[0] == ['docker', 'compose', '-f', ANY, 'up', '-d', '--force-recreate']
+    assert 'api: hit (saved 12.5s)' in deploy_output
+
+
+@patch('os.path.exists', return_value=True)
+@patch('harvey.deployments.BuildCache.build_services')
+@patch('harvey.deployments.stream_subprocess_command')
+def test_deploy_stage_build_cache_disabled(mock_subprocess, mock_build_services, mock_path_exists, mock_webhook):
+    _ = Deployment.deploy({**mock_config('deploy'), 'build_cache': False}, dict(mock_webhook), MOCK_OUTPUT)
+
+    mock_build_services.assert_not_called()
+    assert '--build' in mock_subprocess.call_args.args[0]
+
+
+@patch('os.path.exists', return_value=True)
+@patch('harvey.utils.deployments.append_deployment_log')
+@patch('harvey.deployments.stream_subprocess_command')
+def test_deploy_stage_streams_output(mock_subprocess, mock_append_log, mock_path_exists, mock_webhook):
+    """Output of the compose command is appended to the deployment's live log rather than returned."""
+
+    def stream_output(command, output_callback, pid_callback):
+        output_callback('Building\n')
+        output_callback('Built\n')
+
+    mock_subprocess.side_effect = stream_output
+
+    deploy_output, _ = Deployment.deploy(mock_config('deploy'), dict(mock_webhook), MOCK_OUTPUT)
+
+    mock_append_log.assert_called_with(mock_webhook, ANY)
+    assert ''.join(call.args[1] for call in mock_append_log.call_args_list) == 'Building\nBuilt\n'
+    assert 'Building' not in deploy_output
+    assert 'Deploy stage execution time' in deploy_output
+
 
 @patch('os.path.exists', return_value=True)
 @patch('harvey.deployments.kill_deployment')
-@patch('subprocess.check_output', side_effect=subprocess.TimeoutExpired(cmd='subprocess.check_output', timeout=0.1))
+@patch(
+    'harvey.deployments.stream_subprocess_command',
+    side_effect=subprocess.TimeoutExpired(cmd='subprocess.Popen', timeout=0.1),
+)
 def test_deploy_stage_subprocess_timeout(mock_subprocess, mock_utils_kill, mock_path_exists, mock_webhook):
     _ = Deployment.deploy(mock_config('deploy'), dict(mock_webhook), MOCK_OUTPUT)
 
@@ -181,7 +376,8 @@ def test_deploy_stage_subprocess_timeout(mock_subprocess, mock_utils_kill, mock_
 @patch('os.path.exists', return_value=True)
 @patch('harvey.deployments.kill_deployment')
 @patch(
-    'subprocess.check_output', side_effect=subprocess.CalledProcessError(cmd='subprocess.check_output', returncode=1)
+    'harvey.deployments.stream_subprocess_command',
+    side_effect=subprocess.CalledProcessError(cmd='subprocess.Popen', returncode=1),
 )
 def test_deploy_stage_subprocess_error(mock_subprocess, mock_utils_kill, mock_path_exists, mock_webhook):  # noqa
     _ = Deployment.deploy(mock_config('deploy'), dict(mock_webhook), MOCK_OUTPUT)
@@ -191,7 +387,7 @@ def test_deploy_stage_subprocess_error(mock_subprocess, mock_utils_kill, mock_pa
 
 @patch('os.path.exists', return_value=True)
 @patch('harvey.deployments.Container.run_container_healthcheck', return_value=True)
-@patch('subprocess.check_output')
+@patch('harvey.deployments.stream_subprocess_command')
 def test_deploy_stage_prod_compose_success(mock_subprocess, mock_healthcheck, mock_path_exists, mock_webhook):
     """This test simulates using the `prod_compose` flag and succeeding."""
     config = mock_config('deploy', prod_compose=True)
@@ -210,8 +406,6 @@ def test_deploy_stage_prod_compose_success(mock_subprocess, mock_healthcheck, mo
             '--build',
             '--force-recreate',
         ],
-        stderr=-2,
-        text=True,
-        encoding='utf8',
-        timeout=300,
+        ANY,
+        pid_callback=ANY,
     )
@@ -0,0 +1,232 @@
+import json
+import subprocess
+import sys
+import time
+from unittest.mock import (
+    MagicMock,
+    patch,
+)
+
+import pytest
+
+from harvey.containers import Container
+from harvey.errors import HarveyError
+from harvey.executors import (
+    RecordingExecutor,
+    ReplayExecutor,
+    create_executor,
+    get_command_key,
+    get_command_signature,
+    get_request_path,
+)
+
+
+def mock_record(
+    key, duration_seconds=0.0, signature=None, output='', return_code=0, timed_out=False, output_bytes=None
+):
+    return {
+        'key': key,
+        'signature': signature,
+        'command': key.split(),
+        'duration_seconds': duration_seconds,
+        'output_bytes': len(output) if output_bytes is None else output_bytes,
+        'output': output if output_bytes is None else None,
+        'return_code': return_code,
+        'timed_out': timed_out,
+    }
+
+
+def write_recording(path, records):
+    path.write_text(''.join(json.dumps(record) + '\n' for record in records))
+
+    return str(path)
+
+
+def test_get_command_key():
+    assert get_command_key(['env', 'GIT_NO_LAZY_FETCH=1', 'git', '-C', 'mock-path', 'cat-file', '-e', 'x']) == (
+        'git cat-file'
+    )
+    assert get_command_key(['docker', 'compose', '-f', 'a.yml', '-f', 'b.yml', 'up', '-d']) == 'docker compose up'
+    assert get_command_key(['docker', 'image', 'inspect', 'mock-image']) == 'docker image'
+    assert get_command_key(['git']) == 'git'
+
+
+def test_get_command_signature():
+    """Paths, URLs, and commits are replaced so runs of the same command share a signature."""
+    assert get_command_signature(
+        ['env', 'GIT_NO_LAZY_FETCH=1', 'git', '-C', 'mirror.git', 'cat-file', '-e', f'{"a" * 40}^{{commit}}']
+    ) == ('git -C <path> cat-file -e <commit>^{commit}')
+    assert get_command_signature(['git', 'clone', '--bare', 'git@github.com:user/repo.git', '/harvey/mirror.git']) == (
+        'git clone --bare <path> <path>'
+    )
+    assert get_command_signature(['git', '-C', '/harvey/mirror.git', 'rev-parse', 'refs/harvey/deployed']) == (
+        'git -C <path> rev-parse refs/harvey/deployed'
+    )
+    assert get_command_signature(['/usr/bin/docker', 'compose', '-f', 'docker-compose.yml', 'up', '-d']) == (
+        'docker compose -f <path> up -d'
+    )
+
+
+def test_recording_executor(tmp_path):
+    """Commands run as usual while their key, duration, output size, and outcome are recorded."""
+    recording_path = tmp_path / 'recordings' / 'executor.jsonl'
+    executor = RecordingExecutor(str(recording_path))
+
+    assert executor.run([sys.executable, '-c', 'print("mock output")']) == 'mock output\n'
+    with pytest.raises(subprocess.CalledProcessError):
+        executor.stream([sys.executable, '-c', 'print("building"); exit(2)'], print)
+
+    records = [json.loads(line) for line in recording_path.read_text().splitlines()]
+
+    assert [record['output'] for record in records] == ['mock output\n', 'building\n']
+    assert [record['output_bytes'] for record in records] == [12, 9]
+    assert [record['return_code'] for record in records] == [0, 2]
+    assert all(record['duration_seconds'] > 0 for record in records)
+
+
+@patch('harvey.executors.MAX_RECORDED_OUTPUT_BYTES', 4)
+def test_recording_executor_large_output(tmp_path):
+    """Large outputs are recorded by size only."""
+    recording_path = tmp_path / 'executor.jsonl'
+    lines = []
+
+    RecordingExecutor(str(recording_path)).stream(
+        [sys.executable, '-c', 'print("line 1"); print("line 2")'], lines.append
+    )
+    record = json.loads(recording_path.read_text())
+
+    assert lines == ['line 1\n', 'line 2\n']
+    assert record['output_bytes'] == 14
+    assert record['output'] is None
+
+
+def test_recording_executor_docker_requests(tmp_path):
+    """Requests to the Docker daemon are recorded by method and path."""
+    recording_path = tmp_path / 'executor.jsonl'
+    executor = RecordingExecutor(str(recording_path))
+    response = MagicMock(ok=True, headers={'Content-Length': '2'})
+    response.request.method = 'GET'
+    response.request.path_url = '/v1.45/containers/json?all=1'
+    response.elapsed.total_seconds.return_value = 0.01
+
+    with patch('docker.from_env') as mock_client:
+        mock_client.return_value.api.hooks = {'response': []}
+        client = executor.docker_client(timeout=10)
+    client.api.hooks['response'][-1](response)
+
+    mock_client.assert_called_once_with(timeout=10)
+    record = json.loads(recording_path.read_text())
+    assert record['key'] == 'docker api GET /containers/json'
+    assert record['duration_seconds'] == 0.01
+    assert record['output_bytes'] == 2
+
+
+def test_replay_executor(tmp_path):
+    """Records of a command are replayed in order, starting over once exhausted."""
+    recording_path = write_recording(
+        tmp_path / 'executor.jsonl',
+        [
+            mock_record('git rev-parse', output='commit-1\n'),
+            mock_record('git rev-parse', output='commit-2\n'),
+            mock_record('docker compose build', output_bytes=200),
+        ],
+    )
+    executor = ReplayExecutor(recording_path)
+    lines = []
+
+    assert [executor.run(['git', '-C', 'mock-path', 'rev-parse', 'HEAD']) for _ in range(3)] == [
+        'commit-1\n',
+        'commit-2\n',
+        'commit-1\n',
+    ]
+    assert executor.run(['git', 'worktree', 'prune']) == ''
+
+    executor.stream(['docker', 'compose', '-f', 'docker-compose.yml', 'build'], lines.append)
+
+    assert len(''.join(lines)) == 200
+    assert len(lines) == 3
+
+
+def test_replay_executor_signatures(tmp_path):
+    """Commands are replayed from the records of their signature before those of their key."""
+    recording_path = write_recording(
+        tmp_path / 'executor.jsonl',
+        [
+            mock_record('git rev-parse', signature='git -C <path> rev-parse refs/harvey/deployed', return_code=1),
+            mock_record('git rev-parse', signature='git -C <path> rev-parse HEAD', output='mock-commit\n'),
+        ],
+    )
+    executor = ReplayExecutor(recording_path)
+
+    assert executor.run(['git', '-C', '/mock-path', 'rev-parse', 'HEAD']) == 'mock-commit\n'
+    assert executor.run(['git', '-C', '/mock-path', 'rev-parse', 'HEAD']) == 'mock-commit\n'
+    with pytest.raises(subprocess.CalledProcessError):
+        executor.run(['git', '-C', '/mock-path', 'rev-parse', 'refs/harvey/deployed'])
+
+
+def test_replay_executor_failures(tmp_path):
+    recording_path = write_recording(
+        tmp_path / 'executor.jsonl',
+        [
+            mock_record('git fetch', output='fatal: could not read from remote\n', return_code=128),
+            mock_record('docker compose up', timed_out=True),
+        ],
+    )
+    executor = ReplayExecutor(recording_path)
+
+    with pytest.raises(subprocess.CalledProcessError) as error:
+        executor.run(['git', 'fetch', 'origin'])
+    with pytest.raises(subprocess.TimeoutExpired):
+        executor.stream(['docker', 'compose', 'up', '-d'], print)
+
+    assert error.value.returncode == 128
+    assert error.value.output == 'fatal: could not read from remote\n'
+
+
+@patch('time.sleep')
+def test_replay_executor_speed(mock_sleep, tmp_path):
+    recording_path = write_recording(tmp_path / 'executor.jsonl', [mock_record('git fetch', duration_seconds=3.0)])
+
+    ReplayExecutor(recording_path, speed=2.0).run(['git', 'fetch'])
+
+    mock_sleep.assert_called_once_with(1.5)
+
+
+def test_replay_executor_missing_recording(tmp_path):
+    with pytest.raises(HarveyError, match='could not load the executor recording'):
+        ReplayExecutor(str(tmp_path / 'missing.jsonl'))
+
+
+def test_replay_executor_healthchecks(tmp_path):
+    """Simulated containers are running and were recreated by the deployment, so their healthchecks pass. Inspecting
+    them takes as long as inspecting the recorded containers took, whatever their IDs were.
+    """
+    recording_path = write_recording(
+        tmp_path / 'executor.jsonl', [mock_record('docker api GET /containers/<id>/json', duration_seconds=0.1)]
+    )
+    client = ReplayExecutor(recording_path).docker_client(timeout=10)
+
+    start_time = time.monotonic()
+    results = Container.run_container_healthchecks(client, ['mock-project-api-1', 'mock.worker'])
+
+    assert results == {'mock-project-api-1': (True, 'passed'), 'mock.worker': (True, 'passed')}
+    assert time.monotonic() - start_time >= 0.1
+
+
+@pytest.mark.parametrize(
+    'path, expected_path',
+    [
+        ('/v1.45/containers/json?all=1', '/containers/json'),
+        ('/v1.45/containers/4f2a9c81e3b7/json', '/containers/<id>/json'),
+        ('/containers/mock-project-api-1/logs?tail=10', '/containers/<id>/logs'),
+        ('/_ping', '/_ping'),
+    ],
+)
+def test_get_request_path(path, expected_path):
+    assert get_request_path(path) == expected_path
+
+
+@patch('harvey.config.Config.executor', 'mock-executor')
+def test_create_executor_unknown():
+    with pytest.raises(HarveyError, match='EXECUTOR must be one of'):
+        create_executor()
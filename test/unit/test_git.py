@@ -1,90 +1,324 @@
 import os
+import shutil
 import subprocess
-from unittest.mock import patch
+from unittest.mock import (
+    ANY,
+    patch,
+)
+
+import pytest
 
+from harvey.errors import GitError
 from harvey.git import Git
 
 
-@patch('os.path.exists', return_value=True)
-@patch('harvey.git.Git.pull_repo')
-def test_update_git_repo_path_exists(mock_pull_repo, mock_path_exists, mock_project_path, mock_webhook):  # noqa
-    Git.update_git_repo(mock_webhook)
+MOCK_MIRROR_PATH = 'harvey/mirrors/test_user/test-repo-name.git'
+
 
-    mock_pull_repo.assert_called_once_with(os.path.expanduser(os.path.join('~', mock_project_path)), mock_webhook)
+def git(*args, cwd):
+    """Run a git command against a local repo used to simulate a remote."""
+    return subprocess.check_output(
+        ['git', '-c', 'user.name=test', '-c', 'user.email=test@example.com', *args],
+        cwd=cwd,
+        text=True,
+    ).strip()
 
 
-@patch('os.path.exists', return_value=False)
-@patch('harvey.git.Git.clone_repo')
-def test_update_git_repo_path_does_not_exist(mock_clone_repo, mock_path_exists, mock_project_path, mock_webhook):
-    Git.update_git_repo(mock_webhook)
+@pytest.fixture
+def mock_remote(tmp_path):
+    """A local repo standing in for the GitHub remote of a project."""
+    remote_path = tmp_path / 'remote'
+    remote_path.mkdir()
+    git('init', '-q', '-b', 'main', cwd=remote_path)
 
-    mock_clone_repo.assert_called_once_with(os.path.expanduser(os.path.join('~', mock_project_path)), mock_webhook)
+    return remote_path
 
 
-@patch('logging.Logger.debug')
-@patch('subprocess.check_output')
-def test_clone_repo(mock_subprocess, mock_logger, mock_project_path, mock_webhook):
-    Git.clone_repo(mock_project_path, mock_webhook)
+def commit_file(remote_path, content):
+    (remote_path / 'file.txt').write_text(content)
+    git('add', 'file.txt', cwd=remote_path)
+    git('commit', '-q', '-m', content, cwd=remote_path)
 
-    mock_logger.assert_called()
-    mock_subprocess.assert_called_once_with(
-        ['git', 'clone', '--depth=1', 'https://test-ssh-url.com', 'harvey/projects/test_user/test-repo-name'],
-        stderr=-2,
-        text=True,
-        encoding='utf8',
-        timeout=300,
+    return git('rev-parse', 'HEAD', cwd=remote_path)
+
+
+@patch('harvey.git.Git.checkout_commit', return_value='')
+@patch('harvey.git.Git.update_mirror', return_value='')
+def test_update_git_repo(mock_update_mirror, mock_checkout_commit, mock_project_path, mock_webhook, tmp_path):
+    with patch('harvey.config.Config.mirrors_path', str(tmp_path / 'mirrors')):
+        Git.update_git_repo(mock_webhook)
+
+    mirror_path = str(tmp_path / 'mirrors' / 'test_user' / 'test-repo-name.git')
+    mock_update_mirror.assert_called_once_with(mirror_path, mock_webhook, None)
+    mock_checkout_commit.assert_called_once_with(
+        os.path.expanduser(os.path.join('~', mock_project_path)), mirror_path, mock_webhook, None, None
     )
 
 
-@patch('harvey.git.kill_deployment')
-@patch('subprocess.check_output', side_effect=subprocess.TimeoutExpired(cmd='subprocess.check_output', timeout=0.1))
-def test_clone_repo_subprocess_timeout(mock_subprocess, mock_utils_kill, mock_project_path, mock_webhook):
-    Git.clone_repo(mock_project_path, mock_webhook)
+@patch('harvey.git.Git.checkout_commit', return_value='')
+@patch('harvey.git.Git.update_mirror', return_value='')
+@patch('harvey.git.Git.fetch_commit', return_value='')
+def test_update_git_repo_fetch_commit(mock_fetch_commit, mock_update_mirror, mock_checkout_commit, mock_webhook):
+    config = {'git_fetch': 'commit', 'git_filter': 'blob:none', 'git_sparse_checkout': ['app']}
 
-    mock_utils_kill.assert_called_once()
+    Git.update_git_repo(mock_webhook, config)
 
+    mock_fetch_commit.assert_called_once_with(ANY, ANY, mock_webhook, 'blob:none', None)
+    mock_update_mirror.assert_not_called()
+    mock_checkout_commit.assert_called_once_with(ANY, ANY, mock_webhook, ['app'], None)
 
-@patch('harvey.git.kill_deployment')
-@patch(
-    'subprocess.check_output', side_effect=subprocess.CalledProcessError(cmd='subprocess.check_output', returncode=1)
-)
-def test_clone_repo_process_error(mock_subprocess, mock_utils_kill, mock_project_path, mock_webhook):
-    Git.clone_repo(mock_project_path, mock_webhook)
 
-    mock_utils_kill.assert_called_once()
+@patch('os.path.exists', return_value=False)
+@patch('harvey.git.run_subprocess_command', return_value='')
+def test_update_mirror_clone(mock_subprocess, mock_path_exists, mock_webhook):
+    Git.update_mirror(MOCK_MIRROR_PATH, mock_webhook)
 
+    assert mock_subprocess.call_args_list[0].args[0] == [
+        'git',
+        'clone',
+        '--bare',
+        'https://test-ssh-url.com',
+        MOCK_MIRROR_PATH,
+    ]
 
-@patch('logging.Logger.debug')
-@patch('subprocess.check_output')
-def test_pull_repo(mock_subprocess, mock_logger, mock_project_path, mock_webhook):
-    Git.pull_repo(mock_project_path, mock_webhook)
 
-    mock_logger.assert_called()
-    mock_subprocess.assert_called_once_with(
-        ['git', '-C', 'harvey/projects/test_user/test-repo-name', 'pull', '--rebase'],
-        stderr=-2,
-        text=True,
-        encoding='utf8',
-        timeout=300,
-    )
+@patch('os.path.exists', return_value=True)
+@patch('harvey.git.run_subprocess_command', return_value='')
+def test_update_mirror_fetch(mock_subprocess, mock_path_exists, mock_webhook):
+    Git.update_mirror(MOCK_MIRROR_PATH, mock_webhook)
 
+    assert mock_subprocess.call_args_list[-1].args[0] == [
+        'git',
+        '-C',
+        MOCK_MIRROR_PATH,
+        'fetch',
+        '--prune',
+        '--tags',
+        'origin',
+    ]
 
-@patch('harvey.git.kill_deployment')
-@patch('subprocess.check_output', side_effect=subprocess.TimeoutExpired(cmd='subprocess.check_output', timeout=0.1))
-def test_pull_repo_subprocess_timeout(mock_subprocess, mock_utils_kill, mock_project_path, mock_webhook):
-    Git.pull_repo(mock_project_path, mock_webhook)
 
-    mock_utils_kill.assert_called_once()
+@patch('harvey.git.run_subprocess_command', side_effect=subprocess.TimeoutExpired(cmd='git', timeout=0.1))
+def test_update_mirror_subprocess_timeout(mock_subprocess, mock_webhook):
+    with pytest.raises(GitError) as error:
+        Git.update_mirror(MOCK_MIRROR_PATH, mock_webhook)
+
+    assert str(error.value) == 'Harvey timed out trying to update the mirror of test_user/test-repo-name.'
+
+
+@patch('harvey.git.run_subprocess_command', side_effect=subprocess.CalledProcessError(cmd='git', returncode=1))
+def test_update_mirror_process_error(mock_subprocess, mock_webhook):
+    with pytest.raises(GitError):
+        Git.update_mirror(MOCK_MIRROR_PATH, mock_webhook)
 
 
 @patch('harvey.git.kill_deployment')
+@patch('harvey.git.Git.fetch', side_effect=GitError('mock error'))
+def test_update_git_repo_kills_deployment_on_error(mock_fetch, mock_utils_kill, mock_webhook, tmp_path):
+    with patch('harvey.config.Config.mirrors_path', str(tmp_path / 'mirrors')):
+        Git.update_git_repo(mock_webhook)
+
+    mock_utils_kill.assert_called_once_with(message='mock error', webhook=mock_webhook)
+
+
+@patch('os.path.exists', return_value=True)
+@patch('harvey.git.run_subprocess_command', return_value='')
+def test_fetch_commit(mock_subprocess, mock_path_exists, mock_webhook):
+    Git.fetch_commit(MOCK_MIRROR_PATH, 'mock-project-path', mock_webhook, 'blob:none')
+
+    assert mock_subprocess.call_args.args[0] == [
+        'git',
+        '-C',
+        MOCK_MIRROR_PATH,
+        'fetch',
+        '--depth=1',
+        '--filter=blob:none',
+        'origin',
+        '123456',
+    ]
+
+
+@patch('os.path.exists', return_value=True)
 @patch(
-    'subprocess.check_output', side_effect=subprocess.CalledProcessError(cmd='subprocess.check_output', returncode=1)
+    'harvey.git.run_subprocess_command',
+    side_effect=['', subprocess.CalledProcessError(cmd='git', returncode=1), ''],
 )
-def test_pull_repo_process_error(mock_subprocess, mock_utils_kill, mock_project_path, mock_webhook):
-    # TODO: We need to test here that the `stash` command gets called, unsure how to do this since
-    # we first have to make `subprocess.check_output` fail then run it again - mocking that
-    # in a test seems difficult
-    Git.pull_repo(mock_project_path, mock_webhook)
+def test_fetch_commit_falls_back_to_ref(mock_subprocess, mock_path_exists, mock_webhook):
+    """Servers that don't allow fetching commits by ID get the tip of the pushed ref fetched instead."""
+    Git.fetch_commit(MOCK_MIRROR_PATH, 'mock-project-path', {**mock_webhook, 'ref': 'refs/heads/main'})
+
+    assert mock_subprocess.call_args.args[0] == [
+        'git',
+        '-C',
+        MOCK_MIRROR_PATH,
+        'fetch',
+        '--depth=1',
+        'origin',
+        '+refs/heads/main:refs/heads/main',
+    ]
+
+
+@patch('os.path.exists', return_value=True)
+@patch('harvey.git.run_subprocess_command', side_effect=subprocess.TimeoutExpired(cmd='git', timeout=0.1))
+def test_fetch_commit_subprocess_timeout(mock_subprocess, mock_path_exists, mock_webhook):
+    with pytest.raises(GitError):
+        Git.fetch_commit(MOCK_MIRROR_PATH, 'mock-project-path', mock_webhook)
+
+
+def test_update_git_repo_checks_out_webhook_commit(mock_remote, mock_webhook, tmp_path):
+    """The project folder is a worktree of the mirror pinned to the pushed commit, untracked files survive."""
+    first_commit = commit_file(mock_remote, 'first')
+    webhook = {**mock_webhook, 'repository': {**mock_webhook['repository'], 'ssh_url': str(mock_remote)}}
+    project_path = tmp_path / 'projects' / 'test_user' / 'test-repo-name'
+
+    with patch('harvey.config.Config.projects_path', str(tmp_path / 'projects')), patch(
+        'harvey.config.Config.mirrors_path', str(tmp_path / 'mirrors')
+    ):
+        Git.update_git_repo({**webhook, 'after': first_commit})
+        (project_path / '.env').write_text('SECRET=1')
+        second_commit = commit_file(mock_remote, 'second')
+        commit_file(mock_remote, 'third')
+
+        Git.update_git_repo({**webhook, 'after': second_commit})
+
+    assert (project_path / 'file.txt').read_text() == 'second'
+    assert (project_path / '.env').read_text() == 'SECRET=1'
+    assert git('rev-parse', 'HEAD', cwd=project_path) == second_commit
+    assert (project_path / '.git').is_file()  # A worktree of the mirror rather than a separate clone
+
+
+def test_update_git_repo_streams_output(mock_remote, mock_webhook, tmp_path):
+    """The output of git is passed to the callback as it's produced (eg: to follow it via the live log)."""
+    first_commit = commit_file(mock_remote, 'first')
+    webhook = {
+        **mock_webhook,
+        'after': first_commit,
+        'repository': {**mock_webhook['repository'], 'ssh_url': str(mock_remote)},
+    }
+    output_lines = []
+
+    with patch('harvey.config.Config.projects_path', str(tmp_path / 'projects')), patch(
+        'harvey.config.Config.mirrors_path', str(tmp_path / 'mirrors')
+    ):
+        output = Git.update_git_repo(webhook, output_callback=output_lines.append)
+
+    assert ''.join(output_lines) == output
+    assert 'Cloning into bare repository' in output
+
+
+def test_update_git_repo_legacy_clone(mock_remote, mock_webhook, tmp_path):
+    """Project folders cloned by older versions of Harvey are updated from the mirror in place."""
+    commit_file(mock_remote, 'first')
+    project_path = tmp_path / 'projects' / 'test_user' / 'test-repo-name'
+    git('clone', '-q', '--depth=1', f'file://{mock_remote}', str(project_path), cwd=tmp_path)
+    second_commit = commit_file(mock_remote, 'second')
+    webhook = {
+        **mock_webhook,
+        'after': second_commit,
+        'repository': {**mock_webhook['repository'], 'ssh_url': str(mock_remote)},
+    }
+
+    with patch('harvey.config.Config.projects_path', str(tmp_path / 'projects')), patch(
+        'harvey.config.Config.mirrors_path', str(tmp_path / 'mirrors')
+    ):
+        Git.update_git_repo(webhook)
+
+    assert (project_path / 'file.txt').read_text() == 'second'
+    # The clone has its own copy of the objects it needs, it doesn't break once the mirror's objects are pruned
+    assert not (project_path / '.git' / 'objects' / 'info' / 'alternates').exists()
+    shutil.rmtree(tmp_path / 'mirrors')
+    git('fsck', '--no-dangling', cwd=project_path)
+
+
+def test_update_git_repo_fetch_commit_sparse_checkout(mock_remote, mock_webhook, tmp_path):
+    """Only the pushed commit is fetched, without history or blobs outside of the sparse checkout."""
+    git('config', 'uploadpack.allowFilter', 'true', cwd=mock_remote)
+    (mock_remote / 'app').mkdir()
+    (mock_remote / 'app' / 'main.py').write_text('app')
+    git('add', 'app', cwd=mock_remote)
+    commit_file(mock_remote, 'first')
+    second_commit = commit_file(mock_remote, 'second')
+    webhook = {
+        **mock_webhook,
+        'after': second_commit,
+        'repository': {**mock_webhook['repository'], 'ssh_url': f'file://{mock_remote}'},
+    }
+    config = {'git_fetch': 'commit', 'git_filter': 'blob:none', 'git_sparse_checkout': ['/app/']}
+    project_path = tmp_path / 'projects' / 'test_user' / 'test-repo-name'
+    mirror_path = tmp_path / 'mirrors' / 'test_user' / 'test-repo-name.git'
+
+    with patch('harvey.config.Config.projects_path', str(tmp_path / 'projects')), patch(
+        'harvey.config.Config.mirrors_path', str(tmp_path / 'mirrors')
+    ):
+        Git.update_git_repo(webhook, config)
+
+    assert (project_path / 'app' / 'main.py').read_text() == 'app'
+    assert not (project_path / 'file.txt').exists()
+    assert git('rev-parse', 'HEAD', cwd=project_path) == second_commit
+    assert git('rev-parse', '--is-shallow-repository', cwd=mirror_path) == 'true'
+    assert git('rev-list', '--count', second_commit, cwd=mirror_path) == '1'
+
+
+def test_prefetch(mock_remote, mock_webhook, tmp_path):
+    """A prefetched commit is checked out by the deployment without fetching it again or touching the project
+    folder beforehand.
+    """
+    commit_file(mock_remote, 'first')
+    second_commit = commit_file(mock_remote, 'second')
+    webhook = {
+        **mock_webhook,
+        'after': second_commit,
+        'repository': {**mock_webhook['repository'], 'ssh_url': str(mock_remote)},
+    }
+    project_path = tmp_path / 'projects' / 'test_user' / 'test-repo-name'
+
+    with patch('harvey.config.Config.projects_path', str(tmp_path / 'projects')), patch(
+        'harvey.config.Config.mirrors_path', str(tmp_path / 'mirrors')
+    ):
+        assert Git.prefetch(webhook) is True
+        assert Git.prefetch(webhook) is False
+        assert not project_path.exists()
+
+        with patch('harvey.git.Git.fetch') as mock_fetch:
+            Git.update_git_repo(webhook)
+
+    mock_fetch.assert_not_called()
+    assert (project_path / 'file.txt').read_text() == 'second'
+
+
+def test_changed_paths(mock_remote, mock_webhook, tmp_path):
+    """Changes are determined against the last deployed commit, not the previously checked out one."""
+    commit_file(mock_remote, 'first')
+    webhook = {**mock_webhook, 'repository': {**mock_webhook['repository'], 'ssh_url': str(mock_remote)}}
+    project_path = tmp_path / 'projects' / 'test_user' / 'test-repo-name'
+
+    with patch('harvey.config.Config.projects_path', str(tmp_path / 'projects')), patch(
+        'harvey.config.Config.mirrors_path', str(tmp_path / 'mirrors')
+    ):
+        Git.update_git_repo({**webhook, 'after': git('rev-parse', 'HEAD', cwd=mock_remote)})
+        assert Git.changed_paths(webhook) is None
+
+        Git.record_deployed_commit(webhook)
+        (mock_remote / 'api').mkdir()
+        (mock_remote / 'api' / 'app.py').write_text('app')
+        git('add', 'api', cwd=mock_remote)
+        Git.update_git_repo({**webhook, 'after': commit_file(mock_remote, 'second')})
+        Git.update_git_repo({**webhook, 'after': commit_file(mock_remote, 'third')})
+
+        assert sorted(Git.changed_paths(webhook)) == ['api/app.py', 'file.txt']
+        assert (project_path / 'file.txt').read_text() == 'third'
+
+
+def test_changed_paths_same_commit(mock_remote, mock_webhook, tmp_path):
+    """Deploying the last deployed commit again deploys everything rather than nothing."""
+    commit = commit_file(mock_remote, 'first')
+    webhook = {**mock_webhook, 'repository': {**mock_webhook['repository'], 'ssh_url': str(mock_remote)}}
+
+    with patch('harvey.config.Config.projects_path', str(tmp_path / 'projects')), patch(
+        'harvey.config.Config.mirrors_path', str(tmp_path / 'mirrors')
+    ):
+        Git.update_git_repo({**webhook, 'after': commit})
+        Git.record_deployed_commit(webhook)
+        Git.update_git_repo({**webhook, 'after': commit})
 
-    mock_utils_kill.call_count == 2  # TODO: This should really only be once if we fail to pull but stash successfully
+        assert Git.changed_paths(webhook) is None
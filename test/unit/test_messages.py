@@ -1,17 +1,33 @@
-from unittest.mock import patch
+from unittest.mock import (
+    call,
+    patch,
+)
 
 import slack_sdk
 
-from harvey.messages import Message
+from harvey.messages import (
+    Message,
+    SlackSender,
+)
+
+
+@patch('harvey.messages.SlackSender.submit')
+def test_send_slack_message(mock_submit):
+    message = 'mock message'
+    Message.send_slack_message(message)
+
+    mock_submit.assert_called_once_with(message)
 
 
 @patch('harvey.config.Config.slack_channel', 'mock-channel')
 @patch('harvey.config.Config.slack_bot_token', '123')
 @patch('logging.Logger.debug')
 @patch('slack_sdk.WebClient.chat_postMessage')
-def test_send_slack_message_success(mock_slack, mock_logger):
+def test_slack_sender_success(mock_slack, mock_logger):
     message = 'mock message'
-    Message.send_slack_message(message)
+    slack_sender = SlackSender()
+    slack_sender.submit(message)
+    slack_sender.stop(timeout=5)
 
     mock_logger.assert_called_once()
     mock_slack.assert_called_once_with(channel='mock-channel', text=message)
@@ -29,11 +45,52 @@ def test_send_slack_message_success(mock_slack, mock_logger):
         },
     ),
 )
-def test_send_slack_message_exception(mock_slack, mock_sentry, mock_logger):
+def test_slack_sender_exception(mock_slack, mock_sentry, mock_logger):
     message = 'mock message'
     expected_error_message = "Harvey could not send the Slack message: The request to the Slack API failed.\nThe server responded with: {'ok': False, 'error': 'not_authed'}"  # noqa
 
-    Message.send_slack_message(message)
+    SlackSender()._send(message)
 
+    mock_slack.assert_called_once()
     mock_logger.assert_called_once_with(expected_error_message)
     mock_sentry.assert_called_once_with(expected_error_message, None, scope=None)
+
+
+@patch('logging.Logger.warning')
+@patch('time.sleep')
+@patch('slack_sdk.WebClient.chat_postMessage')
+def test_slack_sender_rate_limited(mock_slack, mock_sleep, mock_logger):
+    """Rate limited requests are retried after the delay Slack asks for."""
+    rate_limited_response = slack_sdk.web.SlackResponse(
+        client=None,
+        http_verb='POST',
+        api_url='mock-url',
+        req_args={},
+        data={'ok': False, 'error': 'ratelimited'},
+        headers={'Retry-After': '3'},
+        status_code=429,
+    )
+    mock_slack.side_effect = [
+        slack_sdk.errors.SlackApiError(message='mock-error', response=rate_limited_response),
+        ConnectionError('mock-error'),
+        None,
+    ]
+
+    SlackSender()._send('mock message')
+
+    assert mock_slack.call_count == 3
+    assert mock_sleep.call_args_list == [call(3.0), call(2.0)]
+
+
+@patch('harvey.messages.SlackSender.max_digest_length', 30)
+def test_slack_sender_digests():
+    """Messages that queued up while sending are coalesced into digests no longer than Slack displays."""
+    messages = [f'mock message {number}' for number in range(3)]
+
+    digests = SlackSender()._digests(messages)
+
+    assert digests == [
+        'Harvey digest of 2 messages:\n\nmock message 0\n\nmock message 1',
+        'mock message 2',
+    ]
+    assert SlackSender()._digests(['mock message']) == ['mock message']
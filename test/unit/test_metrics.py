@@ -0,0 +1,58 @@
+import pytest
+
+from harvey.metrics import (
+    Metric,
+    MetricsRegistry,
+)
+
+
+def test_render_metrics():
+    """Metrics are rendered in the Prometheus text format."""
+    metrics = MetricsRegistry()
+    counter = metrics.counter('mock_total', 'A mock counter.', ('status',))
+    gauge = metrics.gauge('mock_gauge', 'A mock gauge.')
+    histogram = metrics.histogram('mock_seconds', 'A mock histogram.', ('stage',), buckets=[1.0, 5.0])
+
+    counter.inc(status='success')
+    counter.inc(status='success')
+    counter.inc(status='fail"ure')
+    gauge.set_function(lambda: 3)
+    histogram.observe(0.5, stage='git')
+    histogram.observe(2.0, stage='git')
+    histogram.observe(10.0, stage='git')
+
+    assert metrics.render() == (
+        '# HELP mock_total A mock counter.\n'
+        '# TYPE mock_total counter\n'
+        'mock_total{status="fail\\"ure"} 1.0\n'
+        'mock_total{status="success"} 2.0\n'
+        '# HELP mock_gauge A mock gauge.\n'
+        '# TYPE mock_gauge gauge\n'
+        'mock_gauge 3.0\n'
+        '# HELP mock_seconds A mock histogram.\n'
+        '# TYPE mock_seconds histogram\n'
+        'mock_seconds_bucket{stage="git",le="1.0"} 1.0\n'
+        'mock_seconds_bucket{stage="git",le="5.0"} 2.0\n'
+        'mock_seconds_bucket{stage="git",le="+Inf"} 3.0\n'
+        'mock_seconds_sum{stage="git"} 12.5\n'
+        'mock_seconds_count{stage="git"} 3.0\n'
+    )
+
+
+def test_histogram_time():
+    metrics = MetricsRegistry()
+    histogram = metrics.histogram('mock_seconds', 'A mock histogram.', ('operation',))
+
+    try:
+        with histogram.time(operation='read'):
+            raise ValueError('mock error')
+    except ValueError:
+        pass
+
+    assert 'mock_seconds_count{operation="read"} 1.0' in metrics.render()
+
+
+def test_metric_is_abstract():
+    """Metrics must define their samples, see `Counter`, `Gauge`, and `Histogram`."""
+    with pytest.raises(TypeError):
+        Metric('mock_metric', 'A mock metric.')
@@ -0,0 +1,62 @@
+import threading
+from unittest.mock import patch
+
+import pytest
+
+from harvey.errors import GitError
+from harvey.prefetcher import Prefetcher
+
+
+@pytest.fixture
+def prefetcher():
+    prefetcher = Prefetcher()
+
+    yield prefetcher
+
+    prefetcher.stop()
+
+
+@patch('harvey.config.Config.max_concurrent_prefetches', 1)
+def test_submit_supersedes_pending_prefetch(prefetcher, mock_webhook):
+    """Only the newest commit of a project waiting for a free prefetch thread is fetched."""
+    first_started = threading.Event()
+    release = threading.Event()
+    prefetched_commits = []
+
+    def prefetch(webhook, config):
+        prefetched_commits.append(webhook['after'])
+        first_started.set()
+        release.wait(timeout=5)
+
+        return True
+
+    with patch('harvey.git.Git.prefetch', side_effect=prefetch):
+        prefetcher.submit({**mock_webhook, 'after': 'commit-1'})
+        assert first_started.wait(timeout=5)
+        prefetcher.submit({**mock_webhook, 'after': 'commit-2'})
+        prefetcher.submit({**mock_webhook, 'after': 'commit-3'})
+        release.set()
+        prefetcher.stop()
+
+    assert prefetched_commits == ['commit-1', 'commit-3']
+
+
+@patch('logging.Logger.warning')
+@patch('harvey.git.Git.prefetch', side_effect=GitError('mock error'))
+def test_submit_error(mock_prefetch, mock_logger, prefetcher, mock_webhook):
+    """A failed prefetch is left for the deployment to retry."""
+    prefetcher.submit(mock_webhook)
+    prefetcher.stop()
+
+    mock_logger.assert_called_once_with(
+        'Could not prefetch test_user/test-repo-name, the deployment will fetch it instead: mock error'
+    )
+
+
+@patch('harvey.config.Config.max_concurrent_prefetches', 0)
+@patch('harvey.git.Git.prefetch')
+def test_submit_disabled(mock_prefetch, prefetcher, mock_webhook):
+    prefetcher.submit(mock_webhook)
+    prefetcher.stop()
+
+    mock_prefetch.assert_not_called()
@@ -0,0 +1,408 @@
+import threading
+import time
+from unittest.mock import patch
+
+import pytest
+import yaml
+
+from harvey.repos.deployments import (
+    retrieve_deployment,
+    store_deployment_details,
+)
+from harvey.repos.jobs import (
+    claim_job,
+    enqueue_job,
+    reclaim_expired_jobs,
+    retrieve_jobs,
+)
+from harvey.repos.locks import (
+    acquire_project_lock,
+    lookup_project_lock,
+    release_project_lock,
+    update_project_lock,
+)
+from harvey.scheduler import Scheduler
+from harvey.tracing import (
+    TRACER,
+    JsonLinesExporter,
+)
+
+
+@pytest.fixture
+def scheduler():
+    """A scheduler whose workers are stopped once the test finishes so they never outlive its database."""
+    with patch.object(Scheduler, 'poll_interval_seconds', 0.05), patch.object(
+        Scheduler, 'heartbeat_interval_seconds', 0.05
+    ):
+        scheduler = Scheduler()
+        yield scheduler
+        scheduler.stop(timeout=5)
+
+
+def mock_project_webhook(mock_webhook, project_name):
+    return {**mock_webhook, 'repository': {**mock_webhook['repository'], 'full_name': project_name}}
+
+
+@patch('harvey.config.Config.max_concurrent_deployments', 2)
+@patch('harvey.scheduler.Deployment.run_deployment')
+def test_scheduler_limits_concurrent_deployments(mock_run_deployment, mock_webhook, scheduler):
+    """Only `max_concurrent_deployments` deployments run at once, the rest wait in the order they were queued."""
+    release_deployments = threading.Event()
+    two_started = threading.Event()
+    all_finished = threading.Event()
+    started_projects = []
+
+    def run_deployment(webhook, queue_wait_seconds):
+        started_projects.append(webhook['repository']['full_name'])
+        if len(started_projects) == 2:
+            two_started.set()
+        release_deployments.wait(timeout=5)
+        if len(started_projects) == 3:
+            all_finished.set()
+
+    mock_run_deployment.side_effect = run_deployment
+
+    for index in range(3):
+        scheduler.submit(mock_project_webhook(mock_webhook, f'test_user/project-{index}'))
+
+    assert two_started.wait(timeout=5)
+    status = scheduler.status()
+
+    assert len(status['running']) == 2
+    assert [job['project'] for job in status['queued']] == ['test_user/project-2']
+    assert status['queued'][0]['position'] == 1
+    assert status['max_concurrent_deployments'] == 2
+
+    release_deployments.set()
+
+    assert all_finished.wait(timeout=5)
+    assert started_projects[-1] == 'test_user/project-2'
+
+
+@patch('logging.Logger.error')
+@patch('harvey.scheduler.Deployment.run_deployment', side_effect=Exception('mock error'))
+def test_scheduler_survives_failed_deployments(mock_run_deployment, mock_logger, mock_webhook, scheduler):
+    finished = threading.Event()
+    mock_logger.side_effect = lambda message: finished.set()
+
+    scheduler.submit(mock_webhook)
+
+    assert finished.wait(timeout=5)
+    mock_logger.assert_called_once_with('Deployment of test_user/test-repo-name errored: mock error')
+
+
+@patch('harvey.config.Config.max_concurrent_deployments', 1)
+@patch('harvey.scheduler.Deployment.run_deployment')
+def test_scheduler_supersedes_queued_deployments(mock_run_deployment, mock_webhook, scheduler):
+    """A queued deployment is replaced by a newer commit of the same project and recorded as superseded."""
+    release_deployments = threading.Event()
+    first_started = threading.Event()
+    all_finished = threading.Event()
+    deployed_commits = []
+
+    def run_deployment(webhook, queue_wait_seconds):
+        deployed_commits.append(webhook['commits'][0]['id'])
+        first_started.set()
+        release_deployments.wait(timeout=5)
+        if len(deployed_commits) == 2:
+            all_finished.set()
+
+    mock_run_deployment.side_effect = run_deployment
+
+    scheduler.submit(mock_project_webhook(mock_webhook, 'test_user/other-project'))
+    assert first_started.wait(timeout=5)
+    for commit_id in ['1', '2', '3']:
+        job = scheduler.submit({**mock_webhook, 'commits': [{**mock_webhook['commits'][0], 'id': commit_id}]})
+
+    assert job['position'] == 1
+    assert [queued['commit'] for queued in scheduler.status()['queued']] == ['3']
+
+    release_deployments.set()
+
+    assert all_finished.wait(timeout=5)
+    assert deployed_commits[-1] == '3'
+    assert retrieve_deployment('test_user-test-repo-name-1')['attempts'][0]['status'] == 'Superseded'
+    assert retrieve_deployment('test_user-test-repo-name-2')['attempts'][0]['status'] == 'Superseded'
+
+
+@patch('harvey.config.Config.max_concurrent_deployments', 1)
+@patch('harvey.scheduler.Deployment.run_deployment')
+def test_scheduler_supersedes_redelivered_deployments(mock_run_deployment, mock_webhook, scheduler):
+    """Superseding a queued duplicate of the running commit leaves the attempt of the running deployment alone."""
+    release_deployments = threading.Event()
+    first_started = threading.Event()
+    all_finished = threading.Event()
+    deployed_commits = []
+
+    def run_deployment(webhook, queue_wait_seconds):
+        deployed_commits.append(webhook['commits'][0]['id'])
+        store_deployment_details(webhook)
+        first_started.set()
+        release_deployments.wait(timeout=5)
+        store_deployment_details(webhook, 'Deployment succeeded!')
+        release_project_lock('test_user/test-repo-name')  # Done by `succeed_deployment` in a real deployment
+        if len(deployed_commits) == 2:
+            all_finished.set()
+
+    mock_run_deployment.side_effect = run_deployment
+
+    scheduler.submit({**mock_webhook, 'commits': [{**mock_webhook['commits'][0], 'id': '1'}]})
+    assert first_started.wait(timeout=5)
+    scheduler.submit({**mock_webhook, 'commits': [{**mock_webhook['commits'][0], 'id': '1'}]})
+    scheduler.submit({**mock_webhook, 'commits': [{**mock_webhook['commits'][0], 'id': '2'}]})
+    release_deployments.set()
+
+    assert all_finished.wait(timeout=5)
+    assert deployed_commits == ['1', '2']
+    assert [attempt['status'] for attempt in retrieve_deployment('test_user-test-repo-name-1')['attempts']] == [
+        'Success'
+    ]
+
+
+@patch('harvey.scheduler.Deployment.run_deployment')
+def test_scheduler_redeploy(mock_run_deployment, mock_webhook, scheduler):
+    """Redeploys carry a flag on the webhook of their job."""
+    started = threading.Event()
+    mock_run_deployment.side_effect = lambda webhook, **kwargs: started.set()
+
+    scheduler.submit(mock_webhook, redeploy=True)
+
+    assert started.wait(timeout=5)
+    assert mock_run_deployment.call_args.args[0] == {**mock_webhook, 'redeploy': True}
+
+
+def wait_for_idle(scheduler):
+    """Wait for the running jobs of a scheduler to be finished, which happens once their spans are exported."""
+    deadline = time.monotonic() + 5
+    while scheduler.status()['running'] and time.monotonic() < deadline:
+        time.sleep(0.05)
+
+
+@patch('harvey.scheduler.Deployment.run_deployment')
+def test_scheduler_traces_each_attempt(mock_run_deployment, mock_client, mock_webhook, scheduler, tmp_path):
+    """Each attempt of a deployment is traced on its own and retrieved via the deployment's public ID."""
+    finished = threading.Event()
+
+    def run_deployment(webhook, queue_wait_seconds):
+        store_deployment_details(webhook)
+        store_deployment_details(webhook, 'Deployment succeeded!')
+        release_project_lock('test_user/test-repo-name')  # Done by `succeed_deployment` in a real deployment
+        finished.set()
+
+    mock_run_deployment.side_effect = run_deployment
+
+    with patch.object(TRACER, 'exporter', JsonLinesExporter(str(tmp_path))), patch(
+        'harvey.config.Config.traces_path', str(tmp_path)
+    ):
+        for redeploy in [False, True]:
+            finished.clear()
+            scheduler.submit(mock_webhook, redeploy=redeploy)
+            assert finished.wait(timeout=5)
+            wait_for_idle(scheduler)
+
+        latest_trace = mock_client.get('deployments/test_user-test-repo-name-123456/trace').json
+        first_trace = mock_client.get('deployments/test_user-test-repo-name-123456/trace?attempt=1').json
+
+    assert latest_trace['attempt'] == 2
+    assert first_trace['attempt'] == 1
+    for trace, attempt in [(latest_trace, 2), (first_trace, 1)]:
+        span_names = [span['name'] for span in trace['spans']]
+        assert span_names.count('deployment') == 1
+        assert span_names.count('store_deployment_details') == 2
+        assert {span['trace_id'] for span in trace['spans']} == {f'test_user-test-repo-name-123456.{attempt}'}
+        assert trace['timeline'].startswith('deployment')
+
+
+@patch('harvey.scheduler.Deployment.run_deployment')
+def test_scheduler_debounces_deployments(mock_run_deployment, mock_webhook, scheduler):
+    """Deployments of projects with a debounce window wait for it to pass before starting."""
+    started = threading.Event()
+    mock_run_deployment.side_effect = lambda webhook, **kwargs: started.set()
+
+    job = scheduler.submit({**mock_webhook, 'data': {'debounce_seconds': 0.5}})
+
+    assert not started.wait(timeout=0.2)
+    assert scheduler.status()['queued'][0]['id'] == job['id']
+    assert started.wait(timeout=5)
+
+
+@pytest.mark.parametrize(
+    'data, load_project_config',
+    [
+        ({'debounce_seconds': 'soon'}, None),
+        (None, yaml.YAMLError('mock error')),
+    ],
+)
+@patch('logging.Logger.warning')
+@patch('harvey.config.Config.deployment_debounce_seconds', 0)
+@patch('harvey.scheduler.Deployment.run_deployment')
+def test_scheduler_invalid_debounce_window(
+    mock_run_deployment, mock_logger, data, load_project_config, mock_webhook, scheduler
+):
+    """An invalid project config falls back to the default debounce window rather than failing to queue."""
+    started = threading.Event()
+    mock_run_deployment.side_effect = lambda webhook, **kwargs: started.set()
+
+    with patch('harvey.scheduler.Deployment.load_project_config', side_effect=load_project_config):
+        scheduler.submit({**mock_webhook, 'data': data})
+
+    assert started.wait(timeout=5)
+    mock_logger.assert_called_once()
+
+
+def mock_job(mock_webhook, job_id):
+    return {
+        'id': job_id,
+        'project': 'test_user/test-repo-name',
+        'webhook': mock_webhook,
+        'enqueued_at': time.time(),
+        'scheduled_for': time.time(),
+    }
+
+
+def test_scheduler_waits_for_system_locks(mock_webhook, scheduler):
+    """A deployment of a project locked by a deployment another runner is running waits in the queue."""
+    enqueue_job(mock_job(mock_webhook, 'mock-running-job'))
+    claim_job('mock-other-runner', lease_seconds=60)
+    acquire_project_lock('test_user/test-repo-name')
+    job = mock_job(mock_webhook, 'mock-job')
+    enqueue_job(job)
+
+    assert scheduler._acquire_lock(job) is False
+    assert scheduler.status()['queued'][0]['waiting_for_lock'] is True
+    assert lookup_project_lock('test_user/test-repo-name')['locked'] is True
+
+
+@patch('logging.Logger.warning')
+@patch('harvey.scheduler.Deployment.run_deployment')
+def test_scheduler_releases_stale_system_locks(mock_run_deployment, mock_logger, mock_webhook, scheduler):
+    """A system lock no running deployment holds (eg: left behind by a crash) doesn't hold deployments back."""
+    started = threading.Event()
+    mock_run_deployment.side_effect = lambda webhook, **kwargs: started.set()
+    acquire_project_lock('test_user/test-repo-name')
+
+    scheduler.submit(mock_webhook)
+
+    assert started.wait(timeout=5)
+    mock_logger.assert_called_once_with(
+        'Releasing the stale system lock of test_user/test-repo-name, no running deployment holds it'
+    )
+
+
+@patch('harvey.scheduler.Deployment.run_deployment')
+def test_scheduler_runs_one_deployment_per_project(mock_run_deployment, mock_webhook, scheduler):
+    """A deployment queued while its project is being deployed starts as soon as that deployment finishes."""
+    release_deployments = threading.Event()
+    first_started = threading.Event()
+    all_finished = threading.Event()
+    deployed_commits = []
+
+    def run_deployment(webhook, queue_wait_seconds):
+        deployed_commits.append(webhook['commits'][0]['id'])
+        first_started.set()
+        release_deployments.wait(timeout=5)
+        release_project_lock('test_user/test-repo-name')  # Done by `succeed_deployment` in a real deployment
+        if len(deployed_commits) == 2:
+            all_finished.set()
+
+    mock_run_deployment.side_effect = run_deployment
+
+    scheduler.submit({**mock_webhook, 'commits': [{**mock_webhook['commits'][0], 'id': '1'}]})
+    assert first_started.wait(timeout=5)
+    scheduler.submit({**mock_webhook, 'commits': [{**mock_webhook['commits'][0], 'id': '2'}]})
+    time.sleep(0.1)
+
+    assert deployed_commits == ['1']
+
+    release_deployments.set()
+
+    assert all_finished.wait(timeout=5)
+    assert deployed_commits == ['1', '2']
+
+
+@patch('logging.Logger.error')
+@patch('harvey.scheduler.Deployment.run_deployment')
+def test_scheduler_rejects_user_locked_projects(mock_run_deployment, mock_logger, mock_webhook, scheduler):
+    finished = threading.Event()
+    mock_logger.side_effect = lambda message: finished.set() if 'errored' in message else None
+    update_project_lock('test_user/test-repo-name', locked=True, system_lock=False)
+
+    scheduler.submit(mock_webhook)
+
+    assert finished.wait(timeout=5)
+    mock_run_deployment.assert_not_called()
+    assert retrieve_deployment('test_user-test-repo-name-123456')['attempts'][0]['status'] == 'Failure'
+    assert scheduler.status()['queued'] == []
+
+
+@patch('harvey.config.Config.external_runner', True)
+@patch('harvey.scheduler.Deployment.run_deployment')
+def test_scheduler_external_runner(mock_run_deployment, mock_webhook, scheduler):
+    """With an external runner, the API only queues deployments and a runner started later runs them."""
+    started = threading.Event()
+    mock_run_deployment.side_effect = lambda webhook, **kwargs: started.set()
+
+    scheduler.submit(mock_webhook)
+
+    assert not started.wait(timeout=0.1)
+
+    runner = Scheduler()
+    threading.Thread(target=runner.run, daemon=True).start()
+
+    assert started.wait(timeout=5)
+    runner.stop(timeout=5)
+
+
+@patch('harvey.scheduler.Scheduler.lease_seconds', 0.2)
+@patch('harvey.scheduler.Deployment.run_deployment')
+def test_scheduler_renews_leases_while_stopping(mock_run_deployment, mock_webhook, scheduler):
+    """Jobs still running while the scheduler stops keep their lease so no other runner reclaims them."""
+    release_deployment = threading.Event()
+    started = threading.Event()
+
+    def run_deployment(webhook, queue_wait_seconds):
+        started.set()
+        release_deployment.wait(timeout=5)
+
+    mock_run_deployment.side_effect = run_deployment
+
+    scheduler.submit(mock_webhook)
+    assert started.wait(timeout=5)
+    stopper = threading.Thread(target=scheduler.stop, kwargs={'timeout': 5})
+    stopper.start()
+    time.sleep(0.5)
+
+    assert reclaim_expired_jobs('mock-other-runner', lease_seconds=60) == []
+
+    release_deployment.set()
+    stopper.join(timeout=5)
+
+    assert retrieve_jobs() == []
+
+
+@patch('harvey.scheduler.Deployment.run_deployment')
+def test_scheduler_runs_jobs_left_in_the_queue(mock_run_deployment, mock_webhook, scheduler):
+    """Deployments queued before a restart run once the scheduler starts, without waiting for a new webhook."""
+    started = threading.Event()
+    mock_run_deployment.side_effect = lambda webhook, **kwargs: started.set()
+    enqueue_job(mock_job(mock_webhook, 'mock-job'))
+
+    scheduler.start()
+
+    assert started.wait(timeout=5)
+
+
+@patch('logging.Logger.warning')
+@patch('harvey.scheduler.Deployment.run_deployment')
+def test_scheduler_reclaims_jobs_of_dead_runners(mock_run_deployment, mock_logger, mock_webhook, scheduler):
+    """A deployment whose runner stopped renewing its lease is recorded as interrupted and run again."""
+    started = threading.Event()
+    mock_run_deployment.side_effect = lambda webhook, **kwargs: started.set()
+    enqueue_job(mock_job(mock_webhook, 'mock-job'))
+    claim_job('mock-dead-runner', lease_seconds=-1)
+
+    scheduler.start()
+
+    assert started.wait(timeout=5)
+    mock_logger.assert_called_once()
+    assert retrieve_deployment('test_user-test-repo-name-123456')['attempts'][0]['status'] == 'Failure'
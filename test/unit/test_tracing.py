@@ -0,0 +1,111 @@
+import json
+import os
+import time
+from unittest.mock import patch
+
+import pytest
+
+from harvey.tracing import (
+    NOOP_SPAN,
+    JsonLinesExporter,
+    Tracer,
+    render_timeline,
+)
+
+
+def test_tracer_disabled():
+    """Spans are no-ops unless an exporter is set."""
+    tracer = Tracer()
+
+    @tracer.traced('mock-function')
+    def mock_function():
+        return 'mock-result'
+
+    assert tracer.span('mock-span') is NOOP_SPAN
+    assert mock_function() == 'mock-result'
+
+
+def test_tracer_exports_spans(tmp_path):
+    """Spans are exported to the file of their trace, nested spans reference their parent."""
+    exporter = JsonLinesExporter(str(tmp_path))
+    tracer = Tracer(exporter)
+
+    @tracer.traced('mock-function')
+    def mock_function():
+        raise ValueError('mock error')
+
+    with tracer.trace('mock-deployment-id'), tracer.span('deployment', project='mock-project'):
+        with pytest.raises(ValueError):
+            mock_function()
+    with tracer.span('untraced'):
+        pass
+
+    spans = exporter.load('mock-deployment-id')
+
+    assert [span['name'] for span in spans] == ['mock-function', 'deployment']
+    assert spans[0]['parent_id'] == spans[1]['span_id']
+    assert spans[0]['error'] == 'ValueError: mock error'
+    assert spans[1]['parent_id'] is None
+    assert spans[1]['attributes'] == {'project': 'mock-project'}
+    assert (tmp_path / 'harvey.jsonl').exists()
+    assert exporter.load('../mock-deployment-id') == []
+
+
+def test_render_timeline():
+    spans = [
+        {'span_id': 'git', 'parent_id': 'root', 'name': 'git', 'start': 0.0, 'duration_ms': 500.0, 'error': None},
+        {'span_id': 'deploy', 'parent_id': 'root', 'name': 'deploy', 'start': 0.5, 'duration_ms': 500.0, 'error': 'x'},
+        {
+            'span_id': 'root',
+            'parent_id': None,
+            'name': 'deployment',
+            'start': 0.0,
+            'duration_ms': 1000.0,
+            'error': None,
+        },
+    ]
+
+    timeline = render_timeline(spans).split('\n')
+
+    assert timeline[0] == f'deployment       |{"#" * 60}| 1000.0ms'
+    assert timeline[1] == f'  git            |{"#" * 30}{" " * 30}| 500.0ms'
+    assert timeline[2] == f'  deploy (error) |{" " * 30}{"#" * 30}| 500.0ms'
+    assert render_timeline([]) == ''
+
+
+def test_exporter_attempts(tmp_path):
+    for filename in ['mock-deployment-id.2.jsonl', 'mock-deployment-id.10.jsonl', 'mock-deployment-id-2.1.jsonl']:
+        (tmp_path / filename).touch()
+
+    assert JsonLinesExporter(str(tmp_path)).attempts('mock-deployment-id') == [2, 10]
+    assert JsonLinesExporter(str(tmp_path / 'missing')).attempts('mock-deployment-id') == []
+
+
+def test_exporter_removes_expired_traces(tmp_path):
+    """Traces older than the retention period are removed when a new trace starts."""
+    exporter = JsonLinesExporter(str(tmp_path), retention_days=1)
+    expired_time = time.time() - 2 * 24 * 60 * 60
+    for filename in ('expired.1.jsonl', 'harvey.jsonl', 'recent.1.jsonl'):
+        (tmp_path / filename).write_text('{}\n')
+    os.utime(tmp_path / 'expired.1.jsonl', (expired_time, expired_time))
+    os.utime(tmp_path / 'harvey.jsonl', (expired_time, expired_time))
+
+    tracer = Tracer(exporter)
+    with tracer.trace('mock-deployment-id'), tracer.span('deployment'):
+        pass
+
+    assert sorted(os.listdir(tmp_path)) == ['harvey.jsonl', 'mock-deployment-id.jsonl', 'recent.1.jsonl']
+
+
+@patch('harvey.tracing.MAX_UNTRACED_BYTES', 10)
+def test_exporter_rotates_untraced_spans(tmp_path):
+    """The file of untraced spans is rotated once it reaches its size cap."""
+    exporter = JsonLinesExporter(str(tmp_path))
+    tracer = Tracer(exporter)
+
+    for name in ('first', 'second', 'third'):
+        with tracer.span(name):
+            pass
+
+    assert [json.loads(line)['name'] for line in (tmp_path / 'harvey.jsonl').read_text().splitlines()] == ['third']
+    assert [json.loads(line)['name'] for line in (tmp_path / 'harvey.jsonl.1').read_text().splitlines()] == ['second']
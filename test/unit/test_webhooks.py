@@ -83,3 +83,9 @@ def test_deployment_id(mock_webhook):
     result = Webhook.deployment_id(mock_webhook)
 
     assert result == 'test_user-test-repo-name@123456'
+
+
+def test_repo_head_commit_id(mock_webhook):
+    assert Webhook.repo_head_commit_id(mock_webhook) == '123456'
+    assert Webhook.repo_head_commit_id({**mock_webhook, 'head_commit': {'id': 'abc'}}) == 'abc'
+    assert Webhook.repo_head_commit_id({**mock_webhook, 'after': 'def', 'head_commit': {'id': 'abc'}}) == 'def'
@@ -1,3 +1,5 @@
+import subprocess
+import sys
 from unittest.mock import patch
 
 import pytest
@@ -9,29 +11,31 @@ from harvey.utils.deployments import (
 )
 from harvey.utils.utils import (
     format_project_name,
+    get_command_name,
     setup_logger,
+    stream_subprocess_command,
 )
 
 
-@patch('harvey.utils.deployments.lookup_project_lock')
+@patch('harvey.utils.deployments.release_project_lock')
 @patch('harvey.utils.deployments.store_deployment_details')
-@patch('logging.Logger.info')
-def test_kill_deployment(mock_logger, mock_store_deployment_details, mock_lookup_lock, mock_output, mock_webhook):
+@patch('logging.Logger.error')
+def test_kill_deployment(mock_logger, mock_store_deployment_details, mock_release_lock, mock_output, mock_webhook):
     with pytest.raises(HarveyError, match='Failure! `test_user/test-repo-name` deployment failed!'):
         kill_deployment(mock_output, mock_webhook)
 
     mock_store_deployment_details.assert_called_once()
-    mock_lookup_lock.assert_called_once()
+    mock_release_lock.assert_called_once_with('test_user/test-repo-name')
     mock_logger.assert_called()
 
 
 @patch('harvey.config.Config.use_slack', True)
-@patch('harvey.utils.deployments.lookup_project_lock')
+@patch('harvey.utils.deployments.release_project_lock')
 @patch('harvey.messages.Message.send_slack_message')
 @patch('harvey.utils.deployments.store_deployment_details')
 @patch('logging.Logger.error')
 def test_kill_deployment_with_slack(
-    mock_logger, mock_store_deployment_details, mock_slack, mock_lookup_lock, mock_output, mock_webhook
+    mock_logger, mock_store_deployment_details, mock_slack, mock_release_lock, mock_output, mock_webhook
 ):
     with pytest.raises(HarveyError, match='Failure! `test_user/test-repo-name` deployment failed!'):
         kill_deployment(mock_output, mock_webhook)
@@ -39,16 +43,18 @@ def test_kill_deployment_with_slack(
     mock_logger.assert_called()
     mock_store_deployment_details.assert_called_once()
     mock_slack.assert_called_once()
-    mock_lookup_lock.assert_called_once()
+    mock_release_lock.assert_called_once_with('test_user/test-repo-name')
 
 
+@patch('harvey.utils.deployments.release_project_lock')
 @patch('harvey.utils.deployments.store_deployment_details')
 @patch('logging.Logger.info')
-def test_succeed_deployment(mock_logger, mock_store_deployment_details, mock_output, mock_webhook):
+def test_succeed_deployment(mock_logger, mock_store_deployment_details, mock_release_lock, mock_output, mock_webhook):
     succeed_deployment(mock_output, mock_webhook)
 
     mock_logger.assert_called()
     mock_store_deployment_details.assert_called_once()
+    mock_release_lock.assert_called_once_with('test_user/test-repo-name')
 
 
 @patch('harvey.config.Config.use_slack', True)
@@ -76,3 +82,34 @@ def test_setup_logger(mock_logger):
 def test_format_project_name():
     """Tests that we properly format project names so we can lookup items when needed."""
     assert format_project_name('justintime50/project-name') == 'justintime50-project-name'
+
+
+def test_get_command_name():
+    assert get_command_name(['env', 'GIT_NO_LAZY_FETCH=1', '/usr/bin/git', 'cat-file']) == 'git'
+    assert get_command_name(['docker', 'compose', '-f', 'docker-compose.yml', 'up']) == 'docker compose'
+    assert get_command_name(['docker', 'tag', 'mock-image']) == 'docker'
+
+
+def test_stream_subprocess_command():
+    """Tests that output is passed to the callback line by line."""
+    lines = []
+    pids = []
+    stream_subprocess_command(
+        [sys.executable, '-c', 'print("line 1"); print("line 2")'],
+        lines.append,
+        pid_callback=pids.append,
+    )
+
+    assert lines == ['line 1\n', 'line 2\n']
+    assert len(pids) == 1
+
+
+def test_stream_subprocess_command_error():
+    with pytest.raises(subprocess.CalledProcessError):
+        stream_subprocess_command([sys.executable, '-c', 'import sys; sys.exit(1)'], print)
+
+
+@patch('harvey.config.Config.operation_timeout', 0.1)
+def test_stream_subprocess_command_timeout():
+    with pytest.raises(subprocess.TimeoutExpired):
+        stream_subprocess_command([sys.executable, '-c', 'import time; time.sleep(5)'], print)